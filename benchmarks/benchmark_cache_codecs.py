@@ -0,0 +1,70 @@
+"""
+Benchmark of the cache values codecs.
+
+Compares the size of all the Identity Providers configurations (the `all_idps`
+cache entry) and their loading duration when stored as is (pickled by the cache
+backend) or encoded with the available codecs.
+
+Usage: `python benchmarks/benchmark_cache_codecs.py`
+"""
+import pickle
+
+from utils import (
+    generate_large_federation_metadata,
+    get_real_world_metadata,
+    run_benchmark,
+)
+
+from social_edu_federation.parser import FederationMetadataParser
+from social_edu_federation.serialization import (
+    ZlibCodec,
+    decode_value,
+    encode_value,
+    get_codec,
+)
+
+
+def main():
+    """Runs the codecs benchmarks on real world and generated metadata."""
+    for label, metadata in (
+        ("real world metadata", get_real_world_metadata()),
+        ("generated metadata", generate_large_federation_metadata(2000)),
+    ):
+        all_idp_dict = FederationMetadataParser.parse_federation_metadata(metadata)
+        print(f"# {label} ({len(all_idp_dict)} IdPs)")
+
+        # The cache backend pickles the values it stores
+        stored_values = [("as is", pickle.dumps(all_idp_dict, pickle.HIGHEST_PROTOCOL))]
+        for codec_label, codec in (
+            ("pickle codec", get_codec("pickle")),
+            ("zlib codec (level 1)", ZlibCodec(level=1)),
+            ("zlib codec (level 6)", get_codec("zlib")),
+            ("zlib codec (level 9)", ZlibCodec(level=9)),
+        ):
+            stored_values.append(
+                (
+                    codec_label,
+                    pickle.dumps(
+                        encode_value(all_idp_dict, codec), pickle.HIGHEST_PROTOCOL
+                    ),
+                )
+            )
+
+        reference_size = len(stored_values[0][1])
+        for codec_label, stored_value in stored_values:
+            print(
+                f"{codec_label + ' size':<50} {len(stored_value) // 1024:>7} kB"
+                f" (x{reference_size / len(stored_value):.2f})"
+            )
+            run_benchmark(
+                f"{codec_label} load",
+                lambda: decode_value(
+                    pickle.loads(stored_value)  # pylint: disable=cell-var-from-loop
+                ),
+                number=20,
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
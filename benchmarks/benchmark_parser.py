@@ -0,0 +1,47 @@
+"""
+Benchmark of the federation metadata parser.
+
+Compares the single-pass parsing (entity descriptors read from the already
+parsed tree) with the former parsing which serializes each entity descriptor
+to let python3-saml parse it again.
+
+Usage: `python benchmarks/benchmark_parser.py`
+"""
+from utils import (
+    generate_large_federation_metadata,
+    get_real_world_metadata,
+    run_benchmark,
+)
+
+from social_edu_federation.parser import FederationMetadataParser
+
+
+def main():
+    """Runs the parser benchmarks on real world and generated metadata."""
+    for label, metadata in (
+        ("real world metadata", get_real_world_metadata()),
+        ("generated metadata (2000 IdPs)", generate_large_federation_metadata(2000)),
+        (
+            "generated metadata (500 IdPs, 5000 SPs)",
+            generate_large_federation_metadata(500, sp_count=5000),
+        ),
+    ):
+        print(f"# {label} ({len(metadata) // 1024} kB)")
+        reparse_duration = run_benchmark(
+            "reparse entities",
+            lambda: FederationMetadataParser.parse_federation_metadata(
+                metadata,  # pylint: disable=cell-var-from-loop
+                reparse_entities=True,
+            ),
+        )
+        single_pass_duration = run_benchmark(
+            "single pass",
+            lambda: FederationMetadataParser.parse_federation_metadata(
+                metadata,  # pylint: disable=cell-var-from-loop
+            ),
+        )
+        print(f"speed-up: x{reparse_duration / single_pass_duration:.2f}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of the federation metadata parser peak memory.
+
+Compares the peak memory (RSS) of the tree based parsing with the
+streaming (`iterparse`) one, for growing federation sizes.
+Each measure runs in its own process, reading the metadata from a file.
+The streaming parser memory only grows with the returned IdP dict.
+
+Usage: `python benchmarks/benchmark_parser_memory.py`
+"""
+import subprocess  # nosec
+import sys
+import tempfile
+
+from utils import generate_large_federation_metadata
+
+
+# Peak RSS is read from `/proc` (Linux only) because `ru_maxrss` may
+# be inherited from the (large) parent process.
+_MEASURE_SCRIPT = """\
+import sys
+
+from social_edu_federation.parser import FederationMetadataParser
+
+mode, path = sys.argv[1:]
+with open(path, "rb") as metadata_fd:
+    if mode == "tree":
+        FederationMetadataParser.parse_federation_metadata(metadata_fd.read())
+    elif mode == "iterparse":
+        FederationMetadataParser.iterparse_federation_metadata(metadata_fd)
+with open("/proc/self/status", encoding="ascii") as status_fd:
+    print(next(line for line in status_fd if line.startswith("VmHWM:")).split()[1])
+"""
+
+
+def measure_peak_memory(mode: str, path: str) -> int:
+    """Returns the peak RSS (in kB) of a process parsing `path` with `mode`."""
+    process = subprocess.run(  # nosec
+        [sys.executable, "-c", _MEASURE_SCRIPT, mode, path],
+        capture_output=True,
+        check=True,
+    )
+    return int(process.stdout)
+
+
+def main():
+    """Runs the memory benchmarks on generated metadata."""
+    with tempfile.NamedTemporaryFile(suffix=".xml") as metadata_file:
+        baseline = measure_peak_memory("none", metadata_file.name)
+
+        for idp_count in (500, 2000, 8000):
+            metadata = generate_large_federation_metadata(idp_count)
+            metadata_file.seek(0)
+            metadata_file.truncate()
+            metadata_file.write(metadata)
+            metadata_file.flush()
+
+            print(f"# {idp_count} IdPs ({len(metadata) // 1024} kB)")
+            for mode in ("tree", "iterparse"):
+                peak_memory = measure_peak_memory(mode, metadata_file.name) - baseline
+                print(f"{mode:<50} {peak_memory // 1024:>10} MB")
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Benchmark of the federation metadata parallel parser.
+
+Compares the sequential parsing with the parallel one, using
+a growing number of processes, on a generated federation.
+
+Usage: `python benchmarks/benchmark_parser_parallel.py`
+"""
+import os
+
+from utils import generate_large_federation_metadata, run_benchmark
+
+from social_edu_federation.parser import FederationMetadataParser
+
+
+def main():
+    """Runs the parallel parser benchmarks on a 10k entities federation."""
+    metadata = generate_large_federation_metadata(10000)
+    print(f"# generated metadata (10000 IdPs) ({len(metadata) // 1024} kB)")
+    print(f"# {os.cpu_count()} processors available")
+
+    sequential_duration = run_benchmark(
+        "sequential",
+        lambda: FederationMetadataParser.parse_federation_metadata(metadata),
+        number=1,
+    )
+    for max_workers in (2, 4, 8):
+        parallel_duration = run_benchmark(
+            f"parallel ({max_workers} processes)",
+            lambda: FederationMetadataParser.parallel_parse_federation_metadata(
+                metadata,
+                max_workers=max_workers,  # pylint: disable=cell-var-from-loop
+            ),
+            number=1,
+        )
+        print(f"speed-up: x{sequential_duration / parallel_duration:.2f}")
+
+
+if __name__ == "__main__":
+    main()
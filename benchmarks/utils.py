@@ -0,0 +1,52 @@
+"""Common tools for the benchmark scripts."""
+import os
+import timeit
+
+from social_edu_federation.testing.saml_tools import (
+    format_mdui_display_name,
+    generate_idp_federation_metadata,
+    generate_idp_metadata,
+    generate_sp_metadata,
+)
+
+
+REAL_WORLD_METADATA_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "tests",
+    "resources",
+    "real-world-metadata.xml",
+)
+
+
+def get_real_world_metadata() -> bytes:
+    """Returns the real world RENATER metadata used in the tests."""
+    with open(REAL_WORLD_METADATA_PATH, "rb") as metadata_fd:
+        return metadata_fd.read()
+
+
+def generate_large_federation_metadata(idp_count: int, sp_count: int = 0) -> bytes:
+    """
+    Generates a federation metadata containing `idp_count` identity providers
+    and `sp_count` service providers.
+    """
+    entity_descriptor_list = [
+        generate_idp_metadata(
+            entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+            sso_location=f"http://edu-{index}.example.com/adfs/sso/",
+            ui_info_display_names=format_mdui_display_name(f"Edu IdP {index}"),
+        )
+        for index in range(idp_count)
+    ] + [
+        generate_sp_metadata(entity_id=f"https://sp-{index}.example.com/")
+        for index in range(sp_count)
+    ]
+    return generate_idp_federation_metadata(
+        entity_descriptor_list=entity_descriptor_list
+    ).encode("utf-8")
+
+
+def run_benchmark(label: str, statement, number: int = 5, repeat: int = 3) -> float:
+    """Runs `statement` and prints the best average duration (in seconds) per run."""
+    best_duration = min(timeit.repeat(statement, number=number, repeat=repeat)) / number
+    print(f"{label:<50} {best_duration * 1000:>10.2f} ms")
+    return best_duration
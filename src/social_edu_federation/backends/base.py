@@ -1,7 +1,11 @@
 """Module containing the base class for the project's backends."""
 
 from social_core.backends.saml import SAMLAuth, SAMLIdentityProvider
-from social_core.utils import module_member
+
+from social_edu_federation.metadata_store import (
+    get_metadata_store,
+    get_metadata_store_class,
+)
 
 
 class EduFedSAMLIdentityProvider(SAMLIdentityProvider):
@@ -95,17 +99,20 @@ class EduFedSAMLAuth(SAMLAuth):
         return self.setting("FEDERATION_SAML_METADATA_URL", None)
 
     def get_metadata_store(self):
-        """Retrieves the metadata store according to configuration."""
+        """
+        Retrieves the metadata store according to configuration,
+        reused between calls, see `metadata_store.get_metadata_store`.
+        """
         metadata_store_path = self.setting(
             "FEDERATION_SAML_METADATA_STORE",
             "social_edu_federation.metadata_store.BaseMetadataStore",
         )
         try:
-            metadata_store_class = module_member(metadata_store_path)
+            metadata_store_class = get_metadata_store_class(metadata_store_path)
         except AttributeError as exception:
             # Reraise exception as an ImportError
             raise ImportError(exception) from exception
-        return metadata_store_class(self)
+        return get_metadata_store(self, metadata_store_class)
 
     def get_idp(self, idp_name):
         """
@@ -0,0 +1,181 @@
+"""
+In-memory cache module
+
+Provides a cache for the metadata stores which can't rely on a framework cache,
+see `social_edu_federation.metadata_store.MemoryCachedMetadataStore`.
+Its API is a subset of Django's cache API.
+
+Also provides a way to coalesce concurrent computations of the same value,
+by threads or coroutines.
+"""
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+
+DEFAULT_TIMEOUT = object()
+
+
+class MemoryCache:
+    """
+    Thread-safe in-memory cache, with an expiration delay (TTL) per entry and
+    a maximum number of entries: the least recently used entries are evicted first.
+
+    Values are stored as is (not copied nor serialized), they must not be modified.
+    """
+
+    def __init__(self, max_entries=1000, default_timeout=300):
+        """
+        Parameters
+        ----------
+        max_entries : int
+            The maximum number of entries kept in the cache.
+
+        default_timeout : float or None
+            The default number of seconds an entry is kept, `None` to keep
+            entries until they are evicted.
+        """
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()  # {key: (expiration time or None, value)}
+        self._lock = threading.Lock()
+
+    def _get_expiration_time(self, timeout):
+        """Returns the expiration time of an entry, using `time.monotonic`."""
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def _get_entry(self, key):
+        """Returns the entry or `None` when missing or expired, must hold the lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expiration_time, _value = entry
+        if expiration_time is not None and expiration_time <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _set_entry(self, key, value, expiration_time):
+        """Stores an entry and evicts the least recently used ones, must hold the lock."""
+        self._entries[key] = (expiration_time, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        """Returns the value of `key`, or `default` when missing or expired."""
+        with self._lock:
+            entry = self._get_entry(key)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        """Stores `value` for `timeout` seconds (the default timeout if not provided)."""
+        expiration_time = self._get_expiration_time(timeout)
+        with self._lock:
+            self._set_entry(key, value, expiration_time)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT):
+        """Stores all the values of the `data` dict, see `set`."""
+        expiration_time = self._get_expiration_time(timeout)
+        with self._lock:
+            for key, value in data.items():
+                self._set_entry(key, value, expiration_time)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        """
+        Stores `value` only if `key` is missing or expired.
+
+        Returns `True` when the value was stored.
+        """
+        expiration_time = self._get_expiration_time(timeout)
+        with self._lock:
+            if self._get_entry(key) is not None:
+                return False
+            self._set_entry(key, value, expiration_time)
+        return True
+
+    def delete(self, key):
+        """Removes `key`, returns whether it was in the cache."""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        """Removes all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        """Returns the number of entries, including the expired ones not evicted yet."""
+        return len(self._entries)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing the same key, in the process: the first
+    caller runs the function while the others wait for its result (or exception).
+
+    The calls may also be made by coroutines, see `arun`.
+    """
+
+    def __init__(self):
+        """No call in flight."""
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function, *args, **kwargs):
+        """
+        Returns `function(*args, **kwargs)`, or the result of the call already
+        running for `key` in another thread.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._futures[key] = Future()
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    async def arun(self, key, executor, function, *args):
+        """
+        Asynchronous `run`: returns `function(*args)` run in `executor` (`None` for
+        the default executor of the event loop), or the result of the call already
+        running for `key`. The waiting callers (coroutines or threads) do not hold
+        a thread of the executor, and the call is not cancelled with its caller.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = Future()
+                asyncio.get_running_loop().run_in_executor(
+                    executor, self._run_future, key, future, function, *args
+                )
+        return await asyncio.wrap_future(future)
+
+    def _run_future(self, key, future, function, *args):
+        """Runs the call started by `arun`, setting its result on `future`."""
+        try:
+            future.set_result(function(*args))
+        except BaseException as exception:  # pylint: disable=broad-except
+            future.set_exception(exception)
+        finally:
+            with self._lock:
+                del self._futures[key]
@@ -20,3 +20,4 @@ class PythonSocialEduFedAuthConfig(AppConfig):
 
     def ready(self):
         django_checks.register(checks.metadata_store_check, Tags.caches)
+        django_checks.register(checks.metadata_cache_check, Tags.caches)
@@ -0,0 +1,158 @@
+"""
+Django cache entries module
+
+Provides the cache object behavior of the Django cached metadata store, see
+`social_edu_federation.django.metadata_store.CachedMetadataStore`.
+"""
+import datetime
+import logging
+import random
+
+from django.core.cache import cache as default_cache
+
+from asgiref.sync import sync_to_async
+
+from social_edu_federation.serialization import (
+    decode_value,
+    encode_value,
+    get_chunk_count,
+    get_codec,
+    join_chunks,
+    split_value,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntryMixin:
+    """
+    Mix-in to turn `BaseMetadataStore` into a cache object to easily
+    manage object storage in cache.
+
+    This:
+     - adds a namespace to the cached keys,
+     - defines a cache duration of one day,
+       we add a minute to ensure the refreshing management command
+       can pass again, plus a random delay up to `duration_jitter` seconds,
+     -  uses the default defined cache (you may use a Redis cache in production),
+     - encodes the values with `codec` when defined, to compress them for instance
+       (see `social_edu_federation.serialization`),
+     - splits the values larger than `chunk_size` bytes in several cache entries,
+       for caches limiting the size of their items (memcached).
+    """
+
+    namespace = "edu_fed_saml"
+    duration = datetime.timedelta(hours=24, minutes=1).total_seconds()
+    duration_jitter = 0
+    cache = default_cache  # Django default cache
+    codec = None  # Values are stored as is
+    chunk_size = None  # Values are not split
+
+    def get_duration(self):
+        """Returns the cache duration, with its random jitter."""
+        return self.duration + random.uniform(0, self.duration_jitter)
+
+    def _namespaced_key(self, key):
+        """Returns a key for the cache entry."""
+        return f"edu_federation:{self.namespace}:{key}"
+
+    def encode_value(self, value, codec=None):
+        """
+        Returns the value to store in cache, encoded with `codec` (defaults to
+        the store `codec`) if any, or with the pickle codec when it may be split
+        in chunks.
+        """
+        codec = codec or self.codec
+        if codec is None and self.chunk_size is not None:
+            codec = get_codec("pickle")  # The value size must be known
+        if codec is None:
+            return value
+        return encode_value(value, codec)
+
+    def _get_stored_entries(self, key, value, codec=None):
+        """
+        Returns the cache entries storing the value: the encoded value itself,
+        or its chunks and their manifest when larger than `chunk_size`.
+        """
+        namespaced_key = self._namespaced_key(key)
+        value = self.encode_value(value, codec)
+        if self.chunk_size is None or len(value) <= self.chunk_size:
+            return {namespaced_key: value}
+
+        manifest, chunks = split_value(value, self.chunk_size)
+        entries = {namespaced_key: manifest}
+        for index, chunk in enumerate(chunks):
+            entries[f"{namespaced_key}:chunk:{index}"] = chunk
+        return entries
+
+    def _set_entries(self, values, timeout, codec=None):
+        """
+        Stores the `values` dict in cache, for `timeout` seconds (`None` for ever),
+        see `encode_value` for `codec`.
+        """
+        entries = {}
+        for key, value in values.items():
+            entries.update(self._get_stored_entries(key, value, codec))
+        failed_keys = self.cache.set_many(entries, timeout)
+        if failed_keys:
+            logger.warning(
+                "%s cache entries of %s were not stored (too large?)",
+                len(failed_keys),
+                self.namespace,
+            )
+
+    def set_many(self, timeout=None, **kwargs):
+        """
+        Class method to update keys in cache by batch,
+        for `timeout` seconds (defaults to `get_duration`).
+
+        Note: `RenaterCache` does not provide other "many keys" manipulation.
+        This is on purpose, as we don't need this complexity here.
+        """
+        self._set_entries(kwargs, self.get_duration() if timeout is None else timeout)
+
+    def get(self, entry_id):
+        """
+        Returns the cache entry value, `None` when missing or when one
+        of its chunks is missing.
+        """
+        namespaced_key = self._namespaced_key(entry_id)
+        value = self.cache.get(namespaced_key)
+        chunk_count = get_chunk_count(value)
+        if chunk_count is not None:
+            chunk_keys = [
+                f"{namespaced_key}:chunk:{index}" for index in range(chunk_count)
+            ]
+            chunks = self.cache.get_many(chunk_keys)
+            value = join_chunks(value, [chunks.get(key) for key in chunk_keys])
+        return decode_value(value)
+
+    async def _acache_call(self, method_name, *args):
+        """
+        Calls the asynchronous method of the cache (Django >= 4.0), or its synchronous
+        counterpart in a thread.
+        """
+        async_method = getattr(self.cache, f"a{method_name}", None)
+        if async_method is None:
+            return await sync_to_async(getattr(self.cache, method_name))(*args)
+        return await async_method(*args)
+
+    async def aget(self, entry_id):
+        """Asynchronous `get`, using Django's asynchronous cache API."""
+        namespaced_key = self._namespaced_key(entry_id)
+        value = await self._acache_call("get", namespaced_key)
+        chunk_count = get_chunk_count(value)
+        if chunk_count is not None:
+            chunk_keys = [
+                f"{namespaced_key}:chunk:{index}" for index in range(chunk_count)
+            ]
+            chunks = await self._acache_call("get_many", chunk_keys)
+            value = join_chunks(value, [chunks.get(key) for key in chunk_keys])
+        return decode_value(value)
+
+    def set(self, entry_id, value, timeout=None):
+        """Store the cache entry value, for `timeout` seconds (defaults to `get_duration`)."""
+        self._set_entries(
+            {entry_id: value}, self.get_duration() if timeout is None else timeout
+        )
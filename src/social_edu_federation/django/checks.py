@@ -8,6 +8,12 @@ from social_core.utils import setting_name
 from social_edu_federation.backends.base import EduFedSAMLAuth
 
 
+# memcached default item size limit is 1 MB, leave room for the key and item headers
+MEMCACHED_MAX_CHUNK_SIZE = 1000 * 1000
+# Django memcached cache backends class names (also used by third party packages)
+MEMCACHED_CACHE_CLASS_NAMES = ("PyMemcacheCache", "PyLibMCCache", "MemcachedCache")
+
+
 def metadata_store_check(app_configs, **kwargs):  # pylint: disable=unused-argument
     """
     When using Django it is heavily recommended to use the `CachedMetadataStore`
@@ -43,3 +49,60 @@ def metadata_store_check(app_configs, **kwargs):  # pylint: disable=unused-argum
             )
 
     return errors
+
+
+def metadata_cache_check(app_configs, **kwargs):  # pylint: disable=unused-argument
+    """
+    The federation metadata stored by the `CachedMetadataStore` is larger than
+    memcached's item size limit (1 MB by default), which drops too large values
+    silently: they must be split in chunks.
+    """
+    # Make these imports locally to prevent application use before all application are ready.
+    from social_django.utils import (  # pylint: disable=import-outside-toplevel
+        load_strategy,
+    )
+
+    from social_edu_federation.django import (  # pylint: disable=import-outside-toplevel
+        metadata_store,
+    )
+
+    strategy = load_strategy()
+    errors = []
+
+    for authentication_backend_name in settings.AUTHENTICATION_BACKENDS:
+        backend_class = import_string(authentication_backend_name)
+        if not issubclass(backend_class, EduFedSAMLAuth):
+            continue
+        backend = backend_class(strategy)
+        try:
+            metadata_store_class = import_string(
+                backend.setting("FEDERATION_SAML_METADATA_STORE", "")
+            )
+        except ImportError:
+            continue
+        if not issubclass(metadata_store_class, metadata_store.CachedMetadataStore):
+            continue
+
+        cache_name = backend.setting("DJANGO_CACHE", None) or "default"
+        cache_backend = settings.CACHES.get(cache_name, {}).get("BACKEND", "")
+        chunk_size = backend.setting("FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE", None)
+        if cache_backend.rsplit(".", 1)[-1] in MEMCACHED_CACHE_CLASS_NAMES and not (
+            chunk_size and chunk_size <= MEMCACHED_MAX_CHUNK_SIZE
+        ):
+            setting = setting_name(
+                backend_class.name, "FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE"
+            )
+            errors.append(
+                ChecksWarning(
+                    f"The '{cache_name}' cache can't hold the federation metadata.",
+                    hint=(
+                        f"memcached items are limited to 1 MB by default, you should "
+                        f"add a `{setting}` setting (at most {MEMCACHED_MAX_CHUNK_SIZE}) "
+                        f"for `{authentication_backend_name}` backend use."
+                    ),
+                    obj=cache_backend,
+                    id="social_edu_federation.W002",
+                )
+            )
+
+    return errors
@@ -23,6 +23,9 @@ class Command(BaseCommand):
         We catch any error to allow the command to run the cache refresh on other
         backends provided in arguments even if one backend fails (e.g. for a timeout
         reason).
+
+        The backends whose metadata was not modified since the previous refresh
+        are reported as unchanged.
         """
         success = True
         for backend_name in options["backends"]:
@@ -47,6 +50,14 @@ class Command(BaseCommand):
                     f"{metadata_store.__class__.__name__} failed "
                     f"to refresh the metadata cache ({exception})"
                 )
+            else:
+                if (
+                    metadata_store.metadata_modified is False
+                    and options["verbosity"] >= 1
+                ):
+                    self.stdout.write(
+                        f"Metadata for backend '{backend_name}' unchanged"
+                    )
 
         if not success:
             raise CommandError(
@@ -1,65 +1,189 @@
 """Metadata store module using Django's default cache"""
 import datetime
+import logging
+import math
+import random
+import threading
+import time
+import uuid
 
-from django.core.cache import InvalidCacheBackendError, cache as default_cache, caches
+from django.core.cache import InvalidCacheBackendError, caches
 
 from social_core.utils import slugify
 
-from social_edu_federation.metadata_store import BaseMetadataStore
-from social_edu_federation.parser import FederationMetadataParser
+from social_edu_federation.cache import MemoryCache, SingleFlight
+from social_edu_federation.fetcher import (
+    DEFAULT_RETRIES,
+    MetadataNotModified,
+    get_max_fetch_duration,
+    get_validators,
+)
+from social_edu_federation.metadata_store import BaseMetadataStore, get_metadata_store
+from social_edu_federation.mirror import MetadataMirror
+from social_edu_federation.parser import PARSING_STATE_VERSION, FederationMetadataParser
+from social_edu_federation.raw_metadata import get_valid_until
+from social_edu_federation.serialization import get_codec
 
+from .cache_entries import CacheEntryMixin
 
-class CacheEntryMixin:
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshWaitTimeout(Exception):
     """
-    Mix-in to turn `BaseMetadataStore` into a cache object to easily
-    manage object storage in cache.
-
-    This:
-     - adds a namespace to the cached keys,
-     - defines a cache duration of one day,
-       we add a minute to ensure the refreshing management command
-       can pass again.
-     -  uses the default defined cache (you may use a Redis cache in production).
+    Raised when the cache entries are still being refreshed by another process
+    for longer than its fetch may last (see `CachedMetadataStore.refresh_wait_timeout`),
+    and there is no
+    current cache entries to serve meanwhile.
     """
 
-    namespace = "edu_fed_saml"
-    duration = datetime.timedelta(hours=24, minutes=1).total_seconds()
-    cache = default_cache  # Django default cache
 
-    def _namespaced_key(self, key):
-        """Returns a key for the cache entry."""
-        return f"edu_federation:{self.namespace}:{key}"
+class AsyncCachedMetadataStoreMixin:
+    """
+    Mix-in adding the asynchronous counterparts of the `CachedMetadataStore`
+    methods, for ASGI deployments.
 
-    def set_many(self, **kwargs):
-        """
-        Class method to update keys in cache by batch.
+    They share the steps of the synchronous methods (see `_arun_steps`): the cache
+    entries are read with Django's asynchronous cache API, the other blocking calls
+    run in the store executor, with the store of the executor thread (Django caches
+    must not be shared between threads), and the concurrent misses of the process
+    wait for the same refresh without holding a thread.
+    """
 
-        Note: `RenaterCache` does not provide other "many keys" manipulation.
-        This is on purpose, as we don't need this complexity here.
-        """
-        self.cache.set_many(
-            dict((self._namespaced_key(key), value) for key, value in kwargs.items()),
-            self.duration,
-        )
+    def _get_thread_store(self):
+        """Returns the store of the current thread, see `get_metadata_store`."""
+        return get_metadata_store(self.backend, type(self))
+
+    def _call_thread_store(self, method_name, *args):
+        """Calls the method of the store of the current thread."""
+        return getattr(self._get_thread_store(), method_name)(*args)
+
+    async def _arun_steps(self, steps):
+        """Asynchronous `_run_steps`, see the class documentation."""
+        result = None
+        while True:
+            try:
+                operation, *args = steps.send(result)
+            except StopIteration as stop:
+                result = stop.value
+                break
+            if operation == "get":
+                result = await self.aget(*args)
+            elif operation == "refresh":
+                result = await self.refreshes.arun(
+                    self.namespace,
+                    self.executor,
+                    self._call_thread_store,
+                    "refresh_cache_entries_or_restore",
+                    *args,
+                )
+            else:
+                result = await self.run_in_executor(self._call_thread_store, *args)
+        return result
 
-    def get(self, entry_id):
-        """Returns the cache entry value."""
-        return self.cache.get(self._namespaced_key(entry_id))
+    async def arefresh_cache_entries(self):
+        """Asynchronous `refresh_cache_entries`, run in the store executor."""
 
-    def set(self, entry_id, value):
-        """Store the cache entry value."""
-        self.cache.set(self._namespaced_key(entry_id), value, self.duration)
+        def refresh():
+            store = self._get_thread_store()
+            return store.refresh_cache_entries(), store.metadata_modified
+
+        all_idp_dict, self.metadata_modified = await self.run_in_executor(refresh)
+        return all_idp_dict
+
+    async def aget_idp(self, idp_name):
+        """
+        Asynchronous `get_idp`: the Identity Provider instances kept in memory are
+        returned without any thread, see the class documentation.
+        """
+        return await self._arun_steps(self._get_idp_steps(idp_name))
 
 
-class CachedMetadataStore(CacheEntryMixin, BaseMetadataStore):
+class CachedMetadataStore(
+    AsyncCachedMetadataStoreMixin, CacheEntryMixin, BaseMetadataStore
+):
     """
     Implementation of a metadata store for authentication backends with cache.
 
     Its purpose is to allow the retrieval of Identity Provider configuration
     from the remote Federation Metadata without parsing data each time.
+
+    Each refresh stores the Identity Providers configurations in a new generation
+    namespace, then points the snapshot entry to it: the readers never mix two
+    refreshes and the previous generations expire on their own.
+    Each configuration is stored once, under the Identity Provider name, the list
+    views use a projection of them, see `get_idp_choices`.
+
+    The Identity Provider instances and the choices list are also kept in memory,
+    for each cache refresh (generation), to spare their loading from the cache and
+    their creation. The snapshot entry may also be kept in memory for a few seconds,
+    see `get_snapshot`: the reads then do not access the cache at all.
+
+    When the cache is empty, only one process refreshes it, see `refresh_cache_entries_once`,
+    and only one thread of this process.
+    To avoid this, the cache is refreshed in the background before its expiration,
+    see `should_refresh_early`.
+
+    When the refresh fails (federation unreachable, invalid metadata...), the last known
+    good metadata is served for a while, see `restore_last_known_good`.
+
+    The metadata is only fetched again when modified (conditional request), otherwise
+    the last known good metadata is served again, see `renew_last_known_good`.
+
+    The last known good metadata and the raw metadata may also be mirrored in a local
+    directory (`FEDERATION_SAML_METADATA_MIRROR_DIR` setting), to recover from a flushed
+    cache without the federation, see `social_edu_federation.mirror`.
+
+    The asynchronous methods (`aget_idp`...) are provided by `AsyncCachedMetadataStoreMixin`.
     """
 
-    parsed_metadata_key = "all_idps"
+    idp_choices_key = "idp_choices"
+    snapshot_key = "snapshot"
+    refresh_lock_key = "refresh_lock"
+    last_known_good_key = "last_known_good"
+    last_known_good_checked_key = "last_known_good_checked"
+    # The last known good metadata is seldom read: always compress it
+    last_known_good_codec = get_codec("zlib")
+    # The lock expires when its owner dies before releasing it (in seconds), it must
+    # exceed the longest refresh (fetch timeouts and retries included, see
+    # `release_refresh_lock`)
+    refresh_lock_timeout = 5 * 60
+    # How long the other processes wait for the refresh (in seconds), defaults to
+    # the longest fetch, see `fetcher.get_max_fetch_duration`
+    refresh_wait_timeout = None
+    refresh_poll_interval = 0.5
+    # The greater, the earlier the cache is refreshed before its expiration
+    early_refresh_beta = 1.0
+    # How long the last known good metadata may be served, at most (in seconds),
+    # never after the metadata `validUntil`
+    max_staleness = datetime.timedelta(days=7).total_seconds()
+    # Delay before trying to refresh the cache again after a failure (in seconds)
+    refresh_retry_delay = 60
+    # Minimum delay between two refreshes caused by unknown IdP names (in seconds)
+    refresh_min_interval = 60
+    # How long the snapshot entry is kept in memory (in seconds), 0 to always read it
+    snapshot_check_interval = 0
+    init_setting_names = (
+        "DJANGO_CACHE",
+        "FEDERATION_SAML_METADATA_CACHE_CODEC",
+        "FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE",
+        "FEDERATION_SAML_METADATA_CACHE_JITTER",
+        "FEDERATION_SAML_METADATA_MAX_STALENESS",
+    )
+
+    # Snapshot entries, by backend namespace, see `get_snapshot`
+    snapshots = MemoryCache(max_entries=100, default_timeout=None)
+    # Identity Provider instances, by backend namespace, IdP name and generation,
+    # shared by the store instances of the process.
+    identity_providers = MemoryCache(max_entries=1000, default_timeout=None)
+    # Identity Provider choices lists, by backend namespace and generation
+    idp_choices_lists = MemoryCache(max_entries=100, default_timeout=None)
+    # Unknown IdP names, by backend namespace, IdP name and generation,
+    # to avoid looking for them again (in the process)
+    unknown_identity_providers = MemoryCache(max_entries=1000, default_timeout=60)
+    # Cache refreshes running in the process, by backend namespace
+    refreshes = SingleFlight()
 
     def __init__(self, backend):
         """Add cache specific configuration."""
@@ -77,25 +201,766 @@ class CachedMetadataStore(CacheEntryMixin, BaseMetadataStore):
                 raise InvalidCacheBackendError(
                     f"'{specified_cache_name}' does not exist in {list(caches)}"
                 ) from exception
+        codec_name = self.backend.setting("FEDERATION_SAML_METADATA_CACHE_CODEC", None)
+        if codec_name:
+            self.codec = get_codec(codec_name)
+        self.chunk_size = self.backend.setting(
+            "FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE", self.chunk_size
+        )
+        self.duration_jitter = self.backend.setting(
+            "FEDERATION_SAML_METADATA_CACHE_JITTER", self.duration_jitter
+        )
+        self.max_staleness = self.backend.setting(
+            "FEDERATION_SAML_METADATA_MAX_STALENESS", self.max_staleness
+        )
+
+    def get_snapshot_check_interval(self):
+        """Returns how long the snapshot entry is kept in memory (in seconds)."""
+        return self.backend.setting(
+            "FEDERATION_SAML_METADATA_CACHE_CHECK_INTERVAL",
+            self.snapshot_check_interval,
+        )
+
+    def get_snapshot(self, check=False):
+        """
+        Returns the snapshot entry, designating the current generation.
+
+        The snapshot entry is read from the cache at most every
+        `get_snapshot_check_interval` seconds by the process (unless `check`):
+        with the Identity Providers instances and choices kept in memory for each
+        generation, the reads do not access the cache meanwhile, the process may
+        only use the previous generation for this interval after a refresh.
+        """
+        return self._run_steps(self._get_snapshot_steps(check))
+
+    def _get_snapshot_steps(self, check):
+        """Steps of `get_snapshot`, see `_run_steps`."""
+        check_interval = self.get_snapshot_check_interval()
+        if not check_interval:
+            return (yield ("get", self.snapshot_key))
+        snapshot = None if check else self.snapshots.get(self.namespace)
+        if snapshot is None:
+            snapshot = yield ("get", self.snapshot_key)
+            if snapshot:
+                self.snapshots.set(self.namespace, snapshot, check_interval)
+        return snapshot
+
+    def _run_steps(self, steps):
+        """
+        Runs the steps of a method shared with its asynchronous counterpart
+        (see `AsyncCachedMetadataStoreMixin`): a generator yielding the blocking
+        operations, sent back their result, and returning the method result.
+
+        The operations are:
+        - `("get", entry_id)`: reads the cache entry, see `get`
+        - `("refresh", previous_snapshot)`: refreshes the cache entries, sharing the
+          concurrent refreshes of the process, see `refresh_cache_entries_or_restore`
+        - `("call", method_name, *args)`: calls the other method of the store
+        """
+        result = None
+        while True:
+            try:
+                operation, *args = steps.send(result)
+            except StopIteration as stop:
+                result = stop.value
+                break
+            if operation == "get":
+                result = self.get(*args)
+            elif operation == "refresh":
+                result = self.refreshes.run(
+                    self.namespace, self.refresh_cache_entries_or_restore, *args
+                )
+            else:
+                method_name, *args = args
+                result = getattr(self, method_name)(*args)
+        return result
+
+    def set_snapshot(self, snapshot, timeout):
+        """Stores the snapshot entry, for `timeout` seconds."""
+        self.set(self.snapshot_key, snapshot, timeout)
+        self.snapshots.delete(self.namespace)
+
+    def get_generation_entry(self, generation, entry_id):
+        """Returns the cache entry value in the `generation` namespace."""
+        return self.get(f"{generation}:{entry_id}")
+
+    @staticmethod
+    def get_idp_choice(idp_name, idp_configuration):
+        """
+        Returns the part of an Identity Provider configuration used to display
+        it in a list: its name and its `edu_fed_data`.
+        """
+        return {
+            "name": idp_name,
+            "edu_fed_data": idp_configuration.get("edu_fed_data", {}),
+        }
+
+    def set_generation_entries(self, generation, all_idp_dict, timeout, entry_ids=None):
+        """
+        Stores the Identity Providers configurations, one by one, and their
+        choices list (see `get_idp_choices`) in the `generation` namespace,
+        for `timeout` seconds, only the `entry_ids` ones when provided.
+        """
+        entries = {
+            self.idp_choices_key: [
+                self.get_idp_choice(idp_name, idp_configuration)
+                for idp_name, idp_configuration in all_idp_dict.items()
+            ],
+            **all_idp_dict,
+        }
+        self.set_many(
+            timeout,
+            **{
+                f"{generation}:{entry_id}": value
+                for entry_id, value in entries.items()
+                if entry_ids is None or entry_id in entry_ids
+            },
+        )
+
+    def set_generation(self, generation, all_idp_dict, timeout, delta):
+        """
+        Stores the `generation` entries (see `set_generation_entries`) then the snapshot
+        designating it, for `timeout` seconds.
+
+        Parameters
+        ----------
+        delta : float
+            How long the refresh took (in seconds), see `should_refresh_early`.
+
+        Returns
+        -------
+        float
+            When the snapshot was computed (timestamp).
+        """
+        self.set_generation_entries(generation, all_idp_dict, timeout)
+        # Set last, for the new generation to be complete when used
+        return self._set_generation_snapshot(generation, timeout, delta)
+
+    def _set_generation_snapshot(self, generation, timeout, delta):
+        """
+        Stores the snapshot designating the `generation`, see `set_generation`,
+        returns when it was computed.
+        """
+        computed_at = time.time()
+        self.set_snapshot(
+            {
+                "generation": generation,
+                "computed_at": computed_at,
+                "delta": delta,
+                "expires_at": computed_at + timeout,
+            },
+            timeout,
+        )
+        return computed_at
+
+    def _get_mirror(self):
+        """
+        Returns the local mirror of the metadata of the backend, when the
+        `FEDERATION_SAML_METADATA_MIRROR_DIR` setting is defined, see `mirror`.
+        """
+        mirror_directory = self.backend.setting(
+            "FEDERATION_SAML_METADATA_MIRROR_DIR", None
+        )
+        if not mirror_directory:
+            return None
+        return MetadataMirror(mirror_directory, self.namespace)
+
+    def get_last_known_good(self):
+        """
+        Returns the last known good metadata, from the cache or from the local mirror
+        (see `_get_mirror`), `None` when missing.
+
+        Its `computed_at` is the last time it was checked as not modified,
+        see `renew_last_known_good`.
+        """
+        last_known_good = self.get(self.last_known_good_key)
+        if last_known_good is None:
+            mirror = self._get_mirror()
+            if mirror is not None:
+                last_known_good = mirror.read_snapshot()
+        if last_known_good is None:
+            return None
+        checked = self.get(self.last_known_good_checked_key)
+        if checked and checked["generation"] == last_known_good["generation"]:
+            last_known_good = {
+                **last_known_good,
+                "computed_at": max(
+                    last_known_good["computed_at"], checked["computed_at"]
+                ),
+            }
+        return last_known_good
+
+    def set_last_known_good(self, last_known_good, xml_metadata=None):
+        """
+        Stores the last known good metadata, without expiration, and mirrors it with
+        the raw `xml_metadata` (when provided) if enabled, see `_get_mirror`.
+        """
+        self._set_entries(
+            {self.last_known_good_key: last_known_good},
+            None,  # Never expires
+            self.last_known_good_codec,
+        )
+        mirror = self._get_mirror()
+        if mirror is None:
+            return
+        try:
+            if xml_metadata is not None:
+                mirror.write_metadata(xml_metadata)
+            mirror.write_snapshot(last_known_good)
+        except OSError:
+            # The cache is up to date anyway
+            logger.exception("Metadata mirror of %s not written", self.namespace)
+
+    def get_idp_choices(self):
+        """
+        Returns the list of the Identity Providers of the current generation, with
+        only what is needed to display them (see `get_idp_choice`), refreshes the cache
+        entries when needed.
+        """
+        snapshot = self.get_snapshot()
+        generation = snapshot["generation"] if snapshot else None
+        idp_choices = self.idp_choices_lists.get((self.namespace, generation))
+        if idp_choices is not None:
+            return idp_choices
+        idp_choices = (
+            self.get_generation_entry(generation, self.idp_choices_key)
+            if generation
+            else None
+        )
+        if idp_choices is None:
+            all_idp_dict = self.refreshes.run(
+                self.namespace, self.refresh_cache_entries_or_restore, snapshot
+            )
+            snapshot = self.get_snapshot(check=True)
+            generation = snapshot["generation"] if snapshot else None
+            if all_idp_dict is None:  # Refreshed by another process
+                idp_choices = self.get_generation_entry(
+                    generation, self.idp_choices_key
+                )
+            else:
+                idp_choices = [
+                    self.get_idp_choice(idp_name, idp_configuration)
+                    for idp_name, idp_configuration in all_idp_dict.items()
+                ]
+        if generation and idp_choices is not None:
+            self.idp_choices_lists.set((self.namespace, generation), idp_choices)
+        return idp_choices
 
     def refresh_cache_entries(self):
-        """Refetch the metadata, parse them and store values in cache."""
-        xml_metadata = self.fetch_remote_metadata()
+        """
+        Refetch the metadata, parse them and store values in cache.
+
+        Only the entities which changed since the previous refresh are parsed,
+        see `FederationMetadataParser.incremental_parse_federation_metadata`.
+
+        The snapshot entry records the refresh generation, when it was computed,
+        how long it took and when it expires (see `should_refresh_early`).
+
+        The Identity Providers configurations are also kept as the last known good
+        metadata, without expiration, see `restore_last_known_good`, with the parsing
+        state for the next refresh (they share the configurations once pickled) and
+        the metadata validators: the metadata is only fetched when modified since,
+        see `renew_last_known_good`.
+        """
+        refresh_start = time.monotonic()
+        last_known_good = self.get_last_known_good()
+        validators = None
+        # The configurations of an older parser can't be served again
+        if (
+            last_known_good
+            and last_known_good.get("parsing_version") == PARSING_STATE_VERSION
+        ):
+            validators = last_known_good["validators"]
+        try:
+            xml_metadata = self.fetch_remote_metadata(validators)
+        except MetadataNotModified:
+            return self.renew_last_known_good(last_known_good, refresh_start)
+        self.metadata_modified = True
+
+        (
+            all_idp_dict,
+            parsing_state,
+        ) = FederationMetadataParser.incremental_parse_federation_metadata(
+            xml_metadata,
+            previous_state=last_known_good["parsing_state"]
+            if last_known_good
+            else None,
+            max_workers=self.backend.setting(
+                "FEDERATION_SAML_METADATA_PARSER_WORKERS", None
+            ),
+        )
+
+        # All the entries expire together, with the snapshot
+        generation = uuid.uuid4().hex
+        computed_at = self.set_generation(
+            generation,
+            all_idp_dict,
+            self.get_duration(),
+            time.monotonic() - refresh_start,
+        )
+        self.set_last_known_good(
+            {
+                "generation": generation,
+                "computed_at": computed_at,
+                "valid_until": get_valid_until(xml_metadata),
+                "validators": get_validators(xml_metadata),
+                "parsing_version": PARSING_STATE_VERSION,
+                "all_idps": all_idp_dict,
+                "parsing_state": parsing_state,
+            },
+            xml_metadata,
+        )
+
+        return all_idp_dict
 
-        all_idp_dict = FederationMetadataParser.parse_federation_metadata(xml_metadata)
+    def renew_last_known_good(self, last_known_good, refresh_start):
+        """
+        Renews the cache entries from the last known good metadata, when the
+        metadata was not modified since: it is neither downloaded nor parsed again.
+
+        The generation is kept, so are the Identity Provider instances: its entries
+        are stored again from the last known good configurations, in a single call.
+        The last known good metadata is neither stored nor mirrored again, only when
+        it was checked, see `get_last_known_good`.
+
+        Parameters
+        ----------
+        refresh_start : float
+            When the refresh started (`time.monotonic`).
+
+        Returns
+        -------
+        dict
+            All the Identity Providers configurations.
+        """
+        logger.info("Metadata of %s not modified since last refresh", self.namespace)
+        self.metadata_modified = False
+        generation = last_known_good["generation"]
+        all_idp_dict = last_known_good["all_idps"]
+        timeout = self.get_duration()
+        # Stored again in a single call, the evicted entries included
+        self.set_generation_entries(generation, all_idp_dict, timeout)
+        computed_at = self._set_generation_snapshot(
+            generation, timeout, time.monotonic() - refresh_start
+        )
+        if not self.cache.touch(self._namespaced_key(self.last_known_good_key), None):
+            # Read from the mirror
+            self._set_entries(
+                {self.last_known_good_key: last_known_good},
+                None,  # Never expires
+                self.last_known_good_codec,
+            )
+        # The metadata is still current, it becomes stale later
+        self._set_entries(
+            {
+                self.last_known_good_checked_key: {
+                    "generation": generation,
+                    "computed_at": computed_at,
+                }
+            },
+            None,  # Never expires
+        )
+        return all_idp_dict
+
+    def restore_last_known_good(self, delta=0):
+        """
+        Restores the cache entries from the last known good metadata, for
+        `refresh_retry_delay` seconds: the requests are served from the cache
+        while the refresh is failing, instead of trying again each time.
+
+        The last known good metadata is not used after `max_staleness` seconds
+        nor after its `validUntil` date.
 
-        self.set(self.parsed_metadata_key, all_idp_dict)
-        self.set_many(**all_idp_dict)
+        Parameters
+        ----------
+        delta : float
+            How long the failed refresh took (in seconds), to try again early
+            in the background, see `should_refresh_early`.
 
+        Returns
+        -------
+        dict
+            All the Identity Providers configurations or `None` when there is no usable
+            last known good metadata.
+        """
+        last_known_good = self.get_last_known_good()
+        if not last_known_good:
+            return None
+
+        now = time.time()
+        stale_at = last_known_good["computed_at"] + self.max_staleness
+        if last_known_good["valid_until"] is not None:
+            stale_at = min(stale_at, last_known_good["valid_until"])
+        timeout = min(self.refresh_retry_delay, stale_at - now)
+        if timeout <= 0:
+            logger.error(
+                "Last known good metadata of %s is too old to be used", self.namespace
+            )
+            return None
+
+        all_idp_dict = last_known_good["all_idps"]
+        # Keep the generation to reuse the Identity Provider instances
+        self.set_generation(last_known_good["generation"], all_idp_dict, timeout, delta)
         return all_idp_dict
 
+    def refresh_cache_entries_or_restore(self, previous_snapshot=None):
+        """
+        Refreshes the cache entries (see `refresh_cache_entries_once`) or,
+        when it fails, restores the last known good ones (see `restore_last_known_good`).
+
+        Raises the refresh exception when there is no usable last known good metadata.
+        """
+        refresh_start = time.monotonic()
+        try:
+            return self.refresh_cache_entries_once(previous_snapshot)
+        except Exception:  # pylint: disable=broad-except
+            all_idp_dict = self.restore_last_known_good(
+                delta=time.monotonic() - refresh_start
+            )
+            if all_idp_dict is None:
+                raise
+            logger.exception(
+                "Metadata cache refresh of %s failed, serving last known good metadata",
+                self.namespace,
+            )
+            return all_idp_dict
+
+    def acquire_refresh_lock(self):
+        """Returns the lock token when the refresh lock is acquired, `None` otherwise."""
+        lock_token = uuid.uuid4().hex
+        if self.cache.add(
+            self._namespaced_key(self.refresh_lock_key),
+            lock_token,
+            self.refresh_lock_timeout,
+        ):
+            return lock_token
+        return None
+
+    def release_refresh_lock(self, lock_token):
+        """
+        Releases the refresh lock, if still owned (it may have expired).
+
+        Django caches have no atomic "delete if equal": when the lock expires between
+        the check and the deletion, and is acquired meanwhile by another process, the
+        lock of this process is deleted. The lock must not expire before its release,
+        `refresh_lock_timeout` exceeds the longest refresh.
+        """
+        lock_key = self._namespaced_key(self.refresh_lock_key)
+        if self.cache.get(lock_key) == lock_token:
+            self.cache.delete(lock_key)
+
+    def refresh_cache_entries_once(self, previous_snapshot=None):
+        """
+        Refreshes the cache entries, unless another process is already doing it:
+        the refresh is protected by a lock in cache, the other processes wait for
+        the new cache entries (see `_get_refresh_wait_timeout`).
+
+        When the lock owner fails (the lock is released without new cache entries),
+        a waiting process refreshes the cache entries, holding the lock.
+        When the lock owner is too long, the waiting processes serve the current
+        cache entries if any, without refreshing them.
+
+        The refresh is done when the snapshot entry was computed since `previous_snapshot`
+        (including when the metadata was not modified, the generation being kept).
+
+        Parameters
+        ----------
+        previous_snapshot : dict, optional
+            The snapshot entry in cache before the refresh was needed, see `get_snapshot`.
+
+        Returns
+        -------
+        dict
+            All the Identity Providers configurations, see `refresh_cache_entries`,
+            or `None` when the cache entries were refreshed by another process
+            (or are still being refreshed).
+
+        Raises
+        ------
+        RefreshWaitTimeout
+            When the refresh of another process is too long and there is no current
+            cache entries, see `refresh_cache_entries_or_restore`.
+        """
+        lock_token = self.acquire_refresh_lock() or self._wait_for_refresh(
+            previous_snapshot
+        )
+        if lock_token is None:
+            return None
+        try:
+            # The lock owner may have released the lock just before
+            if self._is_refreshed_since(previous_snapshot):
+                return None
+            return self.refresh_cache_entries()
+        finally:
+            self.release_refresh_lock(lock_token)
+
+    def _is_refreshed_since(self, previous_snapshot):
+        """
+        Returns whether the snapshot entry in cache was computed since `previous_snapshot`
+        (`None` when there was no snapshot entry).
+        """
+        snapshot = self.get(self.snapshot_key)
+        if snapshot is None:
+            return False
+        return (
+            previous_snapshot is None
+            or snapshot["computed_at"] != previous_snapshot["computed_at"]
+        )
+
+    def _get_refresh_wait_timeout(self):
+        """
+        Returns how long the processes wait for the refresh of another one (in seconds):
+        `refresh_wait_timeout`, defaults to the longest fetch of the metadata (its
+        timeouts and retries, see `get_fetch_kwargs`), for the waiting processes not
+        to give up while the lock owner may still get it, at most `refresh_lock_timeout`.
+        """
+        if self.refresh_wait_timeout is not None:
+            return self.refresh_wait_timeout
+        fetch_kwargs = self.get_fetch_kwargs()
+        return min(
+            get_max_fetch_duration(
+                fetch_kwargs["timeout"], fetch_kwargs.get("retries", DEFAULT_RETRIES)
+            ),
+            self.refresh_lock_timeout,
+        )
+
+    def _wait_for_refresh(self, previous_snapshot):
+        """
+        Waits for the refresh of another process, see `refresh_cache_entries_once`.
+
+        Returns the refresh lock token when acquired after the lock owner failed,
+        `None` when the cache entries were refreshed by another process or when
+        the current ones are served.
+        """
+        deadline = time.monotonic() + self._get_refresh_wait_timeout()
+        while time.monotonic() < deadline:
+            time.sleep(self.refresh_poll_interval)
+            if self._is_refreshed_since(previous_snapshot):
+                return None
+            lock_token = self.acquire_refresh_lock()
+            if lock_token:
+                # Checked again by `refresh_cache_entries_once`, holding the lock
+                return lock_token
+
+        if self.get(self.snapshot_key) is None:
+            raise RefreshWaitTimeout(self.namespace)
+        logger.warning(
+            "Metadata cache refresh of %s too long, serving current entries",
+            self.namespace,
+        )
+        return None
+
+    def should_refresh_early(self, snapshot):
+        """
+        Decides whether the cache must be refreshed before its expiration,
+        with a probability which increases when the expiration approaches
+        ("XFetch" algorithm, see "Optimal Probabilistic Cache Stampede Prevention").
+
+        The longer the refresh took, the earlier it is done again.
+        """
+        return (
+            time.time()
+            - snapshot["delta"]
+            * self.early_refresh_beta
+            * math.log(1.0 - random.random())
+            >= snapshot["expires_at"]
+        )
+
+    def start_early_refresh(self, generation=None):
+        """
+        Refreshes the cache entries in a background thread, unless another process
+        is already doing it.
+
+        Parameters
+        ----------
+        generation : str, optional
+            The generation to refresh, the refresh is skipped when the cache
+            entries were refreshed since (the snapshot was kept in memory).
+
+        Returns
+        -------
+        threading.Thread
+            The started thread or `None` when the cache is already being refreshed.
+        """
+        lock_token = self.acquire_refresh_lock()
+        if lock_token is None:
+            return None
+
+        def early_refresh():
+            # Use a new store, Django caches must not be shared between threads
+            store = self.__class__(self.backend)
+            refresh_start = time.monotonic()
+            try:
+                snapshot = store.get_snapshot(check=True)
+                if generation and snapshot and snapshot["generation"] != generation:
+                    return
+                store.refresh_cache_entries()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception(
+                    "Metadata cache early refresh of %s failed", self.namespace
+                )
+                # Keep serving the last known good metadata without blocking requests
+                snapshot = store.get(store.snapshot_key)
+                if (
+                    not snapshot
+                    or snapshot["expires_at"] - time.time() < store.refresh_retry_delay
+                ):
+                    store.restore_last_known_good(
+                        delta=time.monotonic() - refresh_start
+                    )
+            finally:
+                store.release_refresh_lock(lock_token)
+
+        thread = threading.Thread(target=early_refresh, daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh_idp_configuration_steps(self, idp_name, previous_snapshot):
+        """
+        Refreshes the cache entries (see `refresh_cache_entries_or_restore`)
+        and returns the new generation and the Identity Provider configuration,
+        see `_run_steps`.
+
+        Raises `KeyError` when the Identity Provider is unknown.
+        """
+        all_idp_dict = yield ("refresh", previous_snapshot)
+        snapshot = yield from self._get_snapshot_steps(check=True)
+        generation = snapshot["generation"] if snapshot else None
+        if all_idp_dict is not None:
+            idp_configuration = all_idp_dict.get(idp_name)
+        elif generation:  # Refreshed by another process
+            idp_configuration = yield ("get", f"{generation}:{idp_name}")
+        else:
+            idp_configuration = None
+        if not idp_configuration:
+            if generation:
+                self.unknown_identity_providers.set(
+                    (self.namespace, idp_name, generation), True
+                )
+            raise KeyError(idp_name)
+        return generation, idp_configuration
+
     def get_idp(self, idp_name):
-        """Given the name of an IdP, get an SAMLIdentityProvider instance from federation."""
-        idp_configuration = self.get(idp_name)
+        """
+        Given the name of an IdP, get an SAMLIdentityProvider instance from federation.
+
+        An unknown IdP name only leads to a cache refresh when the cache was not
+        refreshed for `refresh_min_interval` seconds, then it is remembered as
+        unknown until the next refresh. The name of an IdP evicted from the cache
+        is still listed in its choices (see `get_idp_choices`): its configuration
+        is stored again, or the cache is refreshed.
+        """
+        return self._run_steps(self._get_idp_steps(idp_name))
+
+    def _get_idp_steps(self, idp_name):
+        """Steps of `get_idp`, see `_run_steps`."""
+        snapshot = yield from self._get_snapshot_steps(check=False)
+        generation = snapshot["generation"] if snapshot else None
+        if snapshot and self.should_refresh_early(snapshot):
+            yield ("call", "start_early_refresh", generation)
+        identity_provider = self._get_memorized_idp(idp_name, generation)
+        if identity_provider is not None:
+            return identity_provider
+
+        idp_configuration = (
+            (yield ("get", f"{generation}:{idp_name}")) if generation else None
+        )
+        if not idp_configuration and self.get_snapshot_check_interval():
+            # The snapshot kept in memory may be outdated
+            latest_snapshot = yield from self._get_snapshot_steps(check=True)
+            if latest_snapshot and latest_snapshot["generation"] != generation:
+                return (yield from self._get_idp_steps(idp_name))
+        if not idp_configuration and generation:
+            listed = yield from self._is_listed_idp_steps(idp_name, generation)
+            if (
+                listed is False
+                and time.time() - snapshot["computed_at"] < self.refresh_min_interval
+            ):
+                self.unknown_identity_providers.set(
+                    (self.namespace, idp_name, generation), True
+                )
+                raise KeyError(idp_name)
+            if listed:  # Evicted from the cache
+                idp_configuration = yield (
+                    "call",
+                    "_restore_generation_entry",
+                    idp_name,
+                    snapshot,
+                )
         if not idp_configuration:
-            all_configurations = self.refresh_cache_entries()
-            idp_configuration = all_configurations[idp_name]
+            (
+                generation,
+                idp_configuration,
+            ) = yield from self._refresh_idp_configuration_steps(idp_name, snapshot)
+            # The last known good metadata may have been restored
+            identity_provider = self.identity_providers.get(
+                (self.namespace, idp_name, generation)
+            )
+            if identity_provider is not None:
+                return identity_provider
 
-        return self.backend.edu_fed_saml_idp_class.create_from_config_dict(
+        return self._create_identity_provider(idp_name, generation, idp_configuration)
+
+    def _is_listed_idp_steps(self, idp_name, generation):
+        """
+        Returns whether the Identity Provider is listed in the choices of the
+        `generation` (see `get_idp_choices`), `None` when they are missing,
+        see `_run_steps`.
+        """
+        idp_choices = self.idp_choices_lists.get((self.namespace, generation))
+        if idp_choices is None:
+            idp_choices = yield ("get", f"{generation}:{self.idp_choices_key}")
+            if idp_choices is None:
+                return None
+            self.idp_choices_lists.set((self.namespace, generation), idp_choices)
+        return any(idp_choice["name"] == idp_name for idp_choice in idp_choices)
+
+    def _restore_generation_entry(self, idp_name, snapshot):
+        """
+        Stores again the Identity Provider configuration evicted from the cache,
+        from the last known good metadata of the same generation, and returns it
+        (`None` when it can't be restored this way).
+        """
+        last_known_good = self.get_last_known_good()
+        if (
+            not last_known_good
+            or last_known_good["generation"] != snapshot["generation"]
+            or idp_name not in last_known_good["all_idps"]
+        ):
+            return None
+        self.set_generation_entries(
+            snapshot["generation"],
+            last_known_good["all_idps"],
+            max(int(snapshot["expires_at"] - time.time()), 1),
+            {idp_name},
+        )
+        return last_known_good["all_idps"][idp_name]
+
+    def _get_memorized_idp(self, idp_name, generation):
+        """
+        Returns the Identity Provider instance kept in memory for the `generation`,
+        `None` when not kept.
+
+        Raises `KeyError` when the Identity Provider is remembered as unknown.
+        """
+        identity_provider = self.identity_providers.get(
+            (self.namespace, idp_name, generation)
+        )
+        if identity_provider is None and self.unknown_identity_providers.get(
+            (self.namespace, idp_name, generation)
+        ):
+            raise KeyError(idp_name)
+        return identity_provider
+
+    def _create_identity_provider(self, idp_name, generation, idp_configuration):
+        """
+        Returns the Identity Provider instance, kept in memory for the `generation`.
+        """
+        identity_provider = self.backend.edu_fed_saml_idp_class.create_from_config_dict(
             **idp_configuration
         )
+        if generation:
+            self.identity_providers.set(
+                (self.namespace, idp_name, generation), identity_provider
+            )
+        return identity_provider
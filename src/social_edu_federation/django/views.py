@@ -13,6 +13,7 @@ from social_django.utils import load_backend, load_strategy
 from social_django.views import NAMESPACE
 
 from social_edu_federation.django.metadata_store import CachedMetadataStore
+from social_edu_federation.metadata_store import get_metadata_store
 
 
 class InvalidGeneratedMetadataException(Exception):
@@ -79,23 +80,14 @@ class EduFedIdpChoiceView(SocialBackendViewMixin, TemplateView):
 
     def get_idp_list(self):
         """
-        Returns the cached list of identity providers
+        Returns the cached list of identity providers, with only what is needed
+        to display them (see `CachedMetadataStore.get_idp_choice`)
 
         Returns a list like:
         ```
         [
             {
                 'name': 'idp-university-1',
-                'entityId': 'http://idp.domain/adfs/services/trust',
-                'singleSignOnService': {
-                    'url': 'https://idp.domain/adfs/ls/',
-                    'binding': 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect',
-                },
-                'singleLogoutService': {
-                    'url': 'https://idp.domain/adfs/ls/',
-                    'binding': 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect',
-                },
-                'x509cert': 'MIIC4DCCAcigAwIBAgIQG...CQZXu/agfMc/tY+miyrD0=',
                 'edu_fed_data' : {
                     'display_name': 'IdP University 1',
                     'organization_name': 'Organization',
@@ -108,17 +100,9 @@ class EduFedIdpChoiceView(SocialBackendViewMixin, TemplateView):
         """
         strategy = load_strategy(self.request)
         backend = load_backend(strategy, self.backend_name, redirect_uri=None)
-        metadata_store = self.metadata_store_class(backend)
+        metadata_store = get_metadata_store(backend, self.metadata_store_class)
 
-        idp_list = metadata_store.get("SamlFerIdpAPIView.get_idp_choices")
-        if idp_list is None:
-            all_idps = metadata_store.get(metadata_store.parsed_metadata_key)
-            if all_idps is None:
-                all_idps = metadata_store.refresh_cache_entries()
-            idp_list = list(all_idps.values())
-            metadata_store.set("SamlFerIdpAPIView.get_idp_choices", idp_list)
-
-        return idp_list
+        return metadata_store.get_idp_choices()
 
     def get_context_data(self, **kwargs):
         """
@@ -0,0 +1,283 @@
+"""
+Federation metadata fetching module
+
+The federation metadata is large and seldom changes: a fetch may be conditional,
+using the validators (`ETag` and `Last-Modified` response headers) of a previous one,
+to avoid downloading and parsing the metadata again when it was not modified.
+
+The metadata is a highly compressible XML document: its transfer is compressed when
+the server supports it, and it may be parsed while downloaded, see `open_metadata`.
+
+The fetches share pooled HTTP sessions, retrying the transient errors, see `get_session`.
+
+The metadata may also be read from a local file, using a `file://` URL (for instance
+a mirror, see `mirror`), with the same conditional fetches.
+"""
+import contextlib
+import email.utils
+import functools
+import math
+import os
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# The federation metadata shrinks about tenfold once compressed
+ACCEPT_ENCODING = "gzip, deflate"
+# Transient errors are retried, with an exponential backoff (in seconds): the fetch
+# may then last `DEFAULT_RETRIES + 1` times its timeouts, see `get_max_fetch_duration`
+DEFAULT_RETRIES = 1
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class MetadataNotModified(Exception):
+    """Raised by a conditional fetch when the metadata was not modified."""
+
+
+class FetchedMetadata(bytes):
+    """
+    The fetched metadata content, a `bytes` instance which also holds
+    the response validators (`None` when not provided by the server).
+    """
+
+    etag = None
+    last_modified = None
+
+
+def get_validators(xml_metadata) -> dict:
+    """
+    Returns the validators of fetched metadata, to make a conditional fetch later,
+    or `None` when the server did not provide any.
+    """
+    if not isinstance(xml_metadata, FetchedMetadata) or (
+        xml_metadata.etag is None and xml_metadata.last_modified is None
+    ):
+        return None
+    return {"etag": xml_metadata.etag, "last_modified": xml_metadata.last_modified}
+
+
+def get_conditional_headers(validators) -> dict:
+    """Returns the request headers of a conditional fetch, see `get_validators`."""
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def get_session(retries=DEFAULT_RETRIES) -> requests.Session:
+    """
+    Returns the HTTP session shared by the fetches (of all the backends) with the same
+    number of `retries`: its connections are kept alive and reused.
+
+    The connection errors, read errors and `RETRY_STATUSES` responses are retried
+    at most `retries` times, with an exponential backoff (respecting `Retry-After`).
+
+    A local stand-in may be mounted on the session in tests (see `requests.Session.mount`),
+    `reset_sessions` forgets the sessions.
+    """
+    return _get_session(retries)
+
+
+def get_max_fetch_duration(timeout, retries=DEFAULT_RETRIES) -> float:
+    """
+    Returns how long a fetch may last at most (in seconds) when the server does not
+    respond, its retries and their backoff included (`Retry-After` delays excepted).
+
+    Parameters
+    ----------
+    timeout : float or tuple
+        Timeout in seconds to wait for the server, or `(connect, read)` timeouts,
+        `None` for no timeout (the fetch may last forever: `math.inf`).
+
+    retries : int
+        How many times the transient errors are retried, see `get_session`.
+    """
+    if timeout is None:
+        return math.inf
+    connect_timeout, read_timeout = (
+        timeout if isinstance(timeout, (list, tuple)) else (timeout, timeout)
+    )
+    # The first retry is immediate, see `urllib3.util.retry.Retry.get_backoff_time`
+    backoff = sum(
+        RETRY_BACKOFF_FACTOR * 2 ** (retry - 1) for retry in range(2, retries + 1)
+    )
+    return (retries + 1) * (connect_timeout + read_timeout) + backoff
+
+
+def reset_sessions():
+    """Forgets the HTTP sessions (mainly for tests)."""
+    _get_session.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_session(retries):
+    """Creates the HTTP session, see `get_session`."""
+    adapter = HTTPAdapter(
+        max_retries=Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,  # The last response is returned
+        )
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_local_path(url):
+    """Returns the path of a `file://` URL, `None` for the other URLs."""
+    split_url = urlsplit(url)
+    if split_url.scheme != "file":
+        return None
+    return url2pathname(split_url.path)
+
+
+@contextlib.contextmanager
+def _open_local_metadata(path, headers):
+    """
+    Opens a local metadata file, like an HTTP server would serve it (validators
+    and conditional requests), yields the file and its validators.
+    """
+    with open(path, "rb") as metadata_file:
+        file_status = os.fstat(metadata_file.fileno())
+        validators = {
+            "etag": f'"{file_status.st_size:x}-{file_status.st_mtime_ns:x}"',
+            "last_modified": email.utils.formatdate(file_status.st_mtime, usegmt=True),
+        }
+        if headers and headers.get("If-None-Match") == validators["etag"]:
+            raise MetadataNotModified(path)
+        yield metadata_file, validators
+
+
+@contextlib.contextmanager
+def _open_remote_metadata(url, validate_cert, timeout, headers, retries):
+    """Opens the metadata response, yields its stream and its validators."""
+    with get_session(retries).get(
+        url,
+        headers={"Accept-Encoding": ACCEPT_ENCODING, **(headers or {})},
+        timeout=timeout,
+        verify=validate_cert,
+        stream=True,
+    ) as response:
+        if response.status_code == 304:
+            raise MetadataNotModified(url)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield response.raw, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+
+
+@contextlib.contextmanager
+def open_metadata(
+    url, validate_cert=True, timeout=None, headers=None, retries=DEFAULT_RETRIES
+):
+    """
+    Opens the metadata from `url` as a binary stream, decompressed while it is read:
+    it may be parsed while downloaded, without holding the whole content in memory,
+    see `FederationMetadataParser.iterparse_federation_metadata`.
+
+    The parameters and exceptions are the same as `fetch_metadata`.
+    """
+    local_path = get_local_path(url)
+    if local_path:
+        with _open_local_metadata(local_path, headers) as (metadata_file, _):
+            yield metadata_file
+    else:
+        with _open_remote_metadata(url, validate_cert, timeout, headers, retries) as (
+            metadata_stream,
+            _,
+        ):
+            yield metadata_stream
+
+
+def fetch_metadata(
+    url, validate_cert=True, timeout=None, headers=None, retries=DEFAULT_RETRIES
+):
+    """
+    Fetches the metadata from `url`, as a whole (the raw content is needed
+    to parse it incrementally, see `raw_metadata`).
+
+    Parameters
+    ----------
+    url : str
+        The URL of the federation metadata, a `file://` URL for a local file
+        (the other parameters do not apply).
+
+    validate_cert : bool
+        Whether the server certificate is verified.
+
+    timeout : float or tuple, optional
+        Timeout in seconds to wait for the server, or `(connect, read)` timeouts.
+
+    headers : dict, optional
+        Extra request headers, see `get_conditional_headers`.
+
+    retries : int
+        How many times the transient errors are retried, see `get_session`.
+
+    Returns
+    -------
+    FetchedMetadata
+        The metadata content and its validators.
+
+    Raises
+    ------
+    MetadataNotModified
+        When the request is conditional and the metadata was not modified.
+    requests.RequestException
+        When the metadata can't be fetched.
+    OSError
+        When the local metadata file can't be read.
+    """
+    local_path = get_local_path(url)
+    if local_path:
+        with _open_local_metadata(local_path, headers) as (metadata_file, validators):
+            # An empty file is read as empty metadata, rejected by the parser
+            xml_metadata = FetchedMetadata(metadata_file.read())
+    else:
+        with _open_remote_metadata(url, validate_cert, timeout, headers, retries) as (
+            metadata_stream,
+            validators,
+        ):
+            xml_metadata = FetchedMetadata(metadata_stream.read())
+
+    xml_metadata.etag = validators["etag"]
+    xml_metadata.last_modified = validators["last_modified"]
+    return xml_metadata
+
+
+class MetadataFetcherMixin:
+    """
+    Mix-in for python3-saml's metadata parser, to fetch the metadata
+    with its validators, see `fetch_metadata`, or to stream it, see `open_metadata`.
+    """
+
+    @classmethod
+    def open_metadata(cls, url, **kwargs):
+        """Opens the metadata as a binary stream, see `open_metadata`."""
+        return open_metadata(url, **kwargs)
+
+    @classmethod
+    def get_metadata(cls, url, **kwargs):  # pylint: disable=arguments-differ
+        """
+        Fetches the metadata, see `fetch_metadata`.
+
+        Unlike python3-saml, the metadata is not parsed to be validated here:
+        the federation metadata is parsed later anyway.
+        """
+        return fetch_metadata(url, **kwargs)
@@ -6,10 +6,78 @@ identity provider object available for the SAML backend.
 
 The store is a convenient way to add framework "specific" cache to the
 metadata.
+
+The stores are reused by the backends, see `get_metadata_store`.
+
+The stores also provide asynchronous counterparts of their methods (`aget_idp`...),
+for ASGI deployments: the blocking fetch and the CPU-bound parsing of the metadata
+run in an executor.
 """
+import asyncio
+import copy
+import datetime
+import functools
+import threading
+import weakref
+
+from social_core.utils import module_member
+
+from .cache import MemoryCache, SingleFlight
+from .fetcher import get_conditional_headers
 from .parser import FederationMetadataParser
 
 
+# The metadata stores of each thread, see `get_metadata_store`
+_metadata_stores = weakref.WeakKeyDictionary()
+_metadata_stores_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_metadata_store_class(metadata_store_path):
+    """Returns the metadata store class from its path, imported once."""
+    return module_member(metadata_store_path)
+
+
+def get_metadata_store(backend, metadata_store_class):
+    """
+    Returns a metadata store of `metadata_store_class` for the backend.
+
+    The store is created once per thread (the framework caches may not be shared
+    between threads), backend name and value of the settings it reads when created
+    (see `BaseMetadataStore.init_setting_names`).
+
+    A shallow copy of it, bound to the backend (which holds the current request),
+    is returned (the stored one is not bound to any backend): the requests served
+    concurrently by a thread (coroutines, see `BaseMetadataStore.aget_idp`) do not
+    share their backend, only the store caches and settings.
+    """
+    fingerprint = repr(
+        [
+            backend.setting(name, None)
+            for name in metadata_store_class.init_setting_names
+        ]
+    )
+    key = (backend.name, metadata_store_class, fingerprint)
+    with _metadata_stores_lock:
+        thread_stores = _metadata_stores.setdefault(threading.current_thread(), {})
+
+    metadata_store = thread_stores.get(key)
+    if metadata_store is None:
+        metadata_store = thread_stores[key] = metadata_store_class(backend)
+        # Only the copies are bound, the request must not outlive them
+        metadata_store.backend = None
+    bound_metadata_store = copy.copy(metadata_store)
+    bound_metadata_store.backend = backend
+    return bound_metadata_store
+
+
+def reset_metadata_stores():
+    """Forgets the metadata stores and their classes (mainly for tests)."""
+    with _metadata_stores_lock:
+        _metadata_stores.clear()
+    get_metadata_store_class.cache_clear()
+
+
 class BaseMetadataStore:
     """
     Base implementation of a metadata store for authentication backends.
@@ -18,28 +86,120 @@ class BaseMetadataStore:
     from the remote Federation Metadata.
     """
 
+    # The backend settings read when the store is created, the other ones
+    # must be read when used (see `get_metadata_store`)
+    init_setting_names = ()
+    # Whether the last cache refresh of the store found modified metadata,
+    # `None` when unknown (see `fetch_remote_metadata`)
+    metadata_modified = None
+    # Timeout to fetch the metadata (in seconds), or `(connect, read)` timeouts
+    fetch_timeout = 10
+    # The executor of the blocking calls of the asynchronous methods,
+    # `None` for the default executor of the event loop
+    executor = None
+
     def __init__(self, backend):
         """
         Provided a backend, the store has access to all required methods.
 
         The backend must have:
         - `get_federation_metadata_url` method
+        - `setting` method
         - `edu_fed_saml_idp_class` attribute
 
         See `social_edu_federation.backends.base.EduFedSAMLAuth`.
         """
         self.backend = backend
 
-    def fetch_remote_metadata(self) -> bytes:
+    def get_fetch_kwargs(self, validators=None) -> dict:
+        """
+        Returns the keyword arguments of the metadata fetch, see `fetcher.fetch_metadata`:
+        the `FEDERATION_SAML_METADATA_TIMEOUT` and `FEDERATION_SAML_METADATA_FETCH_RETRIES`
+        settings, and the conditional request headers when `validators` are provided.
+        """
+        fetch_kwargs = {
+            "timeout": self.backend.setting(
+                "FEDERATION_SAML_METADATA_TIMEOUT", self.fetch_timeout
+            )
+        }
+        retries = self.backend.setting("FEDERATION_SAML_METADATA_FETCH_RETRIES", None)
+        if retries is not None:
+            fetch_kwargs["retries"] = retries
+        headers = get_conditional_headers(validators)
+        if headers:
+            fetch_kwargs["headers"] = headers
+        return fetch_kwargs
+
+    def fetch_remote_metadata(self, validators=None) -> bytes:
         """
         Fetches the Renater Metadata remotely.
 
         This basic implementation does not provide any cache.
+
+        Parameters
+        ----------
+        validators : dict, optional
+            The validators of a previous fetch (see `fetcher.get_validators`),
+            to only fetch the metadata when modified since.
+
+        Raises
+        ------
+        MetadataNotModified
+            When `validators` are provided and the metadata was not modified.
         """
         return FederationMetadataParser.get_metadata(
             self.backend.get_federation_metadata_url(),
-            timeout=10,
+            **self.get_fetch_kwargs(validators),
+        )
+
+    async def run_in_executor(self, function, *args):
+        """Returns `function(*args)`, run in the store `executor`."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def afetch_remote_metadata(self, validators=None) -> bytes:
+        """
+        Asynchronous `fetch_remote_metadata`: the metadata is fetched in the store
+        executor (with the pooled HTTP sessions, see `fetcher.get_session`).
+        """
+        return await self.run_in_executor(self.fetch_remote_metadata, validators)
+
+    def parse_metadata(self, xml_metadata: bytes) -> dict:
+        """
+        Parses the federation metadata to extract all the Identity Providers.
+
+        When the `FEDERATION_SAML_METADATA_PARSER_WORKERS` setting is greater
+        than 1, the parsing is spread over this number of processes.
+        """
+        parser_workers = self.backend.setting(
+            "FEDERATION_SAML_METADATA_PARSER_WORKERS", None
         )
+        if parser_workers and parser_workers > 1:
+            return FederationMetadataParser.parallel_parse_federation_metadata(
+                xml_metadata,
+                max_workers=parser_workers,
+            )
+        return FederationMetadataParser.parse_federation_metadata(xml_metadata)
+
+    def parse_remote_metadata(self) -> dict:
+        """
+        Fetches the federation metadata and parses it to extract all the Identity
+        Providers, while it is downloaded: the whole metadata is never held in memory,
+        see `FederationMetadataParser.iterparse_federation_metadata`.
+
+        When the parsing is spread over several processes (see `parse_metadata`),
+        the metadata is fetched first.
+        """
+        parser_workers = self.backend.setting(
+            "FEDERATION_SAML_METADATA_PARSER_WORKERS", None
+        )
+        if parser_workers and parser_workers > 1:
+            return self.parse_metadata(self.fetch_remote_metadata())
+        with FederationMetadataParser.open_metadata(
+            self.backend.get_federation_metadata_url(), **self.get_fetch_kwargs()
+        ) as xml_stream:
+            return FederationMetadataParser.iterparse_federation_metadata(xml_stream)
 
     def refresh_cache_entries(self):
         """
@@ -53,12 +213,145 @@ class BaseMetadataStore:
         """
         raise NotImplementedError()
 
+    async def arefresh_cache_entries(self):
+        """
+        Asynchronous `refresh_cache_entries`: the metadata is fetched and parsed
+        in the store executor.
+        """
+        return await self.run_in_executor(self.refresh_cache_entries)
+
+    def _get_idp_from_metadata(self, xml_metadata, idp_name):
+        """Returns the SAMLIdentityProvider instance of `idp_name`, see `get_idp`."""
+        idp_configuration = FederationMetadataParser.lookup_identity_provider(
+            xml_metadata, idp_name
+        )
+        if idp_configuration is None:
+            idp_configuration = self.parse_metadata(xml_metadata)[idp_name]
+        return self.backend.edu_fed_saml_idp_class.create_from_config_dict(
+            **idp_configuration
+        )
+
+    def get_idp(self, idp_name):
+        """
+        Given the name of an IdP, get an SAMLIdentityProvider instance from federation.
+
+        Only the IdP entity descriptor is parsed, when it can be found without
+        parsing the whole metadata, see `FederationMetadataParser.lookup_identity_provider`.
+        """
+        return self._get_idp_from_metadata(self.fetch_remote_metadata(), idp_name)
+
+    async def aget_idp(self, idp_name):
+        """
+        Asynchronous `get_idp`: the metadata is fetched (see `afetch_remote_metadata`),
+        then parsed in the store executor.
+        """
+        xml_metadata = await self.afetch_remote_metadata()
+        return await self.run_in_executor(
+            self._get_idp_from_metadata, xml_metadata, idp_name
+        )
+
+
+class MemoryCachedMetadataStore(BaseMetadataStore):
+    """
+    Implementation of a metadata store for authentication backends with an in-memory cache,
+    for projects without framework cache.
+
+    The cache is shared by all the store instances of a backend in the process,
+    its entries duration and maximum number can be set using the
+    `FEDERATION_SAML_METADATA_CACHE_DURATION` (in seconds) and
+    `FEDERATION_SAML_METADATA_CACHE_MAX_ENTRIES` settings.
+    """
+
+    parsed_metadata_key = "all_idps"
+    duration = datetime.timedelta(hours=24, minutes=1).total_seconds()
+    max_entries = 10000
+    init_setting_names = (
+        "FEDERATION_SAML_METADATA_CACHE_DURATION",
+        "FEDERATION_SAML_METADATA_CACHE_MAX_ENTRIES",
+    )
+
+    # The caches of all the backends, by backend name and cache configuration
+    _caches = {}
+    _caches_lock = threading.Lock()
+    # Cache refreshes running in the process, by backend cache
+    _refreshes = SingleFlight()
+
+    def __init__(self, backend):
+        """Get the backend cache, creates it if needed."""
+        super().__init__(backend)
+        self.cache = self._get_backend_cache()
+
+    def _get_backend_cache(self):
+        """Returns the cache for the backend and its configuration."""
+        duration = self.backend.setting(
+            "FEDERATION_SAML_METADATA_CACHE_DURATION", self.duration
+        )
+        max_entries = self.backend.setting(
+            "FEDERATION_SAML_METADATA_CACHE_MAX_ENTRIES", self.max_entries
+        )
+        cache_key = (self.backend.name, duration, max_entries)
+        with self._caches_lock:
+            if cache_key not in self._caches:
+                self._caches[cache_key] = MemoryCache(
+                    max_entries=max_entries,
+                    default_timeout=duration,
+                )
+            return self._caches[cache_key]
+
+    @classmethod
+    def clear_caches(cls):
+        """Removes the caches of all the backends (mainly for tests)."""
+        with cls._caches_lock:
+            cls._caches.clear()
+
+    def refresh_cache_entries(self):
+        """
+        Refetch the metadata, parse them while downloaded (see `parse_remote_metadata`)
+        and store values in cache.
+        """
+        all_idp_dict = self.parse_remote_metadata()
+
+        self.cache.set_many(all_idp_dict)
+        # Set last, to be evicted last
+        self.cache.set(self.parsed_metadata_key, all_idp_dict)
+
+        return all_idp_dict
+
     def get_idp(self, idp_name):
-        """Given the name of an IdP, get an SAMLIdentityProvider instance from federation."""
-        xml_metadata = self.fetch_remote_metadata()
-        idp_configuration = FederationMetadataParser.parse_federation_metadata(
-            xml_metadata
-        )[idp_name]
+        """
+        Given the name of an IdP, get an SAMLIdentityProvider instance from federation.
+
+        The cache is only refreshed when expired, not for unknown IdP names.
+        """
+        idp_configuration = self.cache.get(idp_name)
+        if not idp_configuration:
+            all_configurations = self.cache.get(self.parsed_metadata_key)
+            if all_configurations is None:
+                # Concurrent misses wait for the same refresh
+                all_configurations = self._refreshes.run(
+                    id(self.cache), self.refresh_cache_entries
+                )
+            idp_configuration = all_configurations[idp_name]
+
+        return self.backend.edu_fed_saml_idp_class.create_from_config_dict(
+            **idp_configuration
+        )
+
+    async def aget_idp(self, idp_name):
+        """
+        Asynchronous `get_idp`: the cache hits are served without any thread,
+        the concurrent misses (threads or coroutines) wait for the same refresh,
+        run in the store executor.
+        """
+        idp_configuration = self.cache.get(idp_name)
+        if not idp_configuration:
+            all_configurations = self.cache.get(self.parsed_metadata_key)
+            if all_configurations is None:
+                all_configurations = await self._refreshes.arun(
+                    id(self.cache), self.executor, self.refresh_cache_entries
+                )
+            idp_configuration = all_configurations[idp_name]
+
         return self.backend.edu_fed_saml_idp_class.create_from_config_dict(
             **idp_configuration
         )
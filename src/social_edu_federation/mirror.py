@@ -0,0 +1,85 @@
+"""
+Local file system mirror of the federation metadata
+
+The raw metadata and the parsed one (the last known good metadata of the cached
+metadata stores) may be mirrored in a local directory: a cold start or a flushed cache
+is then recovered at local disk speed, and the raw metadata can be served to other
+deployments (see the `file://` URLs in `fetcher`).
+
+The files are replaced atomically (written aside, then renamed), the readers never see
+a partially written file.
+"""
+import logging
+import mmap
+import os
+import pickle
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomically(path, content: bytes):
+    """Writes the file `content` in a temporary file, then renames it as `path`."""
+    directory, filename = os.path.split(path)
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        prefix=f".{filename}.", dir=directory
+    )
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary_file:
+            temporary_file.write(content)
+            temporary_file.flush()
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+class MetadataMirror:
+    """
+    Mirror of the metadata of a backend in a local directory, see the module documentation.
+
+    The directory must only be writable by trusted users: the parsed metadata is pickled.
+    """
+
+    def __init__(self, directory, name):
+        """
+        Parameters
+        ----------
+        directory : str
+            The mirror directory, created when missing.
+
+        name : str
+            The name of the mirrored files, the backend name for instance.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.metadata_path = os.path.join(directory, f"{name}.xml")
+        self.snapshot_path = os.path.join(directory, f"{name}.pickle")
+
+    def write_metadata(self, xml_metadata: bytes):
+        """Replaces the raw metadata file."""
+        write_atomically(self.metadata_path, xml_metadata)
+
+    def write_snapshot(self, snapshot):
+        """Replaces the parsed metadata file with the pickled `snapshot`."""
+        write_atomically(
+            self.snapshot_path, pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+        )
+
+    def read_snapshot(self):
+        """
+        Returns the parsed metadata, `None` when missing or unreadable.
+
+        The file is memory-mapped and unpickled from the mapping, without copying it.
+        """
+        try:
+            with open(self.snapshot_path, "rb") as snapshot_file, mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as snapshot_map:
+                return pickle.loads(snapshot_map)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            logger.exception("Unreadable metadata mirror %s", self.snapshot_path)
+            return None
@@ -5,14 +5,29 @@ This module is partially typed to ease the readability, since
 it's not always obvious to know which object is manipulated.
 """
 
-from typing import Dict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import math
+import os
+from typing import Dict, Optional, Tuple
 
+from lxml import etree
 from onelogin.saml2.constants import OneLogin_Saml2_Constants
 from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
 from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
-from onelogin.saml2.xmlparser import tostring
+from onelogin.saml2.xmlparser import check_docinfo, tostring
 from social_core.utils import slugify
 
+from .fetcher import MetadataFetcherMixin
+from .raw_metadata import (
+    FederationMetadataIndex,
+    compare_entity_descriptors,
+    get_header_digest,
+    join_entity_descriptors,
+    split_entity_descriptors,
+)
+from .report import FederationMetadataReport
+
 
 # Enforce some namespace definitions for python3-saml
 # - Add mdui from SAML V2.0 Metadata Extensions for Login and Discovery
@@ -24,7 +39,40 @@ OneLogin_Saml2_Constants.NSMAP["saml2"] = OneLogin_Saml2_Constants.NS_SAML
 OneLogin_Saml2_Constants.NSMAP["saml2p"] = OneLogin_Saml2_Constants.NS_SAMLP
 
 
-class FederationMetadataParser(OneLogin_Saml2_IdPMetadataParser):
+def compile_xpath(query: str) -> etree.XPath:
+    """
+    Compiles once for all an XPath query using python3-saml's namespaces.
+
+    Compiled queries are much faster than string queries (see `OneLogin_Saml2_XML.query`)
+    which are compiled again on each call.
+    """
+    return etree.XPath(query, namespaces=OneLogin_Saml2_Constants.NSMAP)
+
+
+IDP_ENTITY_DESCRIPTORS_XPATH = compile_xpath(
+    "//md:EntityDescriptor[md:IDPSSODescriptor]"
+)
+ENTITY_DESCRIPTORS_XPATH = compile_xpath("//md:EntityDescriptor")
+ENTITY_DESCRIPTOR_COUNT_XPATH = compile_xpath("count(//md:EntityDescriptor)")
+IDP_SSO_DESCRIPTOR_XPATH = compile_xpath("./md:IDPSSODescriptor")
+SINGLE_SIGN_ON_SERVICE_XPATH = compile_xpath(
+    "./md:SingleSignOnService[@Binding=$binding]"
+)
+SINGLE_LOGOUT_SERVICE_XPATH = compile_xpath(
+    "./md:SingleLogoutService[@Binding=$binding]"
+)
+# Bump when the Identity Provider configuration format changes, so the
+# configurations kept from a previous parsing are not reused,
+# see `incremental_parse_federation_metadata`.
+PARSING_STATE_VERSION = 1
+
+CERTIFICATES_XPATH = compile_xpath(
+    "./md:KeyDescriptor[not(contains(@use, $excluded_use))]"
+    "/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
+)
+
+
+class FederationMetadataParser(MetadataFetcherMixin, OneLogin_Saml2_IdPMetadataParser):
     """
     Extension for the python3-saml metadata parser, we keep the same logic
     using class methods.
@@ -36,9 +84,31 @@ class FederationMetadataParser(OneLogin_Saml2_IdPMetadataParser):
     """
 
     idp_name_key = "display_name"
+    # Fewer changed entities are parsed in the current process, without process pool
+    parallel_parsing_min_entities = 200
+
+    # Queries used to build the `edu_fed_data`, see `extract_data_from_entity_descriptor_node`.
+    # They are compiled only once, subclasses may override some of them, for instance:
+    # `edu_fed_data_xpaths = {**FederationMetadataParser.edu_fed_data_xpaths, "logo": ...}`
+    edu_fed_data_xpaths = {
+        "display_name_fr": compile_xpath(
+            "./md:IDPSSODescriptor/md:Extensions/mdui:UIInfo"
+            '/mdui:DisplayName[@xml:lang="fr"]'
+        ),
+        "display_name": compile_xpath(
+            "./md:IDPSSODescriptor/md:Extensions/mdui:UIInfo/mdui:DisplayName"
+        ),
+        "organization_name": compile_xpath("./md:Organization/md:OrganizationName"),
+        "organization_display_name": compile_xpath(
+            "./md:Organization/md:OrganizationDisplayName"
+        ),
+        "logo": compile_xpath(
+            "./md:IDPSSODescriptor/md:Extensions/mdui:UIInfo/mdui:Logo"
+        ),
+    }
 
     @classmethod
-    def get_xml_node_text(cls, dom, query: str, default: str = ""):
+    def get_xml_node_text(cls, dom, query, default: str = ""):
         """
         Extracts the text part of the first node from the `dom` that
         matches the `query`.
@@ -48,17 +118,132 @@ class FederationMetadataParser(OneLogin_Saml2_IdPMetadataParser):
         dom : lxml.etree.Element
             The parent node.
 
-        query: str
-            The xpath query to lookup.
+        query: str or lxml.etree.XPath
+            The xpath query to lookup, preferably already compiled.
 
         default: str
             The returned default value.
         """
-        nodes = OneLogin_Saml2_XML.query(dom, query)
+        if isinstance(query, str):
+            nodes = OneLogin_Saml2_XML.query(dom, query)
+        else:
+            nodes = query(dom)
         if nodes:
             return OneLogin_Saml2_XML.element_text(nodes[0])
         return default
 
+    @classmethod
+    def extract_certificates(cls, idp_descriptor) -> dict:
+        """
+        Extracts the certificates of an Identity Provider the same way
+        `OneLogin_Saml2_IdPMetadataParser.parse` does.
+
+        Parameters
+        ----------
+        idp_descriptor : lxml.etree.Element
+            The IdP SSO descriptor node.
+
+        Returns
+        -------
+        dict
+            `{"x509cert": "MII..."}` when only one certificate is used,
+            `{"x509certMulti": {"signing": [...], "encryption": [...]}}` when
+            several certificates are defined or an empty dict if none is found.
+        """
+        certs = {}
+        for cert_use, excluded_use in (
+            ("signing", "encryption"),
+            ("encryption", "signing"),
+        ):
+            cert_nodes = CERTIFICATES_XPATH(idp_descriptor, excluded_use=excluded_use)
+            if cert_nodes:
+                certs[cert_use] = [
+                    "".join(OneLogin_Saml2_XML.element_text(cert_node).split())
+                    for cert_node in cert_nodes
+                ]
+
+        if not certs:
+            return {}
+
+        signing_certs = certs.get("signing", [])
+        encryption_certs = certs.get("encryption", [])
+        if (len(certs) == 1 and len(signing_certs + encryption_certs) == 1) or (
+            len(signing_certs) == 1
+            and len(encryption_certs) == 1
+            and signing_certs[0] == encryption_certs[0]
+        ):
+            return {"x509cert": (signing_certs or encryption_certs)[0]}
+        return {"x509certMulti": certs}
+
+    @classmethod
+    def parse_entity_descriptor_node(
+        cls,
+        entity_descriptor,
+        required_sso_binding=OneLogin_Saml2_Constants.BINDING_HTTP_REDIRECT,
+        required_slo_binding=OneLogin_Saml2_Constants.BINDING_HTTP_REDIRECT,
+    ) -> dict:
+        """
+        Extracts the Identity Provider settings from an already parsed entity descriptor.
+
+        This is the same logic as `OneLogin_Saml2_IdPMetadataParser.parse` but it
+        works directly on the node, hence there is no need to serialize the node
+        to bytes and parse it again. Only the "idp" part of the settings is built,
+        since this is the only one we use.
+
+        Parameters
+        ----------
+        entity_descriptor : lxml.etree.Element
+            The entity descriptor node.
+
+        required_sso_binding: str
+            Parse only the SSO endpoints with this binding.
+
+        required_slo_binding: str
+            Parse only the SLO endpoints with this binding.
+
+        Returns
+        -------
+        dict
+            The settings dict with extracted data, looks like the one
+            returned by `OneLogin_Saml2_IdPMetadataParser.parse`:
+            `{"idp": {"entityId": ..., "singleSignOnService": ..., ...}}`
+            or an empty dict when the entity is not an Identity Provider.
+        """
+        data = {}
+
+        idp_descriptor_nodes = IDP_SSO_DESCRIPTOR_XPATH(entity_descriptor)
+        if not idp_descriptor_nodes:
+            return data
+
+        idp_descriptor_node = idp_descriptor_nodes[0]
+        idp_data = data["idp"] = {}
+
+        idp_entity_id = entity_descriptor.get("entityID", None)
+        if idp_entity_id is not None:
+            idp_data["entityId"] = idp_entity_id
+
+        sso_nodes = SINGLE_SIGN_ON_SERVICE_XPATH(
+            idp_descriptor_node, binding=required_sso_binding
+        )
+        if sso_nodes and sso_nodes[0].get("Location", None) is not None:
+            idp_data["singleSignOnService"] = {
+                "url": sso_nodes[0].get("Location"),
+                "binding": required_sso_binding,
+            }
+
+        slo_nodes = SINGLE_LOGOUT_SERVICE_XPATH(
+            idp_descriptor_node, binding=required_slo_binding
+        )
+        if slo_nodes and slo_nodes[0].get("Location", None) is not None:
+            idp_data["singleLogoutService"] = {
+                "url": slo_nodes[0].get("Location"),
+                "binding": required_slo_binding,
+            }
+
+        idp_data.update(cls.extract_certificates(idp_descriptor_node))
+
+        return data
+
     @classmethod
     def extract_data_from_entity_descriptor_node(
         cls,
@@ -100,34 +285,34 @@ class FederationMetadataParser(OneLogin_Saml2_IdPMetadataParser):
         #   and fallback on Entity ID if none found.
         extra_data = {}
 
+        xpaths = cls.edu_fed_data_xpaths
+
         display_name_fr = cls.get_xml_node_text(
             entity_descriptor,
-            './md:IDPSSODescriptor/md:Extensions/mdui:UIInfo/mdui:DisplayName[@xml:lang="fr"]',
+            xpaths["display_name_fr"],
         )
         default_display_name = cls.get_xml_node_text(
             entity_descriptor,
-            "./md:IDPSSODescriptor/md:Extensions/mdui:UIInfo/mdui:DisplayName",
+            xpaths["display_name"],
         )
         display_name = (
             display_name_fr or default_display_name or entity_description["entityId"]
         )
         # clean multiline name
-        extra_data["display_name"] = "\n".join(
-            x.strip() for x in display_name.splitlines()
-        )
+        extra_data["display_name"] = cls.clean_display_name(display_name)
         # - Fetch organization information
         extra_data["organization_name"] = cls.get_xml_node_text(
             entity_descriptor,
-            "./md:Organization/md:OrganizationName",
+            xpaths["organization_name"],
         )
         extra_data["organization_display_name"] = cls.get_xml_node_text(
             entity_descriptor,
-            "./md:Organization/md:OrganizationDisplayName",
+            xpaths["organization_display_name"],
         )
         extra_data["logo"] = (
             cls.get_xml_node_text(
                 entity_descriptor,
-                "./md:IDPSSODescriptor/md:Extensions/mdui:UIInfo/mdui:Logo",
+                xpaths["logo"],
             )
             .replace("\n", "")
             .replace(" ", "")
@@ -136,25 +321,169 @@ class FederationMetadataParser(OneLogin_Saml2_IdPMetadataParser):
         return extra_data
 
     @classmethod
-    def parse_federation_metadata(cls, xml_content: bytes) -> Dict[str, dict]:
+    def clean_display_name(cls, display_name: str) -> str:
+        """Removes the indentation of a multiline display name."""
+        return "\n".join(x.strip() for x in display_name.splitlines())
+
+    @classmethod
+    def get_identity_provider_name(
+        cls,
+        display_name_fr: str,
+        display_name: str,
+        entity_id: str,
+    ) -> str:
+        """
+        Returns the name of an Identity Provider the same way `parse_identity_provider`
+        does, from its display names already extracted.
+        """
+        return str(
+            slugify(
+                cls.clean_display_name(display_name_fr or display_name or entity_id)
+            )
+        )
+
+    @classmethod
+    def parse_identity_provider(cls, entity_descriptor, reparse_entity=False) -> dict:
+        """
+        Builds the full Identity Provider configuration from its entity descriptor:
+        the python3-saml settings, the `edu_fed_data` extra data and the IdP name.
+
+        Parameters
+        ----------
+        entity_descriptor : lxml.etree.Element
+            The entity descriptor node.
+
+        reparse_entity : bool
+            Whether the entity descriptor must be serialized and parsed again
+            by `OneLogin_Saml2_IdPMetadataParser.parse` (slower).
+
+        Returns
+        -------
+        dict
+            The Identity Provider configuration, see `parse_federation_metadata`.
+        """
+        #
+        # Query common IdP metadata
+        if reparse_entity:
+            # Convert the entity descriptor to string again...
+            # Not optimal, but python3-saml only allow to fetch one entity in the metadata.
+            entity_descriptor_bytes = tostring(
+                entity_descriptor, encoding="utf8", method="xml"
+            )
+            entity_dict = OneLogin_Saml2_IdPMetadataParser.parse(
+                entity_descriptor_bytes
+            )["idp"]
+        else:
+            entity_dict = cls.parse_entity_descriptor_node(entity_descriptor)["idp"]
+        #
+        # Query extra metadata for our own needs
+        extra_data = cls.extract_data_from_entity_descriptor_node(
+            entity_descriptor,
+            entity_dict,
+        )
+        # Add a name to the configuration, will be used to init
+        # `FERSAMLIdentityProvider` or equivalent later
+        entity_dict["name"] = slugify(extra_data["display_name"])
+
+        entity_dict["edu_fed_data"] = extra_data
+
+        return entity_dict
+
+    @classmethod
+    def select_identity_provider_entity_descriptors(
+        cls,
+        metadata,
+        report: FederationMetadataReport,
+    ) -> list:
+        """
+        Returns the entity descriptors with an Identity Provider role,
+        the other ones are counted as skipped in the `report`.
+
+        Parameters
+        ----------
+        metadata : lxml.etree.Element
+            The metadata root node.
+
+        report : FederationMetadataReport
+            The report to update with the entities counts.
+        """
+        idp_entity_descriptors = IDP_ENTITY_DESCRIPTORS_XPATH(metadata)
+        report.identity_provider_count += len(idp_entity_descriptors)
+        report.skipped_entity_count += int(
+            ENTITY_DESCRIPTOR_COUNT_XPATH(metadata)
+        ) - len(idp_entity_descriptors)
+        return idp_entity_descriptors
+
+    @classmethod
+    def parse_entity_descriptors(
+        cls,
+        entity_descriptors,
+        reparse_entities: bool = False,
+    ) -> Dict[str, dict]:
+        """
+        Builds the Identity Provider configurations from a list of entity descriptors.
+
+        When several Identity Providers share the same name, the last one wins.
+
+        Parameters
+        ----------
+        entity_descriptors : list of lxml.etree.Element
+            The entity descriptor nodes, with an IdP role.
+
+        reparse_entities : bool
+            See `parse_identity_provider`'s `reparse_entity`.
+
+        Returns
+        -------
+        dict
+            The same dict as `parse_federation_metadata`.
+        """
+        identity_providers = {}
+        for entity_descriptor in entity_descriptors:
+            entity_dict = cls.parse_identity_provider(
+                entity_descriptor,
+                reparse_entity=reparse_entities,
+            )
+            # Store all the necessary data
+            identity_providers[str(entity_dict["name"])] = entity_dict
+
+        return identity_providers
+
+    @classmethod
+    def parse_federation_metadata(
+        cls,
+        xml_content: bytes,
+        reparse_entities: bool = False,
+        report: Optional[FederationMetadataReport] = None,
+    ) -> Dict[str, dict]:
         """
         Parses the Renater federation metadata to extract all Identity Providers.
-        As Python Social Auth relies on python3-saml we re-use it here.
+        As Python Social Auth relies on python3-saml we re-use its logic here.
 
-        `python3-saml` does not allow to extract all the IdP at once, hence the loop
-        with reconversion from `ElementTree` to bytes to be allowed to re-use
-        `python3-saml` for each IdP parsing.
+        `python3-saml` does not allow to extract all the IdP at once, so by default
+        each entity descriptor is read directly from the already parsed tree (see
+        `parse_entity_descriptor_node`). The former behavior, which converts each
+        `ElementTree` back to bytes to let `python3-saml` parse it again, is still
+        available using `reparse_entities`.
 
         We also need more fields than only the technical ones: we fetch
         the French University name.
 
-        Warning:
+        Warning: entities without Identity Provider role (no `md:IDPSSODescriptor`)
+        are ignored, they are filtered out by the XPath query itself.
 
         Parameters
         ----------
         xml_content : bytes
             The content of the metadata.
 
+        reparse_entities : bool
+            Whether each entity descriptor must be serialized and parsed again
+            by `OneLogin_Saml2_IdPMetadataParser.parse` (slower).
+
+        report : FederationMetadataReport, optional
+            When provided, it is filled with the parsing statistics.
+
         Returns
         -------
         dict
@@ -182,37 +511,490 @@ class FederationMetadataParser(OneLogin_Saml2_IdPMetadataParser):
             }
             ```
         """
-        identity_providers = {}
-
+        report = report or FederationMetadataReport()
         metadata = OneLogin_Saml2_XML.to_etree(xml_content)
 
-        for entity_descriptor in OneLogin_Saml2_XML.query(
-            metadata,
-            "//md:EntityDescriptor",
-        ):
-            # Convert the entity descriptor to string again...
-            # Not optimal, but python3-saml only allow to fetch one entity in the metadata.
-            entity_descriptor_bytes = tostring(
-                entity_descriptor, encoding="utf8", method="xml"
+        identity_providers = cls.parse_entity_descriptors(
+            cls.select_identity_provider_entity_descriptors(metadata, report),
+            reparse_entities=reparse_entities,
+        )
+
+        report.log()
+
+        return identity_providers
+
+    @classmethod
+    def split_entity_descriptors(cls, xml_content: bytes):
+        """
+        Locates the entity descriptors in the raw metadata, without parsing it,
+        see `social_edu_federation.raw_metadata.split_entity_descriptors`.
+        """
+        return split_entity_descriptors(xml_content)
+
+    @classmethod
+    def split_federation_metadata(cls, xml_content: bytes, chunk_count: int) -> list:
+        """
+        Splits the raw metadata in (at most) `chunk_count` smaller federation metadata,
+        keeping the entity descriptors order.
+
+        Raises
+        ------
+        ValueError
+            When the metadata can't be split, see `split_entity_descriptors`.
+        """
+        header, footer, ranges = cls.split_entity_descriptors(xml_content)
+
+        chunk_size = math.ceil(len(ranges) / chunk_count)
+        xml_chunks = []
+        for chunk_start in range(0, len(ranges), chunk_size):
+            chunk_end = chunk_start + chunk_size
+            chunk_ranges = ranges[chunk_start:chunk_end]
+            first_entity_start, last_entity_end = (
+                chunk_ranges[0][0],
+                chunk_ranges[-1][1],
             )
-            #
-            # Query common IdP metadata
-            entity_dict = OneLogin_Saml2_IdPMetadataParser.parse(
-                entity_descriptor_bytes
-            )["idp"]
-            #
-            # Query extra metadata for our own needs
-            extra_data = cls.extract_data_from_entity_descriptor_node(
-                entity_descriptor,
-                entity_dict,
+            xml_chunks.append(
+                header + xml_content[first_entity_start:last_entity_end] + footer
             )
-            # Add a name to the configuration, will be used to init
-            # `FERSAMLIdentityProvider` or equivalent later
-            entity_dict["name"] = slugify(extra_data["display_name"])
+        return xml_chunks
+
+    @classmethod
+    def parallel_parse_federation_metadata(
+        cls,
+        xml_content: bytes,
+        max_workers: Optional[int] = None,
+        report: Optional[FederationMetadataReport] = None,
+    ) -> Dict[str, dict]:
+        """
+        Parses the Renater federation metadata to extract all Identity Providers,
+        using several processes.
 
-            entity_dict["edu_fed_data"] = extra_data
+        The raw metadata is split in chunks of entity descriptors (see
+        `split_federation_metadata`) which are parsed by a `ProcessPoolExecutor`,
+        then the resulting dicts are merged in the document order: when several
+        Identity Providers share the same name, the last one wins, like in
+        `parse_federation_metadata`.
 
-            # Store all the necessary data
+        When the metadata can't be split, this falls back to `parse_federation_metadata`.
+
+        Parameters
+        ----------
+        xml_content : bytes
+            The content of the metadata.
+
+        max_workers : int, optional
+            The number of processes, defaults to the number of processors.
+
+        report : FederationMetadataReport, optional
+            When provided, it is filled with the parsing statistics.
+
+        Returns
+        -------
+        dict
+            The same dict as `parse_federation_metadata`.
+        """
+        report = report or FederationMetadataReport()
+        max_workers = max_workers or os.cpu_count() or 1
+        try:
+            # Several chunks per process to balance the load between them
+            xml_chunks = cls.split_federation_metadata(xml_content, max_workers * 4)
+        except ValueError:
+            return cls.parse_federation_metadata(xml_content, report=report)
+
+        try:
+            entity_dicts = cls.parse_federation_metadata_chunks(xml_chunks, max_workers)
+        except ValueError:
+            # A chunk can't be parsed on its own (e.g. a namespace declared
+            # in an intermediate element), parse the whole document instead.
+            return cls.parse_federation_metadata(xml_content, report=report)
+
+        identity_providers = {}
+        for entity_dict in entity_dicts:
+            if entity_dict is None:
+                report.skipped_entity_count += 1
+                continue
+            report.identity_provider_count += 1
             identity_providers[str(entity_dict["name"])] = entity_dict
+        report.log()
+        return identity_providers
+
+    @classmethod
+    def parse_federation_metadata_chunks(
+        cls,
+        xml_chunks: list,
+        max_workers: Optional[int] = None,
+    ) -> list:
+        """
+        Parses chunks of the federation metadata, using a `ProcessPoolExecutor`
+        when `max_workers` is greater than 1.
+
+        Parameters
+        ----------
+        xml_chunks : list of bytes
+            The federation metadata chunks, see `split_federation_metadata`.
+
+        max_workers : int, optional
+            The number of processes, the chunks are parsed in the current one
+            when not greater than 1.
+
+        Returns
+        -------
+        list
+            The Identity Provider configuration of each entity descriptor of
+            the chunks, in order, `None` for entities without Identity Provider role.
+
+        Raises
+        ------
+        ValueError
+            When a chunk is not valid XML on its own.
+        """
+        if max_workers and max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                # `map` returns the results in the chunks order
+                chunk_results = list(
+                    executor.map(
+                        _parse_federation_metadata_chunk,
+                        [cls] * len(xml_chunks),
+                        xml_chunks,
+                    )
+                )
+        else:
+            chunk_results = [
+                _parse_federation_metadata_chunk(cls, xml_chunk)
+                for xml_chunk in xml_chunks
+            ]
+        return [
+            entity_dict
+            for chunk_result in chunk_results
+            for entity_dict in chunk_result
+        ]
+
+    @classmethod
+    def get_parsing_state_key(cls, header: bytes) -> str:
+        """
+        Returns the key two parsings must share for the configurations of the first
+        one to be reused by the second one, see `incremental_parse_federation_metadata`.
+        """
+        return (
+            f"{PARSING_STATE_VERSION}:{cls.__module__}.{cls.__qualname__}:"
+            f"{get_header_digest(header)}"
+        )
+
+    @classmethod
+    def incremental_parse_federation_metadata(
+        cls,
+        xml_content: bytes,
+        previous_state: Optional[dict] = None,
+        max_workers: Optional[int] = None,
+        report: Optional[FederationMetadataReport] = None,
+    ) -> Tuple[Dict[str, dict], Optional[dict]]:
+        """
+        Parses the Renater federation metadata to extract all Identity Providers,
+        reusing the result of a previous parsing for the unchanged entities.
+
+        Each entity descriptor is located with a bytes scan (see
+        `split_entity_descriptors`) and identified by a digest of its raw bytes:
+        only the entities which are new or whose digest changed since the previous
+        parsing are actually parsed. The returned state must be provided to the
+        next parsing, it holds the digest and the configuration of each entity.
+
+        When the metadata can't be split, or when the root element namespaces changed,
+        all entities are parsed (the former with `parse_federation_metadata`).
+
+        Parameters
+        ----------
+        xml_content : bytes
+            The content of the metadata.
+
+        previous_state : dict, optional
+            The state returned by the previous parsing.
+
+        max_workers : int, optional
+            The number of processes used to parse the changed entities when there
+            are `parallel_parsing_min_entities` at least.
+
+        report : FederationMetadataReport, optional
+            When provided, it is filled with the parsing statistics
+            and the number of added, changed and removed entities.
+
+        Returns
+        -------
+        tuple
+            The same dict as `parse_federation_metadata` and the new state,
+            `None` when the metadata can't be parsed incrementally.
+        """
+        # Only forward the caller's report to the fallback parsing
+        fallback_kwargs = {"report": report} if report else {}
+        report = report or FederationMetadataReport()
+        try:
+            header, footer, ranges = cls.split_entity_descriptors(xml_content)
+        except ValueError:
+            return cls.parse_federation_metadata(xml_content, **fallback_kwargs), None
+
+        state_key = cls.get_parsing_state_key(header)
+        previous_entities = {}
+        if previous_state and previous_state.get("key") == state_key:
+            previous_entities = previous_state["entities"]
+
+        entities = compare_entity_descriptors(xml_content, ranges, previous_entities)
+        try:
+            changed_entity_dicts = iter(
+                cls._parse_changed_entity_descriptors(
+                    header,
+                    footer,
+                    [entity_bytes for _, _, status, entity_bytes in entities if status],
+                    max_workers,
+                )
+            )
+        except ValueError:
+            return cls.parse_federation_metadata(xml_content, **fallback_kwargs), None
+
+        identity_providers, state_entities = cls._merge_entity_descriptors(
+            entities, changed_entity_dicts, previous_entities, report
+        )
+        report.removed_entity_count = len(
+            previous_entities.keys() - state_entities.keys()
+        )
+        report.log()
+        report.log_changes()
 
+        return identity_providers, {"key": state_key, "entities": state_entities}
+
+    @classmethod
+    def _merge_entity_descriptors(
+        cls,
+        entities: list,
+        changed_entity_dicts,
+        previous_entities: dict,
+        report: FederationMetadataReport,
+    ) -> tuple:
+        """
+        Builds the Identity Providers dict and the parsing state entities from the
+        compared entity descriptors (see `raw_metadata.compare_entity_descriptors`)
+        and the configurations of the added and changed ones.
+        """
+        identity_providers = {}
+        state_entities = {}
+        for entity_id, digest, status, _entity_bytes in entities:
+            if status == "added":
+                report.added_entity_count += 1
+            elif status == "changed":
+                report.changed_entity_count += 1
+            entity_dict = (
+                next(changed_entity_dicts)
+                if status
+                else previous_entities[entity_id][1]
+            )
+            state_entities[entity_id] = (digest, entity_dict)
+            if entity_dict is None:
+                report.skipped_entity_count += 1
+                continue
+            report.identity_provider_count += 1
+            identity_providers[str(entity_dict["name"])] = entity_dict
+
+        return identity_providers, state_entities
+
+    @classmethod
+    def _parse_changed_entity_descriptors(
+        cls,
+        header: bytes,
+        footer: bytes,
+        entity_descriptors: list,
+        max_workers: Optional[int] = None,
+    ) -> list:
+        """
+        Parses raw entity descriptors wrapped in the federation root element,
+        returns their configurations, see `parse_federation_metadata_chunks`.
+
+        Raises `ValueError` when they can't be parsed on their own.
+        """
+        if not entity_descriptors:
+            return []
+        if len(entity_descriptors) < cls.parallel_parsing_min_entities:
+            max_workers = None  # Not worth starting processes
+
+        xml_chunks = join_entity_descriptors(
+            header,
+            footer,
+            entity_descriptors,
+            max_workers * 4 if max_workers and max_workers > 1 else 1,
+        )
+        entity_dicts = cls.parse_federation_metadata_chunks(xml_chunks, max_workers)
+        if len(entity_dicts) != len(entity_descriptors):
+            raise ValueError("Entity descriptors mismatch")
+        return entity_dicts
+
+    @classmethod
+    def index_federation_metadata(cls, xml_content: bytes) -> FederationMetadataIndex:
+        """
+        Indexes the Identity Providers of the raw metadata by name, without parsing it,
+        see `lookup_identity_provider`.
+
+        Raises
+        ------
+        ValueError
+            When the metadata can't be split, see `split_entity_descriptors`.
+        """
+        return FederationMetadataIndex(xml_content, cls.get_identity_provider_name)
+
+    @classmethod
+    def lookup_identity_provider(
+        cls,
+        xml_content: bytes,
+        idp_name: str,
+        index: Optional[FederationMetadataIndex] = None,
+    ) -> Optional[dict]:
+        """
+        Parses only the entity descriptor of the named Identity Provider.
+
+        The entity descriptor is found using an index built with a bytes scan
+        (see `index_federation_metadata`), whose names are only a guess: the parsed
+        name is checked, the lookup gives up when a later entity may have it too.
+
+        Parameters
+        ----------
+        xml_content : bytes
+            The content of the metadata.
+
+        idp_name : str
+            The Identity Provider name, see `parse_federation_metadata`.
+
+        index : FederationMetadataIndex, optional
+            The index of `xml_content`, built when not provided.
+
+        Returns
+        -------
+        dict or None
+            The Identity Provider configuration, see `parse_federation_metadata`,
+            or `None` when it can't be found this way: the whole metadata must
+            be parsed to get it, if it exists.
+        """
+        try:
+            index = index or cls.index_federation_metadata(xml_content)
+            entity_dicts = _parse_federation_metadata_chunk(
+                cls, index.get_entity_metadata(idp_name)
+            )
+        except (KeyError, ValueError):
+            return None
+
+        if len(entity_dicts) != 1 or not entity_dicts[0]:
+            return None
+        if entity_dicts[0]["name"] != idp_name:
+            return None
+        return entity_dicts[0]
+
+    @classmethod
+    def iterparse_federation_metadata(
+        cls,
+        source,
+        report: Optional[FederationMetadataReport] = None,
+    ) -> Dict[str, dict]:
+        """
+        Parses the Renater federation metadata to extract all Identity Providers,
+        reading the entity descriptors one at a time.
+
+        Unlike `parse_federation_metadata`, the whole document is never kept in
+        memory: each entity descriptor is dropped from the tree once parsed,
+        so the memory footprint does not depend on the federation size.
+        This is the parser to use for large aggregates (eduGAIN-like).
+
+        The same security restrictions as python3-saml's parser apply
+        (no DTD, no entities, no network access).
+        Entities without Identity Provider role are skipped as soon as they are read.
+
+        Parameters
+        ----------
+        source : bytes or file-like object
+            The content of the metadata or a binary stream to read it from.
+
+        report : FederationMetadataReport, optional
+            When provided, it is filled with the parsing statistics.
+
+        Returns
+        -------
+        dict
+            The same dict as `parse_federation_metadata`.
+        """
+        if isinstance(source, bytes):
+            source = BytesIO(source)
+
+        identity_providers = {}
+        report = report or FederationMetadataReport()
+        entity_descriptor_tag = etree.QName(
+            OneLogin_Saml2_Constants.NS_MD, "EntityDescriptor"
+        ).text
+        idp_sso_descriptor_tag = etree.QName(
+            OneLogin_Saml2_Constants.NS_MD, "IDPSSODescriptor"
+        ).text
+
+        docinfo_checked = False
+        for event, element in etree.iterparse(
+            source,
+            events=("start", "end"),
+            tag=(
+                etree.QName(OneLogin_Saml2_Constants.NS_MD, "EntitiesDescriptor").text,
+                entity_descriptor_tag,
+            ),
+            resolve_entities=False,
+            no_network=True,
+            remove_comments=True,
+            remove_pis=True,
+            load_dtd=False,
+            huge_tree=False,
+        ):
+            if not docinfo_checked:
+                # The DTD, if any, is known once the root element starts
+                check_docinfo(element.getroottree(), forbid_dtd=True)
+                docinfo_checked = True
+
+            if event != "end" or element.tag != entity_descriptor_tag:
+                continue
+
+            if element.find(idp_sso_descriptor_tag) is None:
+                report.skipped_entity_count += 1
+            else:
+                report.identity_provider_count += 1
+                entity_dict = cls.parse_identity_provider(element)
+                identity_providers[str(entity_dict["name"])] = entity_dict
+
+            # Free the memory used by the parsed entity and the previous siblings
+            # (entity descriptors, signature, extensions...)
+            element.clear(keep_tail=True)
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+        report.log()
         return identity_providers
+
+
+def _parse_federation_metadata_chunk(parser_class, xml_chunk: bytes) -> list:
+    """
+    Parses a chunk of the federation metadata,
+    see `FederationMetadataParser.parse_federation_metadata_chunks`.
+
+    This must be a module level function to be usable by `ProcessPoolExecutor`.
+
+    Returns
+    -------
+    list
+        The Identity Provider configuration of each entity descriptor of the chunk,
+        in the document order, `None` for entities without Identity Provider role.
+
+    Raises
+    ------
+    ValueError
+        When the chunk is not valid XML on its own.
+    """
+    try:
+        metadata = OneLogin_Saml2_XML.to_etree(xml_chunk)
+    except etree.XMLSyntaxError as exception:
+        # lxml errors can't be pickled to be sent back to the main process
+        raise ValueError(str(exception)) from None
+    return [
+        parser_class.parse_identity_provider(entity_descriptor)
+        if IDP_SSO_DESCRIPTOR_XPATH(entity_descriptor)
+        else None
+        for entity_descriptor in ENTITY_DESCRIPTORS_XPATH(metadata)
+    ]
@@ -0,0 +1,348 @@
+"""
+Tools to handle the raw federation metadata, without parsing it.
+
+The federation metadata is a flat list of entity descriptors in an `EntitiesDescriptor`
+root element: a cheap bytes scan allows to locate each of them, to parse them
+separately or to detect which ones changed between two downloads.
+
+The metadata must be encoded in an ASCII compatible encoding (UTF-8 in practice).
+"""
+import hashlib
+import html
+import math
+import re
+
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+
+# Bytes patterns used to split the raw metadata, see `split_entity_descriptors`
+_START_TAG_ATTRIBUTES = rb"""(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*"""
+XML_DECLARATION_RE = re.compile(rb"\s*<\?xml[^>]*\?>")
+ROOT_START_TAG_RE = re.compile(rb"<(?P<tag>[^\s/>!?]+)" + _START_TAG_ATTRIBUTES + rb">")
+ENTITY_DESCRIPTOR_START_TAG_RE = re.compile(
+    rb"<(?P<prefix>(?:[\w.-]+:)?)EntityDescriptor"
+    + _START_TAG_ATTRIBUTES
+    + rb"(?P<self_closing>/?)>"
+)
+ENTITY_ID_ATTRIBUTE_RE = re.compile(rb"""\sentityID\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+NAMESPACE_DECLARATION_RE = re.compile(
+    rb"""\sxmlns(?::[\w.-]+)?\s*=\s*(?:"[^"]*"|'[^']*')"""
+)
+IDP_SSO_DESCRIPTOR_START_TAG_RE = re.compile(
+    rb"<(?P<prefix>(?:[\w.-]+:)?)IDPSSODescriptor[\s/>]"
+)
+DISPLAY_NAME_RE = re.compile(
+    rb"<(?P<prefix>(?:[\w.-]+:)?)DisplayName(?P<attributes>"
+    + _START_TAG_ATTRIBUTES
+    + rb")>(?P<text>[^<]*)</(?P=prefix)DisplayName\s*>"
+)
+DISPLAY_NAME_START_TAG_RE = re.compile(rb"<(?:[\w.-]+:)?DisplayName[\s/>]")
+# Markup the bytes scan can't read, see `has_unreadable_display_names`
+UNREADABLE_MARKUP_RE = re.compile(rb"<!--|<!\[CDATA\[")
+FRENCH_LANG_ATTRIBUTE_RE = re.compile(rb"""\sxml:lang\s*=\s*(?:"fr"|'fr')""")
+VALID_UNTIL_ATTRIBUTE_RE = re.compile(
+    rb"""\svalidUntil\s*=\s*(?:"([^"]*)"|'([^']*)')"""
+)
+
+
+def split_entity_descriptors(xml_content: bytes):
+    """
+    Locates the entity descriptors in the raw metadata.
+
+    Any entity descriptor can then be parsed on its own, wrapped in the root
+    element (which holds the namespace declarations):
+    `header + xml_content[start:end] + footer`.
+
+    Parameters
+    ----------
+    xml_content : bytes
+        The content of the metadata.
+
+    Returns
+    -------
+    tuple
+        `(header, footer, ranges)` where `header` is the XML declaration and
+        the root start tag, `footer` the root end tag and `ranges` the list of
+        `(start, end)` positions of each entity descriptor.
+
+    Raises
+    ------
+    ValueError
+        When the metadata can't be split (not bytes, not an `EntitiesDescriptor`,
+        DTD found or no entity descriptor found).
+    """
+    if not isinstance(xml_content, bytes):
+        raise ValueError("Federation metadata must be provided as bytes")
+    root_match = ROOT_START_TAG_RE.search(xml_content)
+    prolog_end = root_match.start() if root_match else 0
+    if root_match is None or b"<!DOCTYPE" in xml_content[:prolog_end]:
+        raise ValueError("Invalid federation metadata root")
+    if root_match.group("tag").split(b":")[-1] != b"EntitiesDescriptor":
+        raise ValueError("Federation metadata root is not an EntitiesDescriptor")
+
+    xml_declaration_match = XML_DECLARATION_RE.match(xml_content)
+    header = (
+        xml_declaration_match.group(0) if xml_declaration_match else b""
+    ) + root_match.group(0)
+    footer = b"</" + root_match.group("tag") + b">"
+
+    ranges = []
+    position = root_match.end()
+    while True:
+        entity_match = ENTITY_DESCRIPTOR_START_TAG_RE.search(xml_content, position)
+        if entity_match is None:
+            break
+        if entity_match.group("self_closing"):
+            end = entity_match.end()
+        else:
+            end_tag = b"</" + entity_match.group("prefix") + b"EntityDescriptor"
+            end = xml_content.find(end_tag, entity_match.end())
+            if end < 0:
+                raise ValueError("Unclosed EntityDescriptor")
+            end = xml_content.index(b">", end) + 1
+        ranges.append((entity_match.start(), end))
+        position = end
+
+    if not ranges:
+        raise ValueError("No EntityDescriptor found")
+
+    return header, footer, ranges
+
+
+def join_entity_descriptors(
+    header: bytes,
+    footer: bytes,
+    entity_descriptors: list,
+    chunk_count: int,
+) -> list:
+    """
+    Wraps raw entity descriptors in (at most) `chunk_count` smaller federation
+    metadata, keeping their order.
+    """
+    chunk_size = math.ceil(len(entity_descriptors) / chunk_count)
+    xml_chunks = []
+    for chunk_start in range(0, len(entity_descriptors), chunk_size):
+        chunk_end = chunk_start + chunk_size
+        xml_chunks.append(
+            header + b"".join(entity_descriptors[chunk_start:chunk_end]) + footer
+        )
+    return xml_chunks
+
+
+def compare_entity_descriptors(
+    xml_content: bytes,
+    ranges: list,
+    previous_entities: dict,
+) -> list:
+    """
+    Compares each raw entity descriptor with the ones of a previous download.
+
+    Parameters
+    ----------
+    xml_content : bytes
+        The content of the metadata.
+
+    ranges : list
+        The entity descriptors positions, see `split_entity_descriptors`.
+
+    previous_entities : dict
+        The previous entities, `{entity_id: (digest, ...)}`.
+
+    Returns
+    -------
+    list
+        An `(entity_id, digest, status, entity_bytes)` tuple per entity
+        descriptor, where `status` is `"added"`, `"changed"` or an empty
+        string when the entity is unchanged.
+    """
+    entities = []
+    for start, end in ranges:
+        entity_bytes = xml_content[start:end]
+        digest = get_digest(entity_bytes)
+        entity_id = get_entity_id(entity_bytes) or digest
+        if entity_id not in previous_entities:
+            status = "added"
+        elif previous_entities[entity_id][0] != digest:
+            status = "changed"
+        else:
+            status = ""
+        entities.append((entity_id, digest, status, entity_bytes))
+    return entities
+
+
+def get_entity_id(entity_descriptor: bytes) -> str:
+    """
+    Returns the `entityID` attribute of a raw entity descriptor, as found by
+    `split_entity_descriptors`, or an empty string when missing.
+    """
+    start_tag_end = ENTITY_DESCRIPTOR_START_TAG_RE.match(entity_descriptor).end()
+    entity_id_match = ENTITY_ID_ATTRIBUTE_RE.search(entity_descriptor, 0, start_tag_end)
+    if entity_id_match is None:
+        return ""
+    return (entity_id_match.group(1) or entity_id_match.group(2)).decode(
+        "utf-8", "replace"
+    )
+
+
+def get_valid_until(xml_content: bytes):
+    """
+    Returns the `validUntil` attribute of the metadata root element,
+    as a timestamp, or `None` when missing or invalid.
+    """
+    if not isinstance(xml_content, bytes):
+        return None
+    root_match = ROOT_START_TAG_RE.search(xml_content)
+    if root_match is None:
+        return None
+    valid_until_match = VALID_UNTIL_ATTRIBUTE_RE.search(root_match.group(0))
+    if valid_until_match is None:
+        return None
+    value = (valid_until_match.group(1) or valid_until_match.group(2)).decode(
+        "ascii", "replace"
+    )
+    try:
+        return OneLogin_Saml2_Utils.parse_SAML_to_time(value.strip())
+    except Exception:  # pylint: disable=broad-except
+        # python3-saml raises a bare `Exception` on invalid dates
+        return None
+
+
+def get_digest(content: bytes) -> str:
+    """Returns the digest used to detect changes in the raw metadata."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_header_digest(header: bytes) -> str:
+    """
+    Returns a digest of what, in the header returned by `split_entity_descriptors`,
+    may change the meaning of the entity descriptors bytes: the XML declaration
+    (encoding) and the namespaces declared on the root element.
+
+    The root element attributes which change on each publication (`ID`,
+    `validUntil`...) are left out.
+    """
+    xml_declaration_match = XML_DECLARATION_RE.match(header)
+    return get_digest(
+        b"\n".join(
+            [
+                xml_declaration_match.group(0).strip()
+                if xml_declaration_match
+                else b"",
+                *sorted(
+                    declaration.strip()
+                    for declaration in NAMESPACE_DECLARATION_RE.findall(header)
+                ),
+            ]
+        )
+    )
+
+
+def get_identity_provider_display_names(entity_descriptor: bytes):
+    """
+    Returns the `mdui:DisplayName` values of the Identity Provider role
+    of a raw entity descriptor, as found by `split_entity_descriptors`.
+
+    This is a best effort guess (comments or CDATA sections are not handled),
+    the parsed entity descriptor remains the reference.
+
+    Returns
+    -------
+    tuple
+        `(display_name_fr, display_name)`, the French display name and the first one,
+        empty strings when not found, or `None` when the entity has no Identity
+        Provider role.
+    """
+    idp_match = IDP_SSO_DESCRIPTOR_START_TAG_RE.search(entity_descriptor)
+    if idp_match is None:
+        return None
+    end = entity_descriptor.find(
+        b"</" + idp_match.group("prefix") + b"IDPSSODescriptor", idp_match.end()
+    )
+    display_name_fr, display_name = "", ""
+    for display_name_match in DISPLAY_NAME_RE.finditer(
+        entity_descriptor, idp_match.start(), end if end > 0 else len(entity_descriptor)
+    ):
+        text = html.unescape(
+            display_name_match.group("text").decode("utf-8", "replace")
+        )
+        display_name = display_name or text
+        if not display_name_fr and FRENCH_LANG_ATTRIBUTE_RE.search(
+            display_name_match.group("attributes")
+        ):
+            display_name_fr = text
+    return display_name_fr, display_name
+
+
+def has_unreadable_display_names(entity_descriptor: bytes) -> bool:
+    """
+    Returns whether the display names of a raw entity descriptor may be misread by
+    `get_identity_provider_display_names`: it contains comments or CDATA sections,
+    or display names with nested markup.
+    """
+    return bool(UNREADABLE_MARKUP_RE.search(entity_descriptor)) or len(
+        DISPLAY_NAME_START_TAG_RE.findall(entity_descriptor)
+    ) != len(DISPLAY_NAME_RE.findall(entity_descriptor))
+
+
+class FederationMetadataIndex:
+    """
+    Index of the Identity Providers of a raw federation metadata, by name.
+
+    The index is built with a bytes scan: the names are guessed from the display
+    names (see `get_identity_provider_display_names`), using `get_name`.
+    It allows to parse a single Identity Provider entity descriptor,
+    see `FederationMetadataParser.lookup_identity_provider`.
+    """
+
+    def __init__(self, xml_content: bytes, get_name):
+        """
+        Scans the raw metadata.
+
+        Parameters
+        ----------
+        xml_content : bytes
+            The content of the metadata.
+
+        get_name : callable
+            Returns the Identity Provider name from its display names and entity ID,
+            `get_name(display_name_fr, display_name, entity_id)`.
+
+        Raises
+        ------
+        ValueError
+            When the metadata can't be split, see `split_entity_descriptors`.
+        """
+        self.xml_content = xml_content
+        self.header, self.footer, ranges = split_entity_descriptors(xml_content)
+        # The last entity wins when several share the same name, like for the parsing
+        self.entities = {}
+        # The last entity whose name can't be guessed, it may share any name
+        self.last_unreadable_start = -1
+        for start, end in ranges:
+            entity_descriptor = xml_content[start:end]
+            if has_unreadable_display_names(entity_descriptor):
+                self.last_unreadable_start = start
+            display_names = get_identity_provider_display_names(entity_descriptor)
+            if display_names is None:
+                continue
+            entity_id = html.unescape(get_entity_id(entity_descriptor))
+            self.entities[get_name(*display_names, entity_id)] = (entity_id, start, end)
+
+    def __contains__(self, name):
+        return name in self.entities
+
+    def get_entity_metadata(self, name) -> bytes:
+        """
+        Returns the entity descriptor of the named Identity Provider,
+        wrapped in the federation root element.
+
+        Raises
+        ------
+        KeyError
+            When no Identity Provider has this name, or when a later entity
+            may have it too (its display names can't be read by the bytes scan).
+        """
+        _entity_id, start, end = self.entities[name]
+        if start < self.last_unreadable_start:
+            raise KeyError(name)
+        return self.header + self.xml_content[start:end] + self.footer
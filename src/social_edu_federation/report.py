@@ -0,0 +1,62 @@
+"""Statistics about the federation metadata parsing."""
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class FederationMetadataReport:
+    """
+    Statistics about a federation metadata parsing.
+
+    Provide an instance to the parsing methods to get these figures back,
+    see `FederationMetadataParser.parse_federation_metadata`.
+    """
+
+    def __init__(self):
+        """All counters start at zero."""
+        # Entities with `md:IDPSSODescriptor`, some may share the same name
+        self.identity_provider_count = 0
+        # Entities without `md:IDPSSODescriptor` (i.e. Service Providers)
+        self.skipped_entity_count = 0
+        # Entities compared to the previous parsing,
+        # see `FederationMetadataParser.incremental_parse_federation_metadata`
+        self.added_entity_count = 0
+        self.changed_entity_count = 0
+        self.removed_entity_count = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} "
+            f"identity_providers={self.identity_provider_count} "
+            f"skipped_entities={self.skipped_entity_count} "
+            f"added_entities={self.added_entity_count} "
+            f"changed_entities={self.changed_entity_count} "
+            f"removed_entities={self.removed_entity_count}>"
+        )
+
+    def update(self, other_report):
+        """Adds the counters of `other_report` to this one."""
+        self.identity_provider_count += other_report.identity_provider_count
+        self.skipped_entity_count += other_report.skipped_entity_count
+        self.added_entity_count += other_report.added_entity_count
+        self.changed_entity_count += other_report.changed_entity_count
+        self.removed_entity_count += other_report.removed_entity_count
+
+    def log(self):
+        """Logs the parsing statistics."""
+        logger.info(
+            "Federation metadata parsed: %s identity providers, "
+            "%s entities without IdP role skipped",
+            self.identity_provider_count,
+            self.skipped_entity_count,
+        )
+
+    def log_changes(self):
+        """Logs the entities changes since the previous parsing."""
+        logger.info(
+            "Federation metadata changes: %s entities added, %s changed, %s removed",
+            self.added_entity_count,
+            self.changed_entity_count,
+            self.removed_entity_count,
+        )
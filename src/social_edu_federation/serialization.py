@@ -0,0 +1,159 @@
+"""
+Cache values serialization module
+
+The cached metadata (all the Identity Providers configurations, with their certificates
+and logos) is large: it may be encoded by a codec before being stored, for instance to
+compress it. The codec used is recorded in the encoded value, for any store to decode it.
+
+Encoded values may also be split in chunks, for caches limiting the size of their items
+(memcached), see `split_value`.
+"""
+import hashlib
+import pickle
+import zlib
+
+
+ENCODED_VALUE_PREFIX = b"social_edu_federation:"
+CHUNKS_MANIFEST_PREFIX = ENCODED_VALUE_PREFIX + b"chunks:"
+
+
+class PickleCodec:
+    """Serializes values with pickle, like most cache backends."""
+
+    name = "pickle"
+
+    def encode(self, value) -> bytes:
+        """Returns the serialized value."""
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        """Returns the value from its serialized form (bytes-like object)."""
+        return pickle.loads(data)
+
+
+class ZlibCodec(PickleCodec):
+    """Serializes values with pickle and compresses them with zlib."""
+
+    name = "zlib"
+
+    def __init__(self, level=6):
+        """
+        Parameters
+        ----------
+        level : int
+            The zlib compression level, from 1 (fastest) to 9 (smallest).
+        """
+        self.level = level
+
+    def encode(self, value) -> bytes:
+        """Returns the serialized and compressed value."""
+        return zlib.compress(super().encode(value), self.level)
+
+    def decode(self, data):
+        """Returns the value from its compressed form."""
+        return super().decode(zlib.decompress(data))
+
+
+CODECS = {codec.name: codec for codec in (PickleCodec(), ZlibCodec())}
+
+
+def register_codec(codec):
+    """
+    Registers a codec, to be used by its name.
+
+    A codec defines a `name` and the `encode(value) -> bytes` and `decode(data)` methods.
+    """
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    """
+    Returns the registered codec named `name`.
+
+    Raises
+    ------
+    ValueError
+        When no codec has this name.
+    """
+    try:
+        return CODECS[name]
+    except KeyError as exception:
+        raise ValueError(
+            f"Unknown codec '{name}', available codecs: {list(CODECS)}"
+        ) from exception
+
+
+def encode_value(value, codec) -> bytes:
+    """Returns `value` encoded with `codec`, prefixed with the codec name."""
+    return (
+        ENCODED_VALUE_PREFIX + codec.name.encode("ascii") + b":" + codec.encode(value)
+    )
+
+
+def decode_value(value):
+    """
+    Returns the decoded value when `value` was encoded by `encode_value`,
+    otherwise `value` itself.
+
+    Raises
+    ------
+    ValueError
+        When the codec used to encode the value is not registered.
+    """
+    if not isinstance(value, bytes) or not value.startswith(ENCODED_VALUE_PREFIX):
+        return value
+    name_start = len(ENCODED_VALUE_PREFIX)
+    name_end = value.index(b":", name_start)
+    payload_start = name_end + 1
+    codec = get_codec(value[name_start:name_end].decode("ascii"))
+    # Avoid copying the (large) payload
+    return codec.decode(memoryview(value)[payload_start:])
+
+
+def _parse_manifest(manifest: bytes):
+    """Returns the `(chunk_count, digest)` recorded in a chunks manifest."""
+    manifest_start = len(CHUNKS_MANIFEST_PREFIX)
+    chunk_count, digest = manifest[manifest_start:].decode("ascii").split(":")
+    return int(chunk_count), digest
+
+
+def split_value(value: bytes, chunk_size: int):
+    """
+    Splits an encoded value in chunks of `chunk_size` bytes at most.
+
+    Returns
+    -------
+    tuple
+        `(manifest, chunks)` where `manifest` records the chunk count and the value
+        digest, to be stored instead of the value, see `join_chunks`.
+    """
+    chunks = []
+    for chunk_start in range(0, len(value), chunk_size):
+        chunk_end = chunk_start + chunk_size
+        chunks.append(value[chunk_start:chunk_end])
+    digest = hashlib.sha256(value).hexdigest()
+    manifest = CHUNKS_MANIFEST_PREFIX + f"{len(chunks)}:{digest}".encode("ascii")
+    return manifest, chunks
+
+
+def get_chunk_count(value):
+    """Returns the chunk count when `value` is a chunks manifest, `None` otherwise."""
+    if not isinstance(value, bytes) or not value.startswith(CHUNKS_MANIFEST_PREFIX):
+        return None
+    chunk_count, _digest = _parse_manifest(value)
+    return chunk_count
+
+
+def join_chunks(manifest: bytes, chunks: list):
+    """
+    Returns the encoded value split by `split_value`, or `None` when a chunk is
+    missing or the value does not match the manifest digest (chunks of different
+    values, for instance).
+    """
+    if any(chunk is None for chunk in chunks):
+        return None
+    value = b"".join(chunks)
+    _chunk_count, digest = _parse_manifest(manifest)
+    if hashlib.sha256(value).hexdigest() != digest:
+        return None
+    return value
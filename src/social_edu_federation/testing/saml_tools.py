@@ -172,6 +172,26 @@ _ENTITY_DESCRIPTOR_TEMPLATE = """\
     </md:ContactPerson>
 </md:EntityDescriptor>"""
 
+_SP_ENTITY_DESCRIPTOR_TEMPLATE = """\
+<md:EntityDescriptor
+    xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    entityID="{entity_id}"
+>
+    <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+        <md:NameIDFormat>urn:oasis:names:tc:SAML:2.0:nameid-format:transient</md:NameIDFormat>
+        <md:AssertionConsumerService
+            Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+            Location="{acs_location}"
+            index="1"
+        />
+    </md:SPSSODescriptor>
+    <md:Organization>
+        <md:OrganizationName xml:lang="fr">SP OrganizationName</md:OrganizationName>
+        <md:OrganizationDisplayName xml:lang="fr">SP OrganizationDName</md:OrganizationDisplayName>
+        <md:OrganizationURL xml:lang="en">https://organization.example.com/</md:OrganizationURL>
+    </md:Organization>
+</md:EntityDescriptor>"""
+
 
 def format_lang_attribute(language_code=None):
     """Formats the language attribute for tags if `language_code` provided."""
@@ -266,6 +286,17 @@ def generate_idp_metadata(**kwargs):
     return _add_x509_key_descriptors(metadata, get_dev_certificate())
 
 
+def generate_sp_metadata(**kwargs):
+    """Generates a Service Provider only Entity Descriptor metadata"""
+    sp_config = {
+        "entity_id": "https://sp.example.com/saml/metadata/",
+        "acs_location": "https://sp.example.com/saml/acs/",
+    }
+    sp_config.update(kwargs)
+
+    return _SP_ENTITY_DESCRIPTOR_TEMPLATE.format(**sp_config)
+
+
 def generate_idp_federation_metadata(entity_descriptor_list=None, **kwargs):
     """Generates a look alike Renater Metadata"""
     entity_descriptor_list = entity_descriptor_list or [generate_idp_metadata()]
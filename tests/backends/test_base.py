@@ -101,3 +101,22 @@ def test_sp_get_idp_fail_class_does_not_exists():
     )
     with pytest.raises(ImportError):
         backend.get_idp("some-idp")
+
+
+def test_sp_get_metadata_store_reused():
+    """Asserts the metadata store is created once for the backend."""
+    strategy = TestStrategy(TestStorage)
+    strategy.set_settings(
+        {
+            "SOCIAL_AUTH_BASE_EDU_FED_BACKEND_FEDERATION_SAML_METADATA_STORE": (
+                "social_edu_federation.metadata_store.MemoryCachedMetadataStore"
+            ),
+        }
+    )
+    metadata_store = EduFedSAMLAuth(strategy).get_metadata_store()
+
+    backend = EduFedSAMLAuth(strategy)
+    other_metadata_store = backend.get_metadata_store()
+    assert other_metadata_store.cache is metadata_store.cache
+    assert other_metadata_store.backend is backend
+    assert metadata_store.backend is not backend
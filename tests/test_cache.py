@@ -0,0 +1,202 @@
+"""Test module for the in-memory cache."""
+import asyncio
+import datetime
+import threading
+import time
+
+import pytest
+
+from social_edu_federation.cache import MemoryCache, SingleFlight
+
+
+def test_memory_cache_get_set():
+    """Asserts the values are stored and retrieved."""
+    cache = MemoryCache()
+
+    assert cache.get("key") is None
+    assert cache.get("key", "default") == "default"
+
+    cache.set("key", "value")
+    cache.set_many({"other_key": "other_value", "last_key": "last_value"})
+
+    assert cache.get("key") == "value"
+    assert cache.get("other_key") == "other_value"
+    assert cache.get("last_key") == "last_value"
+    assert len(cache) == 3
+
+    assert cache.delete("key") is True
+    assert cache.delete("key") is False
+    assert cache.get("key") is None
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_memory_cache_expiration(freezer):
+    """Asserts the entries expire after their timeout."""
+    cache = MemoryCache(default_timeout=60)
+
+    cache.set("default", "value")
+    cache.set("short", "value", 10)
+    cache.set("forever", "value", None)
+    cache.set("immediately", "value", 0)
+
+    assert cache.get("immediately") is None
+
+    freezer.tick(datetime.timedelta(seconds=11))
+    assert cache.get("short") is None
+    assert cache.get("default") == "value"
+
+    freezer.tick(datetime.timedelta(seconds=50))
+    assert cache.get("default") is None
+    assert cache.get("forever") == "value"
+
+
+def test_memory_cache_add(freezer):
+    """Asserts `add` only stores missing or expired entries."""
+    cache = MemoryCache()
+
+    assert cache.add("key", "value", 10) is True
+    assert cache.add("key", "other_value", 10) is False
+    assert cache.get("key") == "value"
+
+    freezer.tick(datetime.timedelta(seconds=11))
+    assert cache.add("key", "other_value", 10) is True
+    assert cache.get("key") == "other_value"
+
+
+def test_memory_cache_least_recently_used_eviction():
+    """Asserts the least recently used entries are evicted first."""
+    cache = MemoryCache(max_entries=3)
+
+    cache.set_many({"first": 1, "second": 2, "third": 3})
+    # Use the first entry, the second one becomes the least recently used
+    assert cache.get("first") == 1
+    cache.set("fourth", 4)
+
+    assert len(cache) == 3
+    assert cache.get("second") is None
+    assert cache.get("first") == 1
+    assert cache.get("third") == 3
+    assert cache.get("fourth") == 4
+
+
+def test_memory_cache_thread_safety():
+    """Asserts the cache may be used from several threads at once."""
+    cache = MemoryCache(max_entries=100)
+    added = []
+    barrier = threading.Barrier(8)
+
+    def use_cache(thread_index):
+        barrier.wait()
+        added.append(cache.add("shared", thread_index))
+        barrier.wait()
+        for index in range(1000):
+            cache.set(f"{thread_index}-{index}", index)
+            cache.get(f"{thread_index}-{index - 1}")
+
+    threads = [threading.Thread(target=use_cache, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) == 100
+    assert added.count(True) == 1
+
+
+def test_single_flight():
+    """Asserts concurrent calls with the same key share the same result."""
+    single_flight = SingleFlight()
+    calls = []
+    results = []
+
+    def compute(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value
+
+    def run(key, value):
+        results.append(single_flight.run(key, compute, value))
+
+    threads = [threading.Thread(target=run, args=("key", index)) for index in range(4)]
+    threads.append(threading.Thread(target=run, args=("other_key", 10)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 2
+    assert sorted(results) == sorted([calls[0]] * 4 + [10])
+
+    # Once done, the function is called again
+    assert single_flight.run("key", compute, 20) == 20
+    assert len(calls) == 3
+
+
+def test_single_flight_exception():
+    """Asserts the exception of the running call is raised to all the callers."""
+    single_flight = SingleFlight()
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError("failed")
+
+    def run():
+        barrier.wait()
+        try:
+            single_flight.run("key", fail)
+        except ValueError as exception:
+            errors.append(exception)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 4
+    assert len(set(map(id, errors))) == 1
+
+    with pytest.raises(ValueError):
+        single_flight.run("key", fail)
+
+
+def test_single_flight_arun():
+    """Asserts concurrent coroutines and threads share the same call."""
+    single_flight = SingleFlight()
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value
+
+    async def run_concurrently():
+        thread_results = []
+        thread = threading.Thread(
+            target=lambda: thread_results.append(
+                single_flight.run("key", compute, "thread")
+            )
+        )
+        results = asyncio.gather(
+            *(single_flight.arun("key", None, compute, index) for index in range(4))
+        )
+        await asyncio.sleep(0.05)  # The first coroutine started the call
+        thread.start()
+        results = await results
+        thread.join()
+        return results + thread_results
+
+    assert asyncio.run(run_concurrently()) == [0] * 5
+    assert calls == [0]
+
+    async def fail():
+        return await single_flight.arun("key", None, int, "not an int")
+
+    with pytest.raises(ValueError):
+        asyncio.run(fail())
+    # Once done, the function is called again
+    assert asyncio.run(single_flight.arun("key", None, compute, 1)) == 1
@@ -0,0 +1,198 @@
+"""Test module for the federation metadata fetching."""
+import gzip
+import math
+
+from httpretty import HTTPretty
+from lxml import etree
+import pytest
+import requests
+
+from social_edu_federation.fetcher import (
+    DEFAULT_RETRIES,
+    FetchedMetadata,
+    MetadataNotModified,
+    fetch_metadata,
+    get_conditional_headers,
+    get_max_fetch_duration,
+    get_session,
+    get_validators,
+    open_metadata,
+    reset_sessions,
+)
+from social_edu_federation.parser import FederationMetadataParser
+from social_edu_federation.testing.saml_tools import generate_idp_federation_metadata
+
+
+METADATA_URL = "https://domain.test/metadata/"
+
+
+@pytest.fixture(name="metadata_server")
+def metadata_server_fixture():
+    """
+    Serves the metadata with validators, and honors the conditional requests
+    (local stand-in for the federation server).
+    """
+
+    def serve_metadata(request, _uri, response_headers):
+        """Returns the metadata unless not modified."""
+        response_headers.update(
+            {"ETag": '"v1"', "Last-Modified": "Wed, 01 Mar 2023 10:00:00 GMT"}
+        )
+        if request.headers.get("If-None-Match") == '"v1"':
+            return 304, response_headers, ""
+        return 200, response_headers, "<metadata/>"
+
+    HTTPretty.enable(allow_net_connect=False)
+    HTTPretty.register_uri(HTTPretty.GET, METADATA_URL, body=serve_metadata)
+    yield
+    HTTPretty.disable()
+    HTTPretty.reset()
+
+
+def test_fetch_metadata(metadata_server):
+    """Asserts the metadata is fetched with its validators."""
+    xml_metadata = FederationMetadataParser.get_metadata(METADATA_URL, timeout=10)
+
+    assert isinstance(xml_metadata, FetchedMetadata)
+    assert xml_metadata == b"<metadata/>"
+    assert get_validators(xml_metadata) == {
+        "etag": '"v1"',
+        "last_modified": "Wed, 01 Mar 2023 10:00:00 GMT",
+    }
+    assert "If-None-Match" not in HTTPretty.last_request.headers
+
+
+def test_fetch_metadata_not_modified(metadata_server):
+    """Asserts a conditional fetch fails when the metadata is not modified."""
+    validators = get_validators(fetch_metadata(METADATA_URL))
+    headers = get_conditional_headers(validators)
+
+    assert headers == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Wed, 01 Mar 2023 10:00:00 GMT",
+    }
+    with pytest.raises(MetadataNotModified):
+        fetch_metadata(METADATA_URL, headers=headers)
+
+    # Modified since
+    assert fetch_metadata(METADATA_URL, headers={"If-None-Match": '"v0"'}) == (
+        b"<metadata/>"
+    )
+
+
+def test_open_metadata_compressed(metadata_server):
+    """Asserts the compressed metadata is parsed while downloaded."""
+    xml_metadata = generate_idp_federation_metadata().encode("utf-8")
+    compressed_response = HTTPretty.Response(
+        body=gzip.compress(xml_metadata),
+        adding_headers={"Content-Encoding": "gzip"},
+    )
+    HTTPretty.register_uri(
+        HTTPretty.GET, METADATA_URL, responses=[compressed_response] * 2
+    )
+
+    with open_metadata(METADATA_URL) as xml_stream:
+        all_idp_dict = FederationMetadataParser.iterparse_federation_metadata(
+            xml_stream
+        )
+
+    assert "gzip" in HTTPretty.last_request.headers["Accept-Encoding"]
+    assert all_idp_dict == FederationMetadataParser.parse_federation_metadata(
+        xml_metadata
+    )
+    assert fetch_metadata(METADATA_URL) == xml_metadata
+
+
+def test_fetch_metadata_retries(metadata_server):
+    """Asserts the transient errors are retried, at most `retries` times."""
+    HTTPretty.register_uri(
+        HTTPretty.GET,
+        METADATA_URL,
+        responses=[
+            HTTPretty.Response(body="", status=503),
+            HTTPretty.Response(body="<metadata/>"),
+        ],
+    )
+
+    assert fetch_metadata(METADATA_URL, retries=1) == b"<metadata/>"
+    assert len(HTTPretty.latest_requests) == 2
+
+
+@pytest.mark.parametrize("retries", [0, 1])
+def test_fetch_metadata_error(metadata_server, retries):
+    """Asserts the HTTP errors are raised once retried."""
+    HTTPretty.register_uri(
+        HTTPretty.GET,
+        METADATA_URL,
+        responses=[HTTPretty.Response(body="", status=500)] * (retries + 1),
+    )
+
+    with pytest.raises(requests.HTTPError):
+        fetch_metadata(METADATA_URL, retries=retries)
+    assert len(HTTPretty.latest_requests) == retries + 1
+
+
+def test_fetch_local_metadata(tmp_path):
+    """Asserts the metadata can be read from a local file, with conditional fetches."""
+    metadata_path = tmp_path / "metadata.xml"
+    xml_metadata = generate_idp_federation_metadata().encode("utf-8")
+    metadata_path.write_bytes(xml_metadata)
+    metadata_url = metadata_path.as_uri()
+
+    fetched_metadata = fetch_metadata(metadata_url)
+    assert fetched_metadata == xml_metadata
+    validators = get_validators(fetched_metadata)
+    assert validators["etag"] and validators["last_modified"]
+
+    with pytest.raises(MetadataNotModified):
+        fetch_metadata(metadata_url, headers=get_conditional_headers(validators))
+
+    with open_metadata(metadata_url) as xml_stream:
+        all_idp_dict = FederationMetadataParser.iterparse_federation_metadata(
+            xml_stream
+        )
+    assert list(all_idp_dict) == ["edu-local-idp"]
+
+    # Modified since
+    metadata_path.write_bytes(xml_metadata.replace(b"Edu local IdP", b"Other IdP"))
+    assert b"Other IdP" in fetch_metadata(
+        metadata_url, headers=get_conditional_headers(validators)
+    )
+
+
+def test_fetch_local_metadata_empty(tmp_path):
+    """Asserts an empty local file is read as empty metadata, rejected by the parser."""
+    metadata_path = tmp_path / "metadata.xml"
+    metadata_path.write_bytes(b"")
+
+    fetched_metadata = fetch_metadata(metadata_path.as_uri())
+    assert fetched_metadata == b""
+
+    with pytest.raises(etree.XMLSyntaxError):
+        FederationMetadataParser.parse_federation_metadata(fetched_metadata)
+
+
+def test_get_max_fetch_duration():
+    """Asserts the longest fetch includes the timeouts and backoff of each retry."""
+    assert get_max_fetch_duration(10) == 40
+    assert get_max_fetch_duration((3, 5), retries=0) == 8
+    assert get_max_fetch_duration((3, 5), retries=3) == 4 * 8 + 1 + 2
+    assert get_max_fetch_duration(None) == math.inf
+
+
+def test_get_session():
+    """Asserts the fetches share the sessions with the same retries."""
+    assert get_session() is get_session(DEFAULT_RETRIES)
+    assert get_session(0) is not get_session()
+    assert get_session(0).get_adapter(METADATA_URL).max_retries.total == 0
+
+    session = get_session()
+    reset_sessions()
+    assert get_session() is not session
+
+
+def test_get_validators_not_provided():
+    """Asserts there are no validators when the server did not provide any."""
+    assert get_validators(FetchedMetadata(b"<metadata/>")) is None
+    assert get_validators(b"<metadata/>") is None
+    assert not get_conditional_headers(None)
@@ -1,6 +1,25 @@
 """Metadata store tests, already tested in full process so this is only unit testing."""
-from social_edu_federation.metadata_store import BaseMetadataStore
+import asyncio
+import datetime
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+from social_edu_federation.metadata_store import (
+    BaseMetadataStore,
+    MemoryCachedMetadataStore,
+    get_metadata_store,
+    reset_metadata_stores,
+)
 from social_edu_federation.parser import FederationMetadataParser
+from social_edu_federation.testing.saml_tools import (
+    format_mdui_display_name,
+    generate_idp_federation_metadata,
+    generate_idp_metadata,
+)
 
 
 class MagicClass:
@@ -21,11 +40,19 @@ class MockedBackend:
     """Fake backend for test purpose only"""
 
     edu_fed_saml_idp_class = MagicClass
+    name = "mocked-backend"
+
+    def __init__(self, **settings):
+        self.settings = settings
 
     def get_federation_metadata_url(self):
         """Boilerplate to return a fixed URL"""
         return "https://domain.test/metadata/"
 
+    def setting(self, name, default_value=None):
+        """Returns the settings provided at init"""
+        return self.settings.get(name, default_value)
+
 
 def test_fetch_remote_metadata(mocker):
     """Tests `fetch_remote_metadata` method."""
@@ -41,6 +68,26 @@ def test_fetch_remote_metadata(mocker):
     )
 
 
+def test_fetch_remote_metadata_settings(mocker):
+    """Asserts the metadata fetch timeouts and retries can be defined in settings."""
+    store = BaseMetadataStore(
+        MockedBackend(
+            FEDERATION_SAML_METADATA_TIMEOUT=(3, 30),
+            FEDERATION_SAML_METADATA_FETCH_RETRIES=5,
+        )
+    )
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+
+    store.fetch_remote_metadata({"etag": '"v1"'})
+
+    get_metadata_mock.assert_called_once_with(
+        "https://domain.test/metadata/",
+        timeout=(3, 30),
+        retries=5,
+        headers={"If-None-Match": '"v1"'},
+    )
+
+
 def test_get_idp(mocker):
     """Tests `get_idp` method."""
     store = BaseMetadataStore(MockedBackend())
@@ -70,3 +117,270 @@ def test_get_idp(mocker):
     assert magic_instance.key1 == "value1"
     assert magic_instance.key2 == "value2"
     assert not hasattr(magic_instance, "key3")
+
+
+def test_aget_idp(mocker):
+    """Tests `aget_idp` method, fetching and parsing the metadata in the executor."""
+    store = BaseMetadataStore(MockedBackend())
+    calling_threads = []
+
+    def get_metadata(*args, **kwargs):  # pylint: disable=unused-argument
+        calling_threads.append(threading.current_thread())
+        return b"been called"
+
+    get_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "get_metadata", side_effect=get_metadata
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+
+    magic_instance = asyncio.run(store.aget_idp("some-idp"))
+
+    assert magic_instance.key1 == "value1"
+    get_metadata_mock.assert_called_once_with(
+        "https://domain.test/metadata/", timeout=10
+    )
+    parse_metadata_mock.assert_called_once_with(b"been called")
+    assert calling_threads != [threading.current_thread()]
+
+
+def test_get_idp_parallel_parsing(mocker):
+    """Tests `get_idp` method when the parsing uses several processes."""
+    store = BaseMetadataStore(MockedBackend(FEDERATION_SAML_METADATA_PARSER_WORKERS=4))
+
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+    get_metadata_mock.return_value = b"been called"
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parallel_parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {
+        "some-idp": {
+            "key1": "value1",
+        },
+    }
+
+    magic_instance = store.get_idp("some-idp")
+
+    parse_metadata_mock.assert_called_once_with(b"been called", max_workers=4)
+    assert magic_instance.key1 == "value1"
+
+
+def test_get_idp_parses_only_requested_idp(mocker):
+    """Tests `get_idp` method only parses the requested IdP entity descriptor."""
+    store = BaseMetadataStore(MockedBackend())
+
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+    get_metadata_mock.return_value = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(
+                entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+                ui_info_display_names=format_mdui_display_name(f"IdP {index}"),
+            )
+            for index in range(3)
+        ]
+    ).encode("utf-8")
+    parse_identity_provider_spy = mocker.spy(
+        FederationMetadataParser, "parse_identity_provider"
+    )
+
+    magic_instance = store.get_idp("idp-1")
+
+    assert parse_identity_provider_spy.call_count == 1
+    assert magic_instance.name == "idp-1"
+    assert magic_instance.entityId == "http://edu-1.example.com/adfs/services/trust"
+
+
+@pytest.fixture(name="memory_caches")
+def memory_caches_fixture():
+    """Empties the in-memory metadata stores caches around the test."""
+    MemoryCachedMetadataStore.clear_caches()
+    yield
+    MemoryCachedMetadataStore.clear_caches()
+
+
+def test_memory_cached_get_idp(freezer, memory_caches, mocker):
+    """Tests `get_idp` method of the in-memory cached store."""
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "open_metadata")
+    xml_stream = get_metadata_mock.return_value.__enter__.return_value
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "iterparse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {
+        "some-idp": {"key1": "value1"},
+        "other-idp": {"key3": "value3"},
+    }
+
+    magic_instance = MemoryCachedMetadataStore(MockedBackend()).get_idp("some-idp")
+
+    assert magic_instance.key1 == "value1"
+    get_metadata_mock.assert_called_once_with(
+        "https://domain.test/metadata/", timeout=10
+    )
+    # The metadata is parsed while downloaded
+    parse_metadata_mock.assert_called_once_with(xml_stream)
+
+    # Another store instance of the same backend uses the same cache
+    magic_instance = MemoryCachedMetadataStore(MockedBackend()).get_idp("other-idp")
+
+    assert magic_instance.key3 == "value3"
+    assert get_metadata_mock.call_count == 1
+    assert parse_metadata_mock.call_count == 1
+
+    # Unknown IdP names do not refresh the cache
+    with pytest.raises(KeyError):
+        MemoryCachedMetadataStore(MockedBackend()).get_idp("unknown-idp")
+    assert parse_metadata_mock.call_count == 1
+
+    # Cache expiration
+    freezer.tick(datetime.timedelta(hours=24, minutes=1, seconds=1))
+    MemoryCachedMetadataStore(MockedBackend()).get_idp("some-idp")
+
+    assert get_metadata_mock.call_count == 2
+    assert parse_metadata_mock.call_count == 2
+
+
+def test_memory_cached_store_settings(memory_caches):
+    """Tests the in-memory cache configuration settings."""
+    store = MemoryCachedMetadataStore(MockedBackend())
+
+    assert store.cache.default_timeout == 86460
+    assert store.cache.max_entries == 10000
+
+    store = MemoryCachedMetadataStore(
+        MockedBackend(
+            FEDERATION_SAML_METADATA_CACHE_DURATION=60,
+            FEDERATION_SAML_METADATA_CACHE_MAX_ENTRIES=10,
+        )
+    )
+
+    assert store.cache.default_timeout == 60
+    assert store.cache.max_entries == 10
+    store.cache.set_many({f"idp-{index}": {} for index in range(20)})
+    assert len(store.cache) == 10
+
+
+def test_memory_cached_get_idp_concurrent_misses(memory_caches, mocker):
+    """Asserts concurrent cache misses only lead to one metadata refresh."""
+
+    def slow_open_metadata(*args, **kwargs):  # pylint: disable=unused-argument
+        time.sleep(0.2)
+        return mocker.MagicMock()
+
+    get_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "open_metadata", side_effect=slow_open_metadata
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "iterparse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    results = []
+
+    def get_idp():
+        store = MemoryCachedMetadataStore(MockedBackend())
+        results.append(store.get_idp("some-idp").key1)
+
+    threads = [threading.Thread(target=get_idp) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["value1"] * 4
+    assert get_metadata_mock.call_count == 1
+    assert parse_metadata_mock.call_count == 1
+
+
+def test_memory_cached_aget_idp_concurrent_misses(memory_caches, mocker):
+    """
+    Asserts concurrent asynchronous cache misses only lead to one metadata refresh,
+    and the cache hits are served from the event loop.
+    """
+
+    def slow_open_metadata(*args, **kwargs):  # pylint: disable=unused-argument
+        time.sleep(0.2)
+        return mocker.MagicMock()
+
+    get_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "open_metadata", side_effect=slow_open_metadata
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "iterparse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    store = MemoryCachedMetadataStore(MockedBackend())
+
+    async def get_idps():
+        identity_providers = await asyncio.gather(
+            *(store.aget_idp("some-idp") for _ in range(10))
+        )
+        return [identity_provider.key1 for identity_provider in identity_providers]
+
+    assert asyncio.run(get_idps()) == ["value1"] * 10
+    assert get_metadata_mock.call_count == 1
+    assert parse_metadata_mock.call_count == 1
+
+    run_in_executor_spy = mocker.spy(asyncio.BaseEventLoop, "run_in_executor")
+    assert asyncio.run(store.aget_idp("some-idp")).key1 == "value1"
+    with pytest.raises(KeyError):
+        asyncio.run(store.aget_idp("unknown-idp"))
+    assert run_in_executor_spy.call_count == 0
+    assert parse_metadata_mock.call_count == 1
+
+
+def test_get_metadata_store_reused(mocker):
+    """Asserts the metadata stores are reused per thread, backend and settings."""
+    reset_metadata_stores()
+    init_spy = mocker.spy(MemoryCachedMetadataStore, "__init__")
+    backend = MockedBackend()
+    store = get_metadata_store(backend, MemoryCachedMetadataStore)
+    assert store.backend is backend
+
+    other_backend = MockedBackend()
+    other_store = get_metadata_store(other_backend, MemoryCachedMetadataStore)
+    assert init_spy.call_count == 1
+    assert other_store.cache is store.cache
+    # Each store is bound to its backend
+    assert other_store.backend is other_backend
+    assert store.backend is backend
+
+    # The settings read when creating the store changed
+    resized_store = get_metadata_store(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_MAX_ENTRIES=10),
+        MemoryCachedMetadataStore,
+    )
+    assert init_spy.call_count == 2
+    assert resized_store.cache.max_entries == 10
+    # Other settings are read when used
+    get_metadata_store(
+        MockedBackend(FEDERATION_SAML_METADATA_PARSER_WORKERS=2),
+        MemoryCachedMetadataStore,
+    )
+    assert init_spy.call_count == 2
+    assert not isinstance(
+        get_metadata_store(backend, BaseMetadataStore), MemoryCachedMetadataStore
+    )
+
+    thread = threading.Thread(
+        target=lambda: get_metadata_store(backend, MemoryCachedMetadataStore)
+    )
+    thread.start()
+    thread.join()
+    assert init_spy.call_count == 3
+
+    reset_metadata_stores()
+    get_metadata_store(backend, MemoryCachedMetadataStore)
+    assert init_spy.call_count == 4
+
+    # The reused store does not keep the backend (and its request) alive
+    reset_metadata_stores()
+    init_spy.reset_mock()
+    request_backend = MockedBackend()
+    backend_reference = weakref.ref(request_backend)
+    get_metadata_store(request_backend, MemoryCachedMetadataStore)
+    assert init_spy.call_count == 1
+    init_spy.reset_mock()
+    del request_backend
+    gc.collect()
+    assert backend_reference() is None
@@ -0,0 +1,39 @@
+"""Test module for the local metadata mirror."""
+import os
+
+from social_edu_federation.fetcher import fetch_metadata
+from social_edu_federation.mirror import MetadataMirror
+
+
+def test_mirror_snapshot(tmp_path):
+    """Asserts the parsed metadata is mirrored and read back."""
+    mirror = MetadataMirror(str(tmp_path / "mirror"), "saml_fer")
+    assert mirror.read_snapshot() is None
+
+    snapshot = {"all_idps": {"some-idp": {"key1": "value1"}}}
+    mirror.write_snapshot(snapshot)
+    assert mirror.read_snapshot() == snapshot
+
+    mirror.write_snapshot({"all_idps": {}})
+    assert mirror.read_snapshot() == {"all_idps": {}}
+    # The temporary files are renamed
+    assert os.listdir(tmp_path / "mirror") == ["saml_fer.pickle"]
+
+
+def test_mirror_snapshot_unreadable(tmp_path):
+    """Asserts an unreadable mirror is ignored."""
+    mirror = MetadataMirror(str(tmp_path), "saml_fer")
+
+    (tmp_path / "saml_fer.pickle").write_bytes(b"")
+    assert mirror.read_snapshot() is None
+
+    (tmp_path / "saml_fer.pickle").write_bytes(b"not pickled")
+    assert mirror.read_snapshot() is None
+
+
+def test_mirror_metadata(tmp_path):
+    """Asserts the raw metadata is mirrored, to be fetched with a `file://` URL."""
+    mirror = MetadataMirror(str(tmp_path), "saml_fer")
+    mirror.write_metadata(b"<metadata/>")
+
+    assert fetch_metadata((tmp_path / "saml_fer.xml").as_uri()) == b"<metadata/>"
@@ -1,11 +1,20 @@
 """Test module for the SAML metadata parser."""
+from concurrent.futures import ProcessPoolExecutor
+
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+from onelogin.saml2.xmlparser import DTDForbidden
 import pytest
 
-from social_edu_federation.parser import FederationMetadataParser
+from social_edu_federation.parser import (
+    FederationMetadataParser,
+    FederationMetadataReport,
+    compile_xpath,
+)
 from social_edu_federation.testing.saml_tools import (
     format_mdui_display_name,
     generate_idp_federation_metadata,
     generate_idp_metadata,
+    generate_sp_metadata,
 )
 
 from .utils import get_resource_filename
@@ -218,3 +227,571 @@ def test_renater_idps_metadata():
             "rMN4tw3LLMDGO89uGyVEHNeR8LNXSQ=="
         ),
     }
+
+
+def test_renater_idps_metadata_reparse_entities():
+    """Asserts the single-pass parsing returns exactly what python3-saml parsing returns."""
+    with open(get_resource_filename("real-world-metadata.xml"), "rb") as metadata_fd:
+        metadata = metadata_fd.read()
+
+    identity_providers = FederationMetadataParser.parse_federation_metadata(metadata)
+
+    assert identity_providers == FederationMetadataParser.parse_federation_metadata(
+        metadata,
+        reparse_entities=True,
+    )
+    # Both certificate formats are present in the real world metadata
+    assert any("x509cert" in idp for idp in identity_providers.values())
+    assert any("x509certMulti" in idp for idp in identity_providers.values())
+
+
+def test_parse_entity_descriptor_node_not_an_idp():
+    """Asserts no IdP settings are returned for an entity without IdP role."""
+    entity_descriptor = OneLogin_Saml2_XML.to_etree(
+        '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+        'entityID="https://sp.example.com/"><md:SPSSODescriptor/></md:EntityDescriptor>'
+    )
+
+    assert not FederationMetadataParser.parse_entity_descriptor_node(entity_descriptor)
+
+
+def test_renater_idps_metadata_iterparse():
+    """Asserts the streaming parsing returns the same result as the tree based one."""
+    with open(get_resource_filename("real-world-metadata.xml"), "rb") as metadata_fd:
+        metadata = metadata_fd.read()
+        metadata_fd.seek(0)
+        streamed_identity_providers = (
+            FederationMetadataParser.iterparse_federation_metadata(metadata_fd)
+        )
+
+    identity_providers = FederationMetadataParser.parse_federation_metadata(metadata)
+    assert len(streamed_identity_providers) == 308
+    assert streamed_identity_providers == identity_providers
+    assert (
+        FederationMetadataParser.iterparse_federation_metadata(metadata)
+        == identity_providers
+    )
+
+
+def test_iterparse_frees_parsed_entities(mocker):
+    """Asserts the streaming parser removes the already parsed entity descriptors."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(
+                entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+                ui_info_display_names=format_mdui_display_name(f"IdP {index}"),
+            )
+            for index in range(5)
+        ]
+    )
+    preceding_siblings = []
+    original_parse_identity_provider = FederationMetadataParser.parse_identity_provider
+
+    def _parse_identity_provider(entity_descriptor, **kwargs):
+        preceding_siblings.append(list(entity_descriptor.itersiblings(preceding=True)))
+        return original_parse_identity_provider(entity_descriptor, **kwargs)
+
+    mocker.patch.object(
+        FederationMetadataParser,
+        "parse_identity_provider",
+        side_effect=_parse_identity_provider,
+    )
+
+    identity_providers = FederationMetadataParser.iterparse_federation_metadata(
+        fed_metadata.encode("utf-8")
+    )
+
+    assert list(identity_providers) == [f"idp-{index}" for index in range(5)]
+    # Only the previous entity descriptor is kept, emptied
+    assert [len(siblings) for siblings in preceding_siblings] == [0, 1, 1, 1, 1]
+    assert all(len(siblings[0]) == 0 for siblings in preceding_siblings[1:])
+
+
+def test_iterparse_forbids_dtd():
+    """Asserts the streaming parser refuses metadata with a DTD, as python3-saml does."""
+    fed_metadata = generate_idp_federation_metadata().replace(
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<!DOCTYPE md:EntitiesDescriptor [<!ENTITY name "Evil">]>',
+    )
+
+    with pytest.raises(DTDForbidden):
+        FederationMetadataParser.iterparse_federation_metadata(
+            fed_metadata.encode("utf-8")
+        )
+
+
+@pytest.mark.parametrize(
+    "parse_method,parse_kwargs",
+    [
+        pytest.param("parse_federation_metadata", {}, id="tree"),
+        pytest.param(
+            "parse_federation_metadata", {"reparse_entities": True}, id="reparse"
+        ),
+        pytest.param("iterparse_federation_metadata", {}, id="iterparse"),
+    ],
+)
+def test_service_providers_are_skipped(parse_method, parse_kwargs, mocker):
+    """Asserts the entities without IdP role are skipped before any parsing."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_sp_metadata(entity_id="https://sp-1.example.com/"),
+            generate_idp_metadata(),
+            generate_sp_metadata(entity_id="https://sp-2.example.com/"),
+        ]
+    ).encode("utf-8")
+    parse_identity_provider_spy = mocker.spy(
+        FederationMetadataParser, "parse_identity_provider"
+    )
+    report = FederationMetadataReport()
+
+    identity_providers = getattr(FederationMetadataParser, parse_method)(
+        fed_metadata, report=report, **parse_kwargs
+    )
+
+    assert list(identity_providers) == ["edu-local-idp"]
+    assert parse_identity_provider_spy.call_count == 1
+    assert report.identity_provider_count == 1
+    assert report.skipped_entity_count == 2
+
+
+def test_edu_fed_data_xpaths_override():
+    """Asserts subclasses may override the queries used to build `edu_fed_data`."""
+
+    class OrganizationURLParser(FederationMetadataParser):
+        """Parser using the organization URL as logo, for test purpose only."""
+
+        edu_fed_data_xpaths = {
+            **FederationMetadataParser.edu_fed_data_xpaths,
+            "logo": compile_xpath("./md:Organization/md:OrganizationURL"),
+        }
+
+    fed_metadata = generate_idp_federation_metadata()
+
+    identity_providers = OrganizationURLParser.parse_federation_metadata(fed_metadata)
+
+    assert identity_providers["edu-local-idp"]["edu_fed_data"] == {
+        "display_name": "Edu local IdP",
+        "organization_display_name": "OrganizationDName",
+        "organization_name": "OrganizationName",
+        "logo": "https://organization.example.com/",
+    }
+
+
+def test_get_xml_node_text_string_query():
+    """Asserts `get_xml_node_text` still accepts non compiled queries."""
+    entity_descriptor = OneLogin_Saml2_XML.to_etree(generate_idp_metadata())
+
+    assert (
+        FederationMetadataParser.get_xml_node_text(
+            entity_descriptor, "./md:Organization/md:OrganizationName"
+        )
+        == "OrganizationName"
+    )
+    assert (
+        FederationMetadataParser.get_xml_node_text(
+            entity_descriptor, "./md:Organization/md:Unknown", default="default"
+        )
+        == "default"
+    )
+
+
+def test_renater_idps_metadata_parallel():
+    """Asserts the parallel parsing returns the same result as the sequential one."""
+    with open(get_resource_filename("real-world-metadata.xml"), "rb") as metadata_fd:
+        metadata = metadata_fd.read()
+
+    identity_providers = FederationMetadataParser.parse_federation_metadata(metadata)
+    report = FederationMetadataReport()
+    parallel_identity_providers = (
+        FederationMetadataParser.parallel_parse_federation_metadata(
+            metadata,
+            max_workers=2,
+            report=report,
+        )
+    )
+
+    assert parallel_identity_providers == identity_providers
+    assert list(parallel_identity_providers) == list(identity_providers)
+    assert report.identity_provider_count == 310
+    assert report.skipped_entity_count == 0
+
+
+def test_parallel_parsing_name_collisions():
+    """Asserts name collisions between chunks are resolved as in the sequential parsing."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(
+                entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+                # Names collide every 3 IdPs
+                ui_info_display_names=format_mdui_display_name(f"IdP {index % 3}"),
+            )
+            for index in range(10)
+        ]
+        + [generate_sp_metadata()]
+    ).encode("utf-8")
+
+    identity_providers = FederationMetadataParser.parallel_parse_federation_metadata(
+        fed_metadata,
+        max_workers=2,
+    )
+
+    assert identity_providers == FederationMetadataParser.parse_federation_metadata(
+        fed_metadata
+    )
+    assert {name: idp["entityId"] for name, idp in identity_providers.items()} == {
+        "idp-0": "http://edu-9.example.com/adfs/services/trust",
+        "idp-1": "http://edu-7.example.com/adfs/services/trust",
+        "idp-2": "http://edu-8.example.com/adfs/services/trust",
+    }
+
+
+def test_split_entity_descriptors():
+    """Asserts the raw metadata is split in wrappable entity descriptors."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(),
+            generate_sp_metadata(),
+        ]
+    ).encode("utf-8")
+
+    header, footer, ranges = FederationMetadataParser.split_entity_descriptors(
+        fed_metadata
+    )
+
+    assert header.startswith(b'<?xml version="1.0" encoding="UTF-8"?>')
+    assert header.endswith(b'cacheDuration="PT10D"\n>')
+    assert footer == b"</md:EntitiesDescriptor>"
+    assert len(ranges) == 2
+    for (start, end), entity_id in zip(
+        ranges,
+        [
+            "http://edu.example.com/adfs/services/trust",
+            "https://sp.example.com/saml/metadata/",
+        ],
+    ):
+        entity_descriptor = OneLogin_Saml2_XML.to_etree(
+            header + fed_metadata[start:end] + footer
+        )[0]
+        assert entity_descriptor.get("entityID") == entity_id
+
+
+@pytest.mark.parametrize(
+    "fed_metadata",
+    [
+        pytest.param(generate_idp_metadata(), id="single-entity"),
+        pytest.param(
+            generate_idp_federation_metadata(
+                entity_descriptor_list=[
+                    generate_idp_metadata(),
+                    # The entity namespace prefix is declared in a nested element
+                    '<md:EntitiesDescriptor xmlns:fed="urn:oasis:names:tc:SAML:2.0:metadata">'
+                    + generate_idp_metadata(
+                        entity_id="http://edu-2.example.com/adfs/services/trust",
+                        ui_info_display_names=format_mdui_display_name("Nested"),
+                    )
+                    .replace('xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"', "")
+                    .replace("md:", "fed:")
+                    + "</md:EntitiesDescriptor>",
+                ]
+            ),
+            id="nested-namespace",
+        ),
+    ],
+)
+def test_parallel_parsing_fallback(fed_metadata):
+    """Asserts the parallel parsing falls back on the sequential one when needed."""
+    fed_metadata = fed_metadata.encode("utf-8")
+
+    assert FederationMetadataParser.parallel_parse_federation_metadata(
+        fed_metadata,
+        max_workers=2,
+    ) == FederationMetadataParser.parse_federation_metadata(fed_metadata)
+
+
+def test_incremental_parsing(mocker):
+    """Asserts only the new and modified entities are parsed again."""
+    entity_descriptors = {
+        index: generate_idp_metadata(
+            entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+            ui_info_display_names=format_mdui_display_name(f"IdP {index}"),
+        )
+        for index in range(5)
+    }
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[*entity_descriptors.values(), generate_sp_metadata()]
+    ).encode("utf-8")
+
+    report = FederationMetadataReport()
+    (
+        identity_providers,
+        parsing_state,
+    ) = FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata,
+        report=report,
+    )
+
+    assert identity_providers == FederationMetadataParser.parse_federation_metadata(
+        fed_metadata
+    )
+    assert report.identity_provider_count == 5
+    assert report.skipped_entity_count == 1
+    assert report.added_entity_count == 6
+
+    # Modify the second IdP, remove the third one and add a new one
+    entity_descriptors[1] = generate_idp_metadata(
+        entity_id="http://edu-1.example.com/adfs/services/trust",
+        ui_info_display_names=format_mdui_display_name("IdP 1 renamed"),
+    )
+    del entity_descriptors[2]
+    entity_descriptors[5] = generate_idp_metadata(
+        entity_id="http://edu-5.example.com/adfs/services/trust",
+        ui_info_display_names=format_mdui_display_name("IdP 5"),
+    )
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[*entity_descriptors.values(), generate_sp_metadata()]
+    ).encode("utf-8")
+
+    parse_identity_provider_spy = mocker.spy(
+        FederationMetadataParser, "parse_identity_provider"
+    )
+    report = FederationMetadataReport()
+    (
+        identity_providers,
+        parsing_state,
+    ) = FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata,
+        previous_state=parsing_state,
+        report=report,
+    )
+
+    assert parse_identity_provider_spy.call_count == 2
+    assert identity_providers == FederationMetadataParser.parse_federation_metadata(
+        fed_metadata
+    )
+    assert list(identity_providers) == [
+        "idp-0",
+        "idp-1-renamed",
+        "idp-3",
+        "idp-4",
+        "idp-5",
+    ]
+    assert report.identity_provider_count == 5
+    assert report.skipped_entity_count == 1
+    assert report.added_entity_count == 1
+    assert report.changed_entity_count == 1
+    assert report.removed_entity_count == 1
+
+    # Nothing changed
+    parse_identity_provider_spy.reset_mock()
+    report = FederationMetadataReport()
+    assert FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata,
+        previous_state=parsing_state,
+        report=report,
+    ) == (identity_providers, parsing_state)
+    assert not parse_identity_provider_spy.called
+    assert report.added_entity_count == 0
+    assert report.changed_entity_count == 0
+    assert report.removed_entity_count == 0
+
+
+def test_incremental_parsing_process_pool(mocker):
+    """Asserts the process pool is only started for large enough change sets."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(
+                entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+                ui_info_display_names=format_mdui_display_name(f"IdP {index}"),
+            )
+            for index in range(5)
+        ]
+    ).encode("utf-8")
+    process_pool_mock = mocker.patch(
+        "social_edu_federation.parser.ProcessPoolExecutor",
+        side_effect=ProcessPoolExecutor,
+    )
+
+    (
+        identity_providers,
+        _,
+    ) = FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata, max_workers=2
+    )
+    assert not process_pool_mock.called
+
+    mocker.patch.object(FederationMetadataParser, "parallel_parsing_min_entities", 5)
+    assert FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata, max_workers=2
+    ) == (identity_providers, mocker.ANY)
+    process_pool_mock.assert_called_once_with(max_workers=2)
+
+
+def test_incremental_parsing_namespaces_changed(mocker):
+    """Asserts all the entities are parsed again when the root namespaces change."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[generate_idp_metadata()]
+    ).encode("utf-8")
+    _, parsing_state = FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata
+    )
+
+    parse_identity_provider_spy = mocker.spy(
+        FederationMetadataParser, "parse_identity_provider"
+    )
+    (
+        identity_providers,
+        _,
+    ) = FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata.replace(
+            b"<md:EntitiesDescriptor",
+            b'<md:EntitiesDescriptor xmlns:other="https://other.example.com/ns"',
+        ),
+        previous_state=parsing_state,
+    )
+
+    assert parse_identity_provider_spy.call_count == 1
+    assert identity_providers == FederationMetadataParser.parse_federation_metadata(
+        fed_metadata
+    )
+
+
+def test_incremental_parsing_fallback():
+    """Asserts the metadata which can't be split are fully parsed without state."""
+    fed_metadata = generate_idp_metadata().encode("utf-8")
+
+    assert FederationMetadataParser.incremental_parse_federation_metadata(
+        fed_metadata
+    ) == (FederationMetadataParser.parse_federation_metadata(fed_metadata), None)
+
+
+def test_renater_idps_metadata_lookup():
+    """Asserts each Identity Provider can be parsed alone, using the metadata index."""
+    with open(get_resource_filename("real-world-metadata.xml"), "rb") as metadata_fd:
+        metadata = metadata_fd.read()
+
+    identity_providers = FederationMetadataParser.parse_federation_metadata(metadata)
+    index = FederationMetadataParser.index_federation_metadata(metadata)
+
+    assert list(index.entities) == list(identity_providers)
+    for idp_name, idp_configuration in identity_providers.items():
+        assert (
+            FederationMetadataParser.lookup_identity_provider(
+                metadata, idp_name, index=index
+            )
+            == idp_configuration
+        )
+
+
+def test_lookup_identity_provider(mocker):
+    """Asserts only the requested Identity Provider entity descriptor is parsed."""
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(
+                entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+                # The French display name is preferred, names collide every 3 IdPs
+                ui_info_display_names=format_mdui_display_name(
+                    "Some &amp; IdP", language_code="en"
+                )
+                + format_mdui_display_name(f"IdP {index % 3}"),
+            )
+            for index in range(5)
+        ]
+        + [
+            generate_idp_metadata(
+                entity_id="http://no-name.example.com/adfs/services/trust",
+                ui_info_display_names="",
+            ),
+            generate_sp_metadata(),
+        ]
+    ).encode("utf-8")
+    parse_identity_provider_spy = mocker.spy(
+        FederationMetadataParser, "parse_identity_provider"
+    )
+
+    idp_configuration = FederationMetadataParser.lookup_identity_provider(
+        fed_metadata, "idp-1"
+    )
+
+    assert parse_identity_provider_spy.call_count == 1
+    assert (
+        idp_configuration["entityId"] == "http://edu-4.example.com/adfs/services/trust"
+    )
+    assert (
+        FederationMetadataParser.lookup_identity_provider(
+            fed_metadata, "httpno-nameexamplecomadfsservicestrust"
+        )["entityId"]
+        == "http://no-name.example.com/adfs/services/trust"
+    )
+    assert (
+        FederationMetadataParser.lookup_identity_provider(fed_metadata, "unknown")
+        is None
+    )
+
+
+def test_lookup_identity_provider_unreadable_display_name():
+    """
+    Asserts the lookup gives up when a later Identity Provider display name can't
+    be read without parsing, it may have the same name (the last one wins).
+    """
+    fed_metadata = (
+        generate_idp_federation_metadata(
+            entity_descriptor_list=[
+                generate_idp_metadata(
+                    entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+                    ui_info_display_names=format_mdui_display_name(display_name),
+                )
+                for index, display_name in enumerate(["Foo", "Foo1", "Bar", "Baz"])
+            ]
+        )
+        .encode("utf-8")
+        # Markup dropped by the metadata generation
+        .replace(b">Foo1<", b"><!-- x -->Foo<")
+        .replace(b">Baz<", b">B<![CDATA[a]]>z<")
+    )
+    identity_providers = FederationMetadataParser.parse_federation_metadata(
+        fed_metadata
+    )
+    assert identity_providers["foo"]["entityId"] == (
+        "http://edu-1.example.com/adfs/services/trust"
+    )
+
+    for idp_name in ["foo", "bar"]:
+        assert (
+            FederationMetadataParser.lookup_identity_provider(fed_metadata, idp_name)
+            is None
+        )
+
+
+def test_lookup_identity_provider_wrong_guess():
+    """Asserts the lookup gives up when the indexed name is not the parsed one."""
+
+    class OrganizationNameParser(FederationMetadataParser):
+        """Names the Identity Providers after their organization."""
+
+        edu_fed_data_xpaths = {
+            **FederationMetadataParser.edu_fed_data_xpaths,
+            "display_name_fr": compile_xpath("./md:Organization/md:OrganizationName"),
+        }
+
+    fed_metadata = generate_idp_federation_metadata(
+        entity_descriptor_list=[generate_idp_metadata()]
+    ).encode("utf-8")
+
+    # The index relies on the display names
+    assert "edu-local-idp" in OrganizationNameParser.index_federation_metadata(
+        fed_metadata
+    )
+    assert (
+        OrganizationNameParser.lookup_identity_provider(fed_metadata, "edu-local-idp")
+        is None
+    )
+    assert (
+        OrganizationNameParser.lookup_identity_provider(
+            fed_metadata, "organizationname"
+        )
+        is None
+    )
+    assert list(OrganizationNameParser.parse_federation_metadata(fed_metadata)) == [
+        "organizationname"
+    ]
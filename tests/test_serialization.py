@@ -0,0 +1,82 @@
+"""Test module for the cache values serialization."""
+import math
+
+import pytest
+
+from social_edu_federation.serialization import (
+    CODECS,
+    PickleCodec,
+    decode_value,
+    encode_value,
+    get_chunk_count,
+    get_codec,
+    join_chunks,
+    register_codec,
+    split_value,
+)
+
+
+@pytest.mark.parametrize("codec_name", ["pickle", "zlib"])
+def test_encode_decode_value(codec_name):
+    """Asserts the encoded values are decoded with the codec recorded in them."""
+    value = {"some-idp": {"key1": "value1", "x509certMulti": None, "key2": ("a", 1)}}
+
+    encoded_value = encode_value(value, get_codec(codec_name))
+
+    assert isinstance(encoded_value, bytes)
+    assert encoded_value.startswith(f"social_edu_federation:{codec_name}:".encode())
+    assert decode_value(encoded_value) == value
+
+
+@pytest.mark.parametrize("value", [None, "value", b"value", {"key": b"value"}])
+def test_decode_value_not_encoded(value):
+    """Asserts the values not encoded are returned as is."""
+    assert decode_value(value) == value
+
+
+def test_get_codec_unknown():
+    """Asserts an unknown codec is reported."""
+    with pytest.raises(ValueError, match="Unknown codec 'unknown'"):
+        get_codec("unknown")
+
+    with pytest.raises(ValueError, match="Unknown codec 'unknown'"):
+        decode_value(b"social_edu_federation:unknown:value")
+
+
+def test_register_codec(monkeypatch):
+    """Asserts a custom codec can be registered."""
+
+    class ReversedPickleCodec(PickleCodec):
+        """Useless codec for test purpose only"""
+
+        name = "reversed"
+
+        def encode(self, value):
+            return super().encode(value)[::-1]
+
+        def decode(self, data):
+            return super().decode(bytes(data)[::-1])
+
+    monkeypatch.setattr("social_edu_federation.serialization.CODECS", dict(CODECS))
+    register_codec(ReversedPickleCodec())
+
+    assert decode_value(encode_value(["value"], get_codec("reversed"))) == ["value"]
+
+
+def test_split_join_chunks():
+    """Asserts the encoded values are split in chunks and joined back."""
+    value = encode_value({"some-idp": {"key1": "value1" * 100}}, get_codec("zlib"))
+
+    manifest, chunks = split_value(value, 10)
+
+    assert len(chunks) == math.ceil(len(value) / 10)
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert get_chunk_count(manifest) == len(chunks)
+    assert get_chunk_count(value) is None
+    assert get_chunk_count({"not": "bytes"}) is None
+    assert join_chunks(manifest, chunks) == value
+
+    # Missing chunk
+    assert join_chunks(manifest, chunks[:-1] + [None]) is None
+    # Chunk of another value
+    assert join_chunks(manifest, chunks[:-1] + [b"other"]) is None
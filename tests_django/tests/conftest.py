@@ -6,6 +6,7 @@ from django.core.cache import caches
 
 import pytest
 
+from social_edu_federation.metadata_store import reset_metadata_stores
 from social_edu_federation.testing.settings import saml_fer_settings
 
 
@@ -38,6 +39,8 @@ def default_loc_mem_cache_fixture(settings):
 
     # Force cache list reloading
     del caches.settings
+    # The reused metadata stores hold the previous caches
+    reset_metadata_stores()
 
     yield
 
@@ -47,3 +50,4 @@ def default_loc_mem_cache_fixture(settings):
 
     # Force cache list reloading
     del caches.settings
+    reset_metadata_stores()
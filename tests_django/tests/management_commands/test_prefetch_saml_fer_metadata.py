@@ -6,6 +6,7 @@ from django.core.management import CommandError, call_command
 
 import pytest
 
+from social_edu_federation.fetcher import FetchedMetadata, MetadataNotModified
 from social_edu_federation.parser import FederationMetadataParser
 
 
@@ -95,6 +96,47 @@ def test_command_success_several_backends(mocker, settings):
     assert parse_metadata_mock.call_count == 2
 
 
+def test_command_metadata_unchanged(default_loc_mem_cache, mocker, settings):
+    """Asserts the backends whose metadata was not modified are reported."""
+    settings.AUTHENTICATION_BACKENDS = (
+        "social_edu_federation.backends.saml_fer.FERSAMLAuth",
+    )
+    settings.SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_STORE = (
+        "social_edu_federation.django.metadata_store.CachedMetadataStore"
+    )
+    settings.SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_URL = (
+        "https://domain.test/metadata/"
+    )
+
+    xml_metadata = FetchedMetadata(b"been called")
+    xml_metadata.etag = '"v1"'
+    get_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "get_metadata", return_value=xml_metadata
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser,
+        "parse_federation_metadata",
+        return_value={"some-idp": {"key1": "value1"}},
+    )
+
+    out = StringIO()
+    call_command("prefetch_saml_fer_metadata", ["saml_fer"], stdout=out)
+    assert "unchanged" not in out.getvalue()
+
+    get_metadata_mock.side_effect = MetadataNotModified
+    out = StringIO()
+    call_command("prefetch_saml_fer_metadata", ["saml_fer"], stdout=out)
+
+    assert "Metadata for backend 'saml_fer' unchanged" in out.getvalue()
+    assert "All metadata caches refreshed" in out.getvalue()
+    get_metadata_mock.assert_called_with(
+        "https://domain.test/metadata/",
+        timeout=10,
+        headers={"If-None-Match": '"v1"'},
+    )
+    assert parse_metadata_mock.call_count == 1
+
+
 def test_command_fails_base_metadata_store(settings):
     """
     The `prefetch_saml_fer_metadata` management command will fail when the metadata store
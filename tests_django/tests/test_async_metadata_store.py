@@ -0,0 +1,111 @@
+"""Asynchronous metadata store tests, for ASGI deployments."""
+import asyncio
+import time
+
+from django.core.cache import cache as default_cache
+
+import pytest
+
+from social_edu_federation.django.metadata_store import CachedMetadataStore
+from social_edu_federation.parser import FederationMetadataParser
+
+from .test_metadata_store import MockedBackend
+
+
+def test_aget_idp(default_loc_mem_cache, mocker):
+    """
+    Asserts concurrent asynchronous cache misses wait for the same metadata refresh,
+    run in the executor, then the Identity Providers are served without any thread.
+    """
+
+    def slow_get_metadata(*args, **kwargs):  # pylint: disable=unused-argument
+        time.sleep(0.5)
+        return b"been called"
+
+    get_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "get_metadata", side_effect=slow_get_metadata
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    refresh_cache_entries_once_spy = mocker.spy(
+        CachedMetadataStore, "refresh_cache_entries_once"
+    )
+    store = CachedMetadataStore(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_CHECK_INTERVAL=10)
+    )
+    refreshes_run_spy = mocker.spy(store.refreshes, "run")
+    refreshes_arun_spy = mocker.spy(store.refreshes, "arun")
+
+    async def get_idps():
+        return await asyncio.gather(*(store.aget_idp("some-idp") for _ in range(10)))
+
+    assert [idp.key1 for idp in asyncio.run(get_idps())] == ["value1"] * 10
+    assert get_metadata_mock.call_count == 1
+    assert parse_metadata_mock.call_count == 1
+    assert refresh_cache_entries_once_spy.call_count == 1
+    assert refreshes_arun_spy.call_count == 10
+    assert refreshes_run_spy.call_count == 0
+
+    run_in_executor_spy = mocker.spy(asyncio.BaseEventLoop, "run_in_executor")
+    assert asyncio.run(store.aget_idp("some-idp")) is store.get_idp("some-idp")
+    assert run_in_executor_spy.call_count == 0
+
+    # Refreshed less than a minute ago
+    with pytest.raises(KeyError):
+        asyncio.run(store.aget_idp("unknown-idp"))
+    assert get_metadata_mock.call_count == 1
+
+
+def test_aget_idp_not_in_memory(default_loc_mem_cache, mocker):
+    """
+    Asserts the Identity Providers not kept in memory are read with Django's
+    asynchronous cache API, or the synchronous one when not available,
+    and the asynchronous refresh.
+    """
+    mocker.patch.object(
+        FederationMetadataParser, "get_metadata", return_value=b"been called"
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1" * 100}}
+    store = CachedMetadataStore(
+        MockedBackend(
+            FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE=100,
+            FEDERATION_SAML_METADATA_CACHE_CHECK_INTERVAL=0,
+        )
+    )
+
+    all_idp_dict = asyncio.run(store.arefresh_cache_entries())
+    assert all_idp_dict == parse_metadata_mock.return_value
+    assert store.metadata_modified is True
+
+    # Not kept in memory by the process
+    store.identity_providers.clear()
+    run_in_executor_spy = mocker.spy(CachedMetadataStore, "run_in_executor")
+    aget_spy = mocker.spy(CachedMetadataStore, "aget")
+    assert asyncio.run(store.aget_idp("some-idp")).key1 == "value1" * 100
+    assert aget_spy.call_count == 2  # The snapshot and the Identity Provider
+    assert asyncio.run(store.aget_idp("some-idp")).key1 == "value1" * 100
+    assert aget_spy.call_count == 3  # Only the snapshot, not kept in memory
+
+    # Refreshed less than a minute ago, then remembered as unknown
+    with pytest.raises(KeyError):
+        asyncio.run(store.aget_idp("unknown-idp"))
+    with pytest.raises(KeyError):
+        asyncio.run(store.aget_idp("unknown-idp"))
+    assert run_in_executor_spy.call_count == 0
+
+    class SyncCache:
+        """Cache without asynchronous API, like Django 3.2 ones."""
+
+        get = default_cache.get
+        get_many = default_cache.get_many
+
+    store.identity_providers.clear()
+    store.cache = SyncCache()
+    assert asyncio.run(store.aget_idp("some-idp")).key1 == "value1" * 100
+    assert run_in_executor_spy.call_count == 0
+    assert parse_metadata_mock.call_count == 1
@@ -2,7 +2,10 @@
 
 from django.core.checks import Warning as ChecksWarning
 
-from social_edu_federation.django.checks import metadata_store_check
+from social_edu_federation.django.checks import (
+    metadata_cache_check,
+    metadata_store_check,
+)
 
 
 def test_metadata_store_check(settings):
@@ -31,3 +34,47 @@ def test_metadata_store_check(settings):
         "defined.module.Store"
     )
     assert not metadata_store_check([])  # empty list
+
+
+def test_metadata_cache_check(settings):
+    """Asserts the Django checks warn when the metadata cache is memcached without chunks"""
+    settings.AUTHENTICATION_BACKENDS = (
+        "social_edu_federation.backends.saml_fer.FERSAMLAuth",
+        "django.contrib.auth.backends.ModelBackend",
+    )
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "memcached": {
+            "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+            "LOCATION": "127.0.0.1:11211",
+        },
+    }
+    settings.SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_STORE = (
+        "social_edu_federation.django.metadata_store.CachedMetadataStore"
+    )
+    assert not metadata_cache_check([])  # empty list
+
+    settings.SOCIAL_AUTH_SAML_FER_DJANGO_CACHE = "memcached"
+    assert metadata_cache_check([]) == [
+        ChecksWarning(
+            "The 'memcached' cache can't hold the federation metadata.",
+            hint=(
+                "memcached items are limited to 1 MB by default, you should add "
+                "a `SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE` "
+                "setting (at most 1000000) "
+                "for `social_edu_federation.backends.saml_fer.FERSAMLAuth` backend use."
+            ),
+            obj="django.core.cache.backends.memcached.PyMemcacheCache",
+            id="social_edu_federation.W002",
+        )
+    ]
+
+    settings.SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE = 500000
+    assert not metadata_cache_check([])  # empty list
+
+    # Not a cached metadata store
+    settings.SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE = None
+    settings.SOCIAL_AUTH_SAML_FER_FEDERATION_SAML_METADATA_STORE = (
+        "social_edu_federation.metadata_store.BaseMetadataStore"
+    )
+    assert not metadata_cache_check([])  # empty list
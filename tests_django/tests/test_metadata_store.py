@@ -6,12 +6,20 @@ import re
 from django.core.cache import InvalidCacheBackendError, cache as default_cache, caches
 from django.utils import timezone
 
+from httpretty import HTTPretty
 import pytest
 from social_django.utils import load_backend, load_strategy
 
 from social_edu_federation.backends.saml_fer import FERSAMLIdentityProvider
+from social_edu_federation.cache import MemoryCache
 from social_edu_federation.django.metadata_store import CachedMetadataStore
+from social_edu_federation.mirror import MetadataMirror
 from social_edu_federation.parser import FederationMetadataParser
+from social_edu_federation.testing.saml_tools import (
+    format_mdui_display_name,
+    generate_idp_federation_metadata,
+    generate_idp_metadata,
+)
 
 
 class MagicClass:
@@ -34,20 +42,22 @@ class MockedBackend:
     edu_fed_saml_idp_class = MagicClass
     name = "mocked-backend"
 
-    def __init__(self, cache_name=None):
+    def __init__(self, cache_name=None, **settings):
         self.cache_name = cache_name
+        self.settings = settings
 
     def get_federation_metadata_url(self):
         """Boilerplate to return a fixed URL"""
         return "https://domain.test/metadata/"
 
-    def setting(self, name, default_value=None):  # pylint: disable=unused-argument
+    def setting(self, name, default_value=None):
         """
         Defines a dummy method to return the cache name,
-        we assert this is the only setting used.
+        other settings are the ones provided at init or keep their default value.
         """
-        assert name == "DJANGO_CACHE"
-        return self.cache_name
+        if name == "DJANGO_CACHE":
+            return self.cache_name
+        return self.settings.get(name, default_value)
 
 
 @pytest.fixture(name="cache_settings")
@@ -154,17 +164,26 @@ def test_get_idp(cache_name, cache_settings, freezer, mocker):
     assert not hasattr(magic_instance, "key3")
 
     cache_to_test = default_cache if cache_name is None else caches[cache_name]
-    assert cache_to_test.get("edu_federation:mocked-backend:some-idp") == {
+    generation = cache_to_test.get("edu_federation:mocked-backend:snapshot")[
+        "generation"
+    ]
+    assert cache_to_test.get(
+        f"edu_federation:mocked-backend:{generation}:some-idp"
+    ) == {
         "key1": "value1",
         "key2": "value2",
     }
-    assert cache_to_test.get("edu_federation:mocked-backend:other-idp") == {
+    assert cache_to_test.get(
+        f"edu_federation:mocked-backend:{generation}:other-idp"
+    ) == {
         "key3": "value3",
     }
-    assert cache_to_test.get("edu_federation:mocked-backend:all_idps") == {
-        "other-idp": {"key3": "value3"},
-        "some-idp": {"key1": "value1", "key2": "value2"},
-    }
+    assert cache_to_test.get(
+        f"edu_federation:mocked-backend:{generation}:idp_choices"
+    ) == [
+        {"name": "some-idp", "edu_fed_data": {}},
+        {"name": "other-idp", "edu_fed_data": {}},
+    ]
 
     # Now call it again and assert cache is used
     get_metadata_mock.reset_mock()
@@ -182,9 +201,12 @@ def test_get_idp(cache_name, cache_settings, freezer, mocker):
     # Move after the cache expiration
     freezer.move_to(now + datetime.timedelta(hours=24, minutes=1, seconds=1))
 
-    assert cache_to_test.get("edu_federation:mocked-backend:some-idp") is None
-    assert cache_to_test.get("edu_federation:mocked-backend:other-idp") is None
-    assert cache_to_test.get("edu_federation:mocked-backend:all_idps") is None
+    assert cache_to_test.get("edu_federation:mocked-backend:snapshot") is None
+    for key in ("some-idp", "other-idp", "idp_choices"):
+        assert (
+            cache_to_test.get(f"edu_federation:mocked-backend:{generation}:{key}")
+            is None
+        )
 
     magic_instance_refreshed = store.get_idp("some-idp")
 
@@ -291,3 +313,624 @@ def test_saml_fer_backend_integration(cache_settings, mocker, settings):
         "x509certMulti": None,
         "edu_fed_display_name": "Some IdP",
     }
+
+
+def test_refresh_cache_entries_incremental(cache_settings, mocker):
+    """Asserts the refresh only parses the entities changed since the previous one."""
+    store = CachedMetadataStore(MockedBackend())
+    entity_descriptors = [
+        generate_idp_metadata(
+            entity_id=f"http://edu-{index}.example.com/adfs/services/trust",
+            ui_info_display_names=format_mdui_display_name(f"IdP {index}"),
+        )
+        for index in range(3)
+    ]
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+    get_metadata_mock.return_value = generate_idp_federation_metadata(
+        entity_descriptor_list=entity_descriptors
+    ).encode("utf-8")
+    parse_identity_provider_spy = mocker.spy(
+        FederationMetadataParser, "parse_identity_provider"
+    )
+
+    assert list(store.refresh_cache_entries()) == ["idp-0", "idp-1", "idp-2"]
+    assert parse_identity_provider_spy.call_count == 3
+
+    entity_descriptors[1] = generate_idp_metadata(
+        entity_id="http://edu-1.example.com/adfs/services/trust",
+        ui_info_display_names=format_mdui_display_name("IdP 1 renamed"),
+    )
+    get_metadata_mock.return_value = generate_idp_federation_metadata(
+        entity_descriptor_list=entity_descriptors
+    ).encode("utf-8")
+    parse_identity_provider_spy.reset_mock()
+
+    all_idp_dict = store.refresh_cache_entries()
+
+    assert parse_identity_provider_spy.call_count == 1
+    assert list(all_idp_dict) == ["idp-0", "idp-1-renamed", "idp-2"]
+    generation = store.get("snapshot")["generation"]
+    assert [idp["name"] for idp in store.get_idp_choices()] == list(all_idp_dict)
+    assert (
+        store.get_generation_entry(generation, "idp-1-renamed")
+        == all_idp_dict["idp-1-renamed"]
+    )
+
+
+def test_get_idp_identity_provider_reused(cache_settings, mocker):
+    """Asserts the IdP instances are reused until the cache is refreshed."""
+    store = CachedMetadataStore(MockedBackend())
+
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    create_from_config_dict_spy = mocker.spy(MagicClass, "create_from_config_dict")
+
+    magic_instance = store.get_idp("some-idp")
+    cache_get_spy = mocker.spy(store, "get")
+
+    assert CachedMetadataStore(MockedBackend()).get_idp("some-idp") is magic_instance
+    assert store.get_idp("some-idp") is magic_instance
+    assert create_from_config_dict_spy.call_count == 1
+    # Only the snapshot generation is loaded from the cache
+    assert [call.args for call in cache_get_spy.call_args_list] == [("snapshot",)]
+
+    # A new snapshot is loaded in cache
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "new value1"}}
+    store.refresh_cache_entries()
+
+    refreshed_magic_instance = store.get_idp("some-idp")
+
+    assert refreshed_magic_instance is not magic_instance
+    assert refreshed_magic_instance.key1 == "new value1"
+    assert create_from_config_dict_spy.call_count == 2
+
+
+def test_cache_entries_timeout(cache_settings, freezer):
+    """Asserts the cache entries timeout defaults to the cache duration, 0 included."""
+    store = CachedMetadataStore(MockedBackend())
+
+    store.set("default", "value")
+    store.set_many(some_idp={"key1": "value1"})
+    store.set("expired", "value", 0)
+    store.set_many(0, other_idp={"key1": "value1"})
+
+    freezer.tick(datetime.timedelta(hours=24))
+    assert store.get("default") == "value"
+    assert store.get("some_idp") == {"key1": "value1"}
+    assert store.get("expired") is None
+    assert store.get("other_idp") is None
+
+
+def test_refresh_cache_entries_jitter(cache_settings, freezer, mocker):
+    """Asserts the cache duration jitter is applied to all the cache entries."""
+    store = CachedMetadataStore(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_JITTER=600)
+    )
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    mocker.patch.object(
+        FederationMetadataParser,
+        "parse_federation_metadata",
+        return_value={"some-idp": {"key1": "value1"}},
+    )
+    uniform_mock = mocker.patch(
+        "social_edu_federation.django.metadata_store.random.uniform",
+        return_value=300,
+    )
+
+    store.refresh_cache_entries()
+
+    uniform_mock.assert_called_once_with(0, 600)
+    generation = store.get("snapshot")["generation"]
+    keys = ("snapshot", f"{generation}:idp_choices", f"{generation}:some-idp")
+    freezer.tick(datetime.timedelta(hours=24, minutes=1, seconds=1))
+    for key in keys:
+        assert store.get(key) is not None
+    freezer.tick(datetime.timedelta(seconds=300))
+    for key in keys:
+        assert store.get(key) is None
+
+
+@pytest.mark.parametrize(
+    "backend_settings,stale_after",
+    [
+        # Limited by the metadata `validUntil`
+        ({}, datetime.timedelta(days=2)),
+        (
+            {"FEDERATION_SAML_METADATA_MAX_STALENESS": 25 * 3600},
+            datetime.timedelta(hours=25),
+        ),
+    ],
+)
+def test_get_idp_last_known_good(
+    backend_settings, cache_settings, freezer, mocker, stale_after
+):
+    """Asserts the last known good metadata is served while the refresh fails."""
+    store = CachedMetadataStore(MockedBackend(**backend_settings))
+    mocker.patch.object(CachedMetadataStore, "should_refresh_early", return_value=False)
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+    get_metadata_mock.return_value = generate_idp_federation_metadata(
+        entity_descriptor_list=[
+            generate_idp_metadata(
+                ui_info_display_names=format_mdui_display_name("Some IdP"),
+            )
+        ],
+        valid_until=(timezone.now() + datetime.timedelta(days=2)).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        ),
+    ).encode("utf-8")
+    magic_instance = store.get_idp("some-idp")
+
+    # The federation is not reachable anymore
+    get_metadata_mock.side_effect = OSError("Connection timed out")
+    freezer.tick(datetime.timedelta(hours=24, minutes=2))
+
+    assert store.get_idp("some-idp") is magic_instance
+    assert get_metadata_mock.call_count == 2
+    assert default_cache.get("edu_federation:mocked-backend:refresh_lock") is None
+
+    # The refresh is not tried again on each request
+    freezer.tick(datetime.timedelta(seconds=59))
+    assert store.get_idp("some-idp") is magic_instance
+    assert get_metadata_mock.call_count == 2
+
+    freezer.tick(datetime.timedelta(seconds=2))
+    assert store.get_idp("some-idp") is magic_instance
+    assert get_metadata_mock.call_count == 3
+
+    # Too old to be served
+    freezer.move_to(
+        timezone.now() + stale_after - datetime.timedelta(hours=24, minutes=2)
+    )
+    with pytest.raises(OSError, match="Connection timed out"):
+        store.get_idp("some-idp")
+
+
+def test_get_idp_no_last_known_good(cache_settings, mocker):
+    """Asserts the refresh error is raised when no metadata was ever fetched."""
+    store = CachedMetadataStore(MockedBackend())
+    mocker.patch.object(
+        FederationMetadataParser,
+        "get_metadata",
+        side_effect=OSError("Connection timed out"),
+    )
+
+    with pytest.raises(OSError, match="Connection timed out"):
+        store.get_idp("some-idp")
+    assert default_cache.get("edu_federation:mocked-backend:refresh_lock") is None
+
+
+def test_refresh_cache_entries_new_generation(cache_settings, mocker):
+    """
+    Asserts each refresh is stored in a new generation, the Identity Providers
+    removed from the federation are not served anymore.
+    """
+    store = CachedMetadataStore(MockedBackend())
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {
+        "some-idp": {"key1": "value1"},
+        "other-idp": {"key2": "value2"},
+    }
+    assert store.get_idp("other-idp").key2 == "value2"
+    previous_generation = store.get("snapshot")["generation"]
+
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "new value1"}}
+    store.refresh_cache_entries()
+    generation = store.get("snapshot")["generation"]
+
+    assert generation != previous_generation
+    assert store.get_idp_choices() == [{"name": "some-idp", "edu_fed_data": {}}]
+    assert store.get_idp("some-idp").key1 == "new value1"
+    with pytest.raises(KeyError):
+        store.get_idp("other-idp")
+
+    # The previous generation is left unchanged until it expires
+    assert store.get_generation_entry(previous_generation, "idp_choices") == [
+        {"name": "some-idp", "edu_fed_data": {}},
+        {"name": "other-idp", "edu_fed_data": {}},
+    ]
+    assert store.get_generation_entry(previous_generation, "other-idp") == {
+        "key2": "value2"
+    }
+    assert store.get_generation_entry(generation, "other-idp") is None
+
+
+def test_get_idp_cache_codec(cache_settings, mocker):
+    """Asserts the cached values are encoded with the codec defined in settings."""
+    store = CachedMetadataStore(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_CODEC="zlib")
+    )
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    mocker.patch.object(
+        FederationMetadataParser,
+        "parse_federation_metadata",
+        return_value={"some-idp": {"key1": "value1"}},
+    )
+
+    assert store.get_idp("some-idp").key1 == "value1"
+
+    generation = store.get("snapshot")["generation"]
+    assert default_cache.get(
+        f"edu_federation:mocked-backend:{generation}:some-idp"
+    ).startswith(b"social_edu_federation:zlib:")
+    assert store.get_generation_entry(generation, "some-idp") == {"key1": "value1"}
+    # A store without codec still reads the encoded values
+    assert CachedMetadataStore(MockedBackend()).get_idp_choices() == [
+        {"name": "some-idp", "edu_fed_data": {}}
+    ]
+
+
+def test_cache_codec_does_not_exist(cache_settings):
+    """Asserts an unknown codec is reported."""
+    with pytest.raises(ValueError, match="Unknown codec 'unknown'"):
+        CachedMetadataStore(
+            MockedBackend(FEDERATION_SAML_METADATA_CACHE_CODEC="unknown")
+        )
+
+
+def test_get_idp_cache_chunks(cache_settings, mocker):
+    """Asserts the cached values larger than the chunk size are split in chunks."""
+    store = CachedMetadataStore(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_CHUNK_SIZE=100)
+    )
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {
+        "some-idp": {"key1": "value1" * 50},
+        "other-idp": {"key2": "value2"},
+    }
+
+    assert store.get_idp("some-idp").key1 == "value1" * 50
+    generation = store.get("snapshot")["generation"]
+    some_idp_key = f"edu_federation:mocked-backend:{generation}:some-idp"
+    assert default_cache.get(some_idp_key).startswith(b"social_edu_federation:chunks:")
+    assert all(
+        len(default_cache.get(f"{some_idp_key}:chunk:{index}")) <= 100
+        for index in range(3)
+    )
+    assert store.get_generation_entry(generation, "some-idp") == {"key1": "value1" * 50}
+    # Small values are not split
+    assert default_cache.get(
+        f"edu_federation:mocked-backend:{generation}:other-idp"
+    ).startswith(b"social_edu_federation:pickle:")
+
+    # A missing chunk makes the whole value missing
+    default_cache.delete(f"{some_idp_key}:chunk:1")
+    assert store.get_generation_entry(generation, "some-idp") is None
+
+
+def test_get_idp_refreshed_by_other_process(cache_settings, mocker):
+    """
+    Asserts the Identity Provider configuration is read from the cache entries
+    refreshed by the process owning the lock, where each one is stored once.
+    """
+    default_cache.add("edu_federation:mocked-backend:refresh_lock", "other", 60)
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {
+        "some-idp": {"key1": "value1", "edu_fed_data": {"display_name": "Some IdP"}},
+        "other-idp": {"key2": "value2"},
+    }
+    store = CachedMetadataStore(MockedBackend())
+    store.refresh_poll_interval = 0.01
+    mocker.patch(
+        "social_edu_federation.django.metadata_store.time.sleep",
+        side_effect=lambda _: CachedMetadataStore(
+            MockedBackend()
+        ).refresh_cache_entries(),
+    )
+
+    assert store.get_idp("some-idp").key1 == "value1"
+    assert parse_metadata_mock.call_count == 1
+
+    generation = store.get("snapshot")["generation"]
+    assert sorted(default_cache._cache) == sorted(  # pylint: disable=protected-access
+        f":1:edu_federation:mocked-backend:{key}"
+        for key in (
+            "last_known_good",
+            "refresh_lock",
+            "snapshot",
+            f"{generation}:idp_choices",
+            f"{generation}:other-idp",
+            f"{generation}:some-idp",
+        )
+    )
+    assert store.get_idp_choices() == [
+        {"name": "some-idp", "edu_fed_data": {"display_name": "Some IdP"}},
+        {"name": "other-idp", "edu_fed_data": {}},
+    ]
+
+
+def test_get_idp_unknown(cache_settings, freezer, mocker):
+    """Asserts unknown IdP names do not lead to a cache refresh on each request."""
+    store = CachedMetadataStore(MockedBackend())
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    store.get_idp("some-idp")
+
+    # The cache was just refreshed
+    with pytest.raises(KeyError):
+        store.get_idp("unknown-idp")
+    assert parse_metadata_mock.call_count == 1
+
+    # Only the snapshot is loaded from the cache for a known unknown IdP
+    cache_get_spy = mocker.spy(store, "get")
+    with pytest.raises(KeyError):
+        store.get_idp("unknown-idp")
+    assert [call.args for call in cache_get_spy.call_args_list] == [("snapshot",)]
+
+    # The cache is refreshed once the minimum interval is over
+    freezer.tick(datetime.timedelta(seconds=61))
+    with pytest.raises(KeyError):
+        store.get_idp("other-unknown-idp")
+    assert parse_metadata_mock.call_count == 2
+    with pytest.raises(KeyError):
+        store.get_idp("other-unknown-idp")
+    with pytest.raises(KeyError):
+        store.get_idp("unknown-idp")
+    assert parse_metadata_mock.call_count == 2
+    assert store.get_idp("some-idp").key1 == "value1"
+
+
+def test_get_idp_evicted(cache_settings, freezer, mocker):
+    """
+    Asserts the Identity Providers evicted from the cache are not taken for
+    unknown ones, but stored again.
+    """
+    store = CachedMetadataStore(MockedBackend())
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {
+        "some-idp": {"key1": "value1"},
+        "other-idp": {"key1": "value2"},
+    }
+    store.refresh_cache_entries()
+    generation = store.get_snapshot()["generation"]
+
+    # Evicted right after the refresh, restored from the last known good metadata
+    store.cache.delete(f"edu_federation:mocked-backend:{generation}:some-idp")
+    assert store.get_idp("some-idp").key1 == "value1"
+    assert get_metadata_mock.call_count == 1
+    assert store.get_generation_entry(generation, "some-idp") == {"key1": "value1"}
+    with pytest.raises(KeyError):
+        store.get_idp("unknown-idp")
+
+    # The choices are evicted too (and not kept in memory by this process),
+    # the cache is refreshed
+    freezer.tick(datetime.timedelta(seconds=1))
+    store.idp_choices_lists.clear()
+    for entry_id in ["idp_choices", "other-idp"]:
+        store.cache.delete(f"edu_federation:mocked-backend:{generation}:{entry_id}")
+    assert store.get_idp("other-idp").key1 == "value2"
+    assert get_metadata_mock.call_count == 2
+
+
+def test_get_idp_snapshot_check_interval(cache_settings, freezer, mocker):
+    """Asserts the snapshot kept in memory spares the cache reads."""
+    CachedMetadataStore.snapshots.clear()
+    store = CachedMetadataStore(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_CHECK_INTERVAL=10)
+    )
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    magic_instance = store.get_idp("some-idp")
+    idp_choices = store.get_idp_choices()
+
+    cache_get_spy = mocker.spy(store, "get")
+    assert store.get_idp("some-idp") is magic_instance
+    assert store.get_idp_choices() is idp_choices
+    assert cache_get_spy.call_count == 0
+
+    # Another process refreshes the cache
+    snapshot = store.get("snapshot")
+    store.set_generation_entries(
+        "new-generation", {"some-idp": {"key1": "new value1"}}, 100
+    )
+    store.set("snapshot", {**snapshot, "generation": "new-generation"})
+
+    # The previous generation is used until the snapshot is checked again
+    assert store.get_idp("some-idp") is magic_instance
+    freezer.tick(datetime.timedelta(seconds=11))
+    assert store.get_idp("some-idp").key1 == "new value1"
+
+    # The snapshot is checked again at once for an unknown IdP
+    store.set_generation_entries(
+        "newer-generation", {"new-idp": {"key2": "value2"}}, 100
+    )
+    store.set("snapshot", {**snapshot, "generation": "newer-generation"})
+    assert store.get_idp("new-idp").key2 == "value2"
+    assert [choice["name"] for choice in store.get_idp_choices()] == ["new-idp"]
+    assert parse_metadata_mock.call_count == 1
+
+    # The refreshes of the process are used at once
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "last value1"}}
+    store.refresh_cache_entries()
+    assert store.get_idp("some-idp").key1 == "last value1"
+
+    CachedMetadataStore.snapshots.clear()
+
+
+def test_get_idp_snapshot_check_interval_other_process(cache_settings, mocker):
+    """
+    Asserts the snapshot kept in memory is not used once the cache entries were
+    refreshed by another process, while this one was waiting for them.
+    """
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    store = CachedMetadataStore(
+        MockedBackend(FEDERATION_SAML_METADATA_CACHE_CHECK_INTERVAL=10)
+    )
+    store.refresh_min_interval = 0
+    store.refresh_poll_interval = 0.01
+    store.get_idp_choices()
+    # The other process keeps its own snapshot in memory
+    other_process_store = CachedMetadataStore(MockedBackend())
+    other_process_store.snapshots = MemoryCache(max_entries=100, default_timeout=None)
+
+    def refresh_by_other_process(_interval):
+        other_process_store.refresh_cache_entries()
+        default_cache.delete("edu_federation:mocked-backend:refresh_lock")
+
+    mocker.patch(
+        "social_edu_federation.django.metadata_store.time.sleep",
+        side_effect=refresh_by_other_process,
+    )
+
+    for get_value, expected_value in (
+        (lambda: store.get_idp("some-idp").key1, "value1"),
+        (store.get_idp_choices, [{"name": "some-idp", "edu_fed_data": {}}]),
+    ):
+        default_cache.clear()
+        store.identity_providers.clear()
+        store.idp_choices_lists.clear()
+        default_cache.add("edu_federation:mocked-backend:refresh_lock", "other", 60)
+        assert get_value() == expected_value
+    assert parse_metadata_mock.call_count == 3
+
+
+def test_refresh_cache_entries_not_modified(cache_settings, freezer, mocker):
+    """
+    Asserts the metadata not modified since the previous refresh is neither
+    downloaded nor parsed again, the cache entries are stored again.
+    """
+
+    def serve_metadata(request, _uri, response_headers):
+        """Local stand-in for the federation server, with conditional requests."""
+        response_headers["ETag"] = '"v1"'
+        if request.headers.get("If-None-Match") == '"v1"':
+            return 304, response_headers, ""
+        return 200, response_headers, generate_idp_federation_metadata()
+
+    HTTPretty.enable(allow_net_connect=False)
+    HTTPretty.register_uri(
+        HTTPretty.GET, "https://domain.test/metadata/", body=serve_metadata
+    )
+    try:
+        store = CachedMetadataStore(MockedBackend())
+        all_idp_dict = store.refresh_cache_entries()
+        snapshot = store.get("snapshot")
+        assert store.metadata_modified is True
+
+        parse_metadata_spy = mocker.spy(
+            FederationMetadataParser, "incremental_parse_federation_metadata"
+        )
+        set_generation_entries_spy = mocker.spy(store, "set_generation_entries")
+        set_last_known_good_spy = mocker.spy(store, "set_last_known_good")
+        cache_set_many_spy = mocker.spy(store.cache, "set_many")
+        freezer.tick(datetime.timedelta(hours=1))
+        # Evicted entry
+        key_prefix = f"edu_federation:mocked-backend:{snapshot['generation']}"
+        store.cache.delete(f"{key_prefix}:edu-local-idp")
+
+        assert store.refresh_cache_entries() == all_idp_dict
+        assert store.metadata_modified is False
+        assert HTTPretty.last_request.headers["If-None-Match"] == '"v1"'
+        assert parse_metadata_spy.call_count == 0
+        new_snapshot = store.get("snapshot")
+        assert new_snapshot["generation"] == snapshot["generation"]
+        assert new_snapshot["expires_at"] == pytest.approx(
+            snapshot["expires_at"] + 3600
+        )
+        # The entries are stored again in a single call, the evicted one included
+        set_generation_entries_spy.assert_called_once_with(
+            snapshot["generation"], all_idp_dict, mocker.ANY
+        )
+        generation_set_many_calls = [
+            call
+            for call in cache_set_many_spy.call_args_list
+            if f"{key_prefix}:idp_choices" in call.args[0]
+        ]
+        assert len(generation_set_many_calls) == 1
+        assert f"{key_prefix}:edu-local-idp" in generation_set_many_calls[0].args[0]
+        freezer.tick(datetime.timedelta(hours=23, minutes=30))
+        assert store.get_generation_entry(snapshot["generation"], "idp_choices")
+        assert store.get_generation_entry(snapshot["generation"], "edu-local-idp")
+        # The last known good metadata is not stored again
+        assert set_last_known_good_spy.call_count == 0
+        last_known_good = store.get_last_known_good()
+        assert last_known_good["computed_at"] == new_snapshot["computed_at"]
+        assert store.get("last_known_good")["computed_at"] == snapshot["computed_at"]
+
+        # The configurations of an older parser are not served again
+        store.set_last_known_good({**last_known_good, "parsing_version": 0})
+        assert store.refresh_cache_entries() == all_idp_dict
+        assert store.metadata_modified is True
+        assert "If-None-Match" not in HTTPretty.last_request.headers
+        assert parse_metadata_spy.call_count == 1
+    finally:
+        HTTPretty.disable()
+        HTTPretty.reset()
+
+
+def test_refresh_cache_entries_mirror(cache_settings, mocker, tmp_path):
+    """
+    Asserts the metadata is mirrored in a local directory, to recover
+    from a flushed cache without downloading nor parsing it again.
+    """
+
+    def serve_metadata(request, _uri, response_headers):
+        """Local stand-in for the federation server, with conditional requests."""
+        response_headers["ETag"] = '"v1"'
+        if request.headers.get("If-None-Match") == '"v1"':
+            return 304, response_headers, ""
+        return 200, response_headers, generate_idp_federation_metadata()
+
+    HTTPretty.enable(allow_net_connect=False)
+    HTTPretty.register_uri(
+        HTTPretty.GET, "https://domain.test/metadata/", body=serve_metadata
+    )
+    try:
+        backend = MockedBackend(FEDERATION_SAML_METADATA_MIRROR_DIR=str(tmp_path))
+        all_idp_dict = CachedMetadataStore(backend).refresh_cache_entries()
+        assert (tmp_path / "mocked-backend.xml").read_bytes() == (
+            generate_idp_federation_metadata().encode("utf-8")
+        )
+        assert (tmp_path / "mocked-backend.pickle").exists()
+
+        default_cache.clear()
+        parse_metadata_spy = mocker.spy(
+            FederationMetadataParser, "incremental_parse_federation_metadata"
+        )
+        write_snapshot_spy = mocker.spy(MetadataMirror, "write_snapshot")
+        store = CachedMetadataStore(backend)
+        assert store.refresh_cache_entries() == all_idp_dict
+        assert store.metadata_modified is False
+        assert parse_metadata_spy.call_count == 0
+        # Nothing changed, the mirror is left alone
+        assert write_snapshot_spy.call_count == 0
+        assert store.get("last_known_good")["all_idps"] == all_idp_dict
+
+        # The mirror is also used when the federation is unreachable
+        default_cache.clear()
+        HTTPretty.reset()
+        HTTPretty.register_uri(
+            HTTPretty.GET, "https://domain.test/metadata/", status=503
+        )
+        mocker.patch.object(store, "get_fetch_kwargs", return_value={"retries": 0})
+        assert store.refresh_cache_entries_or_restore() == all_idp_dict
+        assert store.get_idp("edu-local-idp").entityId == (
+            all_idp_dict["edu-local-idp"]["entityId"]
+        )
+    finally:
+        HTTPretty.disable()
+        HTTPretty.reset()
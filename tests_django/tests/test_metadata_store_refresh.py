@@ -0,0 +1,250 @@
+"""Metadata store tests of the cache refreshes coordination, between processes and threads."""
+import threading
+import time
+
+from django.core.cache import cache as default_cache
+
+import pytest
+
+from social_edu_federation.django.metadata_store import (
+    CachedMetadataStore,
+    RefreshWaitTimeout,
+)
+from social_edu_federation.fetcher import MetadataNotModified
+from social_edu_federation.parser import FederationMetadataParser
+
+from .test_metadata_store import MockedBackend
+
+
+def test_get_idp_single_refresh(default_loc_mem_cache, mocker):
+    """Asserts concurrent cache misses only lead to one metadata refresh."""
+
+    def slow_get_metadata(*args, **kwargs):  # pylint: disable=unused-argument
+        time.sleep(0.5)
+        return b"been called"
+
+    get_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "get_metadata", side_effect=slow_get_metadata
+    )
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    refresh_cache_entries_once_spy = mocker.spy(
+        CachedMetadataStore, "refresh_cache_entries_once"
+    )
+
+    results = []
+
+    def get_idp():
+        store = CachedMetadataStore(MockedBackend())
+        store.refresh_poll_interval = 0.05
+        results.append(store.get_idp("some-idp").key1)
+
+    threads = [threading.Thread(target=get_idp) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["value1"] * 4
+    assert get_metadata_mock.call_count == 1
+    assert parse_metadata_mock.call_count == 1
+    # The threads of the process wait for the same refresh, without polling the cache
+    assert refresh_cache_entries_once_spy.call_count == 1
+    # The lock is released
+    assert default_cache.get("edu_federation:mocked-backend:refresh_lock") is None
+
+
+def test_get_idp_refresh_lock_released(default_loc_mem_cache, mocker):
+    """
+    Asserts the cache is refreshed, holding the lock, when the process owning
+    the lock fails.
+    """
+    default_cache.add("edu_federation:mocked-backend:refresh_lock", "other", 60)
+    store = CachedMetadataStore(MockedBackend())
+    store.refresh_poll_interval = 0.01
+
+    sleep_mock = mocker.patch("social_edu_federation.django.metadata_store.time.sleep")
+    sleep_mock.side_effect = lambda _: default_cache.delete(
+        "edu_federation:mocked-backend:refresh_lock"
+    )
+    acquire_refresh_lock_spy = mocker.spy(store, "acquire_refresh_lock")
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+
+    assert store.get_idp("some-idp").key1 == "value1"
+    assert parse_metadata_mock.call_count == 1
+    assert sleep_mock.call_count == 1
+    assert acquire_refresh_lock_spy.call_count == 2
+    assert default_cache.get("edu_federation:mocked-backend:refresh_lock") is None
+
+
+def test_refresh_cache_entries_once_not_modified(default_loc_mem_cache, mocker):
+    """
+    Asserts the processes waiting for the refresh of the current generation notice
+    it is done when the metadata was not modified, the generation being kept.
+    """
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    store = CachedMetadataStore(MockedBackend())
+    store.refresh_cache_entries()
+    snapshot = store.get_snapshot()
+
+    def slow_fetch_remote_metadata(*args, **kwargs):  # pylint: disable=unused-argument
+        time.sleep(0.2)
+        raise MetadataNotModified()
+
+    fetch_remote_metadata_mock = mocker.patch.object(
+        CachedMetadataStore,
+        "fetch_remote_metadata",
+        side_effect=slow_fetch_remote_metadata,
+    )
+    results = []
+
+    def refresh():
+        # Other processes, not sharing their refreshes
+        other_process_store = CachedMetadataStore(MockedBackend())
+        other_process_store.refresh_poll_interval = 0.01
+        results.append(other_process_store.refresh_cache_entries_once(snapshot))
+
+    threads = [threading.Thread(target=refresh) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fetch_remote_metadata_mock.call_count == 1
+    assert sorted(results, key=bool) == [None] * 3 + [{"some-idp": {"key1": "value1"}}]
+    assert store.get_snapshot()["generation"] == snapshot["generation"]
+
+
+@pytest.mark.parametrize("cache_state", ["empty", "current", "last_known_good"])
+def test_get_idp_refresh_lock_not_released(default_loc_mem_cache, cache_state, mocker):
+    """
+    Asserts the cache is not refreshed when the process owning the lock takes
+    too long: the current cache entries or the last known good ones are served,
+    if any.
+    """
+    mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    store = CachedMetadataStore(MockedBackend())
+    if cache_state != "empty":
+        store.refresh_cache_entries()
+    if cache_state == "last_known_good":
+        default_cache.delete("edu_federation:mocked-backend:snapshot")
+    snapshot = store.get_snapshot()
+
+    default_cache.add("edu_federation:mocked-backend:refresh_lock", "other", 60)
+    store.refresh_poll_interval = 0.01
+    store.refresh_wait_timeout = 0.1
+    mocker.patch("social_edu_federation.django.metadata_store.time.sleep")
+    parse_metadata_mock.reset_mock()
+
+    if cache_state == "empty":
+        with pytest.raises(RefreshWaitTimeout):
+            store.refresh_cache_entries_or_restore(snapshot)
+    elif cache_state == "current":
+        assert store.refresh_cache_entries_or_restore(snapshot) is None
+        assert store.get_idp("some-idp").key1 == "value1"
+    else:
+        assert store.refresh_cache_entries_or_restore(snapshot) == {
+            "some-idp": {"key1": "value1"}
+        }
+        assert store.get_idp("some-idp").key1 == "value1"
+    assert parse_metadata_mock.call_count == 0
+    # The lock of the other process is not released
+    assert default_cache.get("edu_federation:mocked-backend:refresh_lock") == "other"
+
+
+def test_refresh_wait_timeout(default_loc_mem_cache):
+    """
+    Asserts the processes wait for the refresh as long as its fetch may last,
+    unless the waiting duration is defined.
+    """
+    # pylint: disable=protected-access
+    assert CachedMetadataStore(MockedBackend())._get_refresh_wait_timeout() == 40
+    store = CachedMetadataStore(
+        MockedBackend(
+            FEDERATION_SAML_METADATA_TIMEOUT=(3, 5),
+            FEDERATION_SAML_METADATA_FETCH_RETRIES=0,
+        )
+    )
+    assert store._get_refresh_wait_timeout() == 8
+    store.refresh_wait_timeout = 30
+    assert store._get_refresh_wait_timeout() == 30
+
+    # At most as long as the lock of the refreshing process is kept
+    store = CachedMetadataStore(MockedBackend(FEDERATION_SAML_METADATA_TIMEOUT=None))
+    assert store._get_refresh_wait_timeout() == store.refresh_lock_timeout
+
+
+@pytest.mark.parametrize(
+    "random_value,expected",
+    [
+        (0.5, False),  # 100 seconds before expiration, the refresh takes 10 seconds
+        (1 - 1e-10, True),
+    ],
+)
+def test_should_refresh_early(default_loc_mem_cache, expected, mocker, random_value):
+    """Asserts the early refresh decision depends on the expiration and refresh delay."""
+    store = CachedMetadataStore(MockedBackend())
+    mocker.patch(
+        "social_edu_federation.django.metadata_store.random.random",
+        return_value=random_value,
+    )
+
+    assert (
+        store.should_refresh_early(
+            {
+                "generation": "generation",
+                "computed_at": time.time() - 1000,
+                "delta": 10,
+                "expires_at": time.time() + 100,
+            }
+        )
+        is expected
+    )
+
+
+def test_get_idp_early_refresh(default_loc_mem_cache, mocker):
+    """Asserts the cache is refreshed in background when `should_refresh_early`."""
+    store = CachedMetadataStore(MockedBackend())
+    get_metadata_mock = mocker.patch.object(FederationMetadataParser, "get_metadata")
+    parse_metadata_mock = mocker.patch.object(
+        FederationMetadataParser, "parse_federation_metadata"
+    )
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "value1"}}
+    magic_instance = store.get_idp("some-idp")
+    snapshot = store.get("snapshot")
+
+    assert snapshot["expires_at"] == pytest.approx(snapshot["computed_at"] + 86460)
+
+    should_refresh_early_mock = mocker.patch.object(
+        CachedMetadataStore, "should_refresh_early", return_value=True
+    )
+    start_early_refresh_spy = mocker.spy(CachedMetadataStore, "start_early_refresh")
+    parse_metadata_mock.return_value = {"some-idp": {"key1": "new value1"}}
+
+    # The current cache entries are used while the refresh is running
+    assert store.get_idp("some-idp") is magic_instance
+
+    start_early_refresh_spy.spy_return.join()
+    should_refresh_early_mock.return_value = False
+    assert get_metadata_mock.call_count == 2
+    assert store.get("snapshot")["generation"] != snapshot["generation"]
+    assert store.get_idp("some-idp").key1 == "new value1"
+    assert default_cache.get("edu_federation:mocked-backend:refresh_lock") is None
+
+    # No early refresh while another process refreshes the cache
+    default_cache.add("edu_federation:mocked-backend:refresh_lock", "other", 60)
+    assert store.start_early_refresh() is None